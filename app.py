@@ -1,5 +1,6 @@
 from flask import Flask, render_template, request, jsonify, session
 from flask_socketio import SocketIO, join_room, leave_room, emit
+from socketio import PubSubManager
 import os
 import sys
 import subprocess
@@ -9,24 +10,186 @@ import json
 import re
 import time
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+import itertools
 import threading
+import atexit
+import sqlite3
+import zlib
+from contextlib import contextmanager
+import platform
+import queue
+import hashlib
+import shutil
+import codecs
+import signal
+import gzip
+import bisect
+import functools
+import mmap
+import array
+import struct
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from ot import (utf16_len, split_utf16, component_length, append_component,
+                check_text_op, apply_text_op, transform_text_op, compose_text_ops)
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import pty
+except ImportError:  # Windows
+    pty = None
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is used instead
+    brotli = None
+
+try:
+    import pyflakes
+except ImportError:  # optional Python linter
+    pyflakes = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24)
-socketio = SocketIO(app, cors_allowed_origins="*", ping_timeout=60, ping_interval=25)
-
 # Configuration
 ROOMS_DIR = "rooms"
 SETTINGS_DIR = "settings"
 SNIPPETS_DIR = "snippets"
+JOURNAL_DIR = "journal"
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
 CODE_EXECUTION_TIMEOUT = 10
+DOCUMENT_HISTORY_LIMIT = 1000  # ops kept per document to transform late edits
+DOCUMENT_FLUSH_INTERVAL = 0.5  # seconds between write-behind passes
+DOCUMENT_FLUSH_DELAY = 2  # seconds a document may stay dirty before it is written
+DOCUMENT_FLUSH_BYTES = 256 * 1024  # changed characters that force an early write
+DOCUMENT_IDLE_TIMEOUT = 300  # seconds before an untouched document is evicted
+PRESENCE_TICK_RATE = 20  # presence frames per second per room
+PRESENCE_MAX_RATE = 10  # default cap on cursor/selection updates per second per client
+STATE_BACKEND = os.environ.get('CODESYNC_STATE_BACKEND', 'memory')  # memory, sqlite:///path or redis://...
+MESSAGE_QUEUE = os.environ.get('CODESYNC_MESSAGE_QUEUE')  # e.g. redis://... or sqlite:///path for several workers
+MESSAGE_QUEUE_POLL_INTERVAL = 0.02  # seconds between polls of a sqlite message queue
+MESSAGE_QUEUE_RETENTION = 60  # seconds queued messages are kept in sqlite
+EXECUTION_WORKERS = 4  # code runs executing at once
+EXECUTION_QUEUE_LIMIT = 32  # runs allowed to wait before submissions are refused
+EXECUTION_ROOM_LIMIT = 4  # queued + running runs allowed per room
+EXECUTION_JOB_TTL = 300  # seconds a finished job's result stays available
+STREAM_FLUSH_INTERVAL = 0.05  # seconds streamed output may wait before it is sent
+STREAM_CHUNK_BYTES = 4096  # buffered output that is sent immediately
+STREAM_OUTPUT_LIMIT = 1024 * 1024  # output bytes a streamed run may produce before it is killed
+TERMINAL_MAX_SESSIONS = 16  # PTY shells open at once on this worker
+TERMINAL_IDLE_TIMEOUT = 600  # seconds without input or output before a shell is closed
+TERMINAL_FLUSH_INTERVAL = 0.05  # seconds between terminal output batches
+TERMINAL_BATCH_BYTES = 64 * 1024  # terminal output sent per session per batch
+ROOM_IDLE_GRACE = 300  # seconds a room stays empty before its lock, presence and terminal are reclaimed
+PYTHON_POOL_SIZE = int(os.environ.get('CODESYNC_PYTHON_POOL', '0'))  # warm interpreters kept ready; 0 runs every Python job cold
+PYTHON_POOL_PRELOAD = ('collections', 'itertools', 'functools', 'math', 're', 'random', 'string')  # imported before a job arrives
+JOURNAL_SEGMENT_BYTES = 4 * 1024 * 1024  # journal segment size before a snapshot is taken
+JOURNAL_MAX_BYTES = 64 * 1024 * 1024  # journal kept per room; older history is compacted away
+JOURNAL_OPEN_ROOMS = 64  # rooms whose journal segment and lock file are kept open
+AI_CLIENT_POOL_SIZE = 64  # provider clients kept for reuse
+AI_CACHE_SIZE = 256  # assistant answers kept
+AI_CACHE_TTL = 600  # seconds an assistant answer may be reused
+AI_REQUEST_TIMEOUT = 120  # seconds to wait for an identical request already in flight
+AI_PROVIDER_CONCURRENCY = 4  # upstream requests in flight per provider
+AI_PROVIDER_QUEUE = 16  # requests allowed to wait for a provider slot before new ones are refused
+AI_STREAM_FLUSH_INTERVAL = 0.1  # seconds streamed tokens are coalesced before being sent
+AI_STREAM_CHUNK_CHARS = 512  # streamed characters that force a send before the interval is up
+AI_FAKE_PROVIDER = os.environ.get('CODESYNC_AI_FAKE')  # set (to a delay in seconds) to enable the 'fake' provider
+COMPRESS_MIN_BYTES = 1024  # smaller responses are sent uncompressed
+COMPRESS_CACHE_BYTES = 32 * 1024 * 1024  # compressed file bodies kept for reuse
+SETTINGS_CACHE_SIZE = 1024  # rooms whose settings are kept in memory
+SETTINGS_CHECK_INTERVAL = 2  # seconds before a cached settings file is re-stated
+FILE_INDEX_CHECK_INTERVAL = 2  # seconds between checks of a room's directories for outside changes
+ANALYSIS_CACHE_SIZE = 128  # analyzed files kept for incremental re-analysis
+ANALYSIS_LONG_LINE = 100  # characters before a line is reported as long
+DIAGNOSTICS_DELAY = 0.5  # seconds a file must go unedited before it is linted
+DIAGNOSTICS_WORKERS = 2  # lints running at once
+DIAGNOSTICS_TIMEOUT = 10  # seconds an external linter may run
+BATCH_MAX_OPERATIONS = 1000  # file operations accepted in one batch request
+ARCHIVE_CHUNK_BYTES = 64 * 1024  # bytes read, compressed and sent at a time when exporting or importing a room
+IMPORT_MAX_BYTES = 100 * 1024 * 1024  # unpacked bytes an imported archive may contain
+IMPORT_MAX_FILES = 10000  # files an imported archive may contain
+LARGE_FILE_BYTES = 1024 * 1024  # bigger files open read-only and are loaded by range
+LARGE_FILE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # largest file a range edit may produce
+RANGE_MAX_BYTES = 1024 * 1024  # bytes returned by one range read
+RANGE_MAX_LINES = 10000  # lines returned by one range read
+LINE_INDEX_BLOCK_BYTES = 16 * 1024  # bytes of a file covered by one line index entry
+LINE_INDEX_CACHE_SIZE = 64  # files whose line index is kept in memory
+SEARCH_INDEX_ROOMS = 32  # rooms whose search index is kept in memory
+SEARCH_MAX_FILE_BYTES = 1024 * 1024  # larger files are listed but not searched
+SEARCH_PAGE_SIZE = 50  # default search results per page
+SEARCH_MAX_COUNT = 100  # matches counted per file when ranking
+SEARCH_MATCHES_PER_FILE = 5  # matching lines returned per file
+SEARCH_LINE_CHARS = 200  # characters of a matching line returned
+SEARCH_TEXT_CACHE_CHARS = 64 * 1024 * 1024  # characters of file text kept for checking search candidates
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # latency histogram bounds in seconds
+COMPILE_CACHE_DIR = os.path.join(".cache", "compile")
+COMPILE_CACHE_MAX_BYTES = 256 * 1024 * 1024  # 256MB of cached executables/.class files
 
 # In-memory storage
-room_users = {}  # room_id -> {sid: {username, cursor, selection}}
-room_locks = defaultdict(threading.Lock)  # room_id -> Lock
-active_terminals = {}  # room_id -> terminal_data
+room_users = {}  # room_id -> {sid: {username, cursor, selection}} for sids connected to this worker
+sid_rooms = {}  # sid -> set of room_ids it has joined on this worker
+empty_rooms = {}  # room_id -> when its last user on this worker left
+membership_lock = threading.Lock()  # guards room_users, sid_rooms and empty_rooms
+presence_dirty = defaultdict(set)  # room_id -> sids with unsent cursor/selection changes
+room_locks = {}  # room_id -> {lock, holders, used}
+room_locks_guard = threading.Lock()
+active_terminals = {}  # room_id -> {pid, fd, started, last_activity, decoder} PTY shell on this worker
+documents = {}  # (room_id, filename) -> {content, revision, epoch, dirty, ...}
+background_tasks = {}  # task name -> background task handle
+file_indexes = {}  # room_id -> {files, dirs, epoch, counter, sorted, checked}
+file_index_lock = threading.Lock()
+journal_locks = {}  # room_id -> {lock, holders} for journal writers; dropped when nobody holds it
+journal_locks_guard = threading.Lock()
+journal_writers = OrderedDict()  # room_id -> {fd, lock_fd} open journal files, least recently used first; guarded by journal_locks_guard
+search_indexes = OrderedDict()  # room_id -> search index, least recently used first
+search_lock = threading.Lock()
+search_texts = OrderedDict()  # (room_id, path) -> (stat, text) read from disk for search, least recently used first
+search_texts_size = [0]
+search_texts_lock = threading.Lock()
+line_indexes = OrderedDict()  # (room_id, filename) -> line index of a large file, least recently used first
+line_index_lock = threading.Lock()
+range_edit_lock = threading.Lock()  # range edits rewrite files one at a time
+settings_cache = OrderedDict()  # room_id -> {settings, version, signature, checked}, least recently used first
+settings_lock = threading.Lock()
+created_rooms = set()  # rooms already set up by this worker
+compressed_bodies = OrderedDict()  # (cache key, etag, encoding) -> compressed body, least recently used first
+compressed_bodies_size = [0]
+compressed_bodies_lock = threading.Lock()
+ai_clients = OrderedDict()  # (provider, api key hash) -> client, least recently used first
+ai_cache = OrderedDict()  # (provider, model, task, prompt, code hash) -> (expires, answer)
+ai_inflight = {}  # cache key -> {done, result, ok} for requests currently upstream
+ai_lock = threading.Lock()
+analysis_cache = OrderedDict()  # (file key or content hash, language) -> analysis entry, least recently used first
+analysis_lock = threading.Lock()
+diagnostics_pending = {}  # (room_id, filename) -> {due, delta} for files waiting to be linted
+diagnostics_running = set()  # (room_id, filename) being linted
+diagnostics_generation = {}  # (room_id, filename) -> bumped on every change; older lints are stale
+diagnostics_results = {}  # (room_id, filename) -> {revision, items} last pushed to the room
+diagnostics_lock = threading.Lock()
+diagnostics_executor = ThreadPoolExecutor(max_workers=DIAGNOSTICS_WORKERS, thread_name_prefix='diagnostics')
+ai_pools = {}  # provider -> {executor, pending}
+ai_streams = {}  # stream id -> {sid, cancel} for answers being streamed
+execution_jobs = {}  # job_id -> job
+execution_queue = queue.PriorityQueue()  # (priority, seq, job_id)
+worker_events = queue.Queue()  # (event, payload, room) emitted on behalf of worker threads
+execution_lock = threading.Lock()
+execution_workers = []
+compile_cache = OrderedDict()  # cache key -> artifact bytes, least recently used first
+compile_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0, 'loaded': False}
+compile_cache_lock = threading.Lock()
+toolchain_versions = {}  # (compiler path, mtime) -> version banner
+metric_histograms = {}  # (metric name, label values) -> [count per bucket..., +Inf count, sum]
+metric_counters = defaultdict(float)  # (metric name, label values) -> value
+metrics_lock = threading.Lock()
+python_pool = deque()  # idle pre-started Python interpreters
+python_pool_lock = threading.Lock()
 
 # Language configurations
 LANGUAGE_CONFIG = {
@@ -133,6 +296,602 @@ LANGUAGE_CONFIG = {
     }
 }
 
+# ============ Metrics ============
+#
+# Route and Socket.IO handler latencies, execution phases, AI provider calls
+# and room broadcast volume are recorded here and served on /metrics in the
+# Prometheus text format. Recording takes one bisect and an increment under a
+# lock. Gauges are worked out only when /metrics is scraped. Broadcast bytes
+# are estimated from the payload's structure instead of encoding it twice.
+
+METRICS = {
+    'codesync_http_request_seconds': ('histogram', ('endpoint', 'method', 'status'), "HTTP request latency"),
+    'codesync_socket_event_seconds': ('histogram', ('event',), "Socket.IO handler latency"),
+    'codesync_socket_event_errors_total': ('counter', ('event',), "Socket.IO handlers that raised"),
+    'codesync_execution_phase_seconds': ('histogram', ('language', 'phase'), "Time spent in each phase of a code run"),
+    'codesync_ai_request_seconds': ('histogram', ('provider', 'outcome'), "Upstream AI provider latency"),
+    'codesync_broadcast_messages_total': ('counter', ('room',), "Messages broadcast to a room"),
+    'codesync_broadcast_bytes_total': ('counter', ('room',), "Approximate payload bytes delivered to a room's sockets on this worker"),
+    'codesync_rooms_reclaimed_total': ('counter', (), "Empty rooms whose state was reclaimed"),
+}
+
+METRIC_GAUGES = {
+    'codesync_active_rooms': ("Rooms with users connected to this worker", lambda: len(room_users)),
+    'codesync_tracked_rooms': ("Rooms this worker holds a lock, presence or terminal for", lambda: tracked_room_count()),
+    'codesync_connected_users': ("Users connected to this worker", lambda: sum(len(users) for users in room_users.values())),
+    'codesync_terminals': ("Open terminal sessions", lambda: len(active_terminals)),
+    'codesync_live_documents': ("Documents held in memory", lambda: len(documents)),
+    'codesync_execution_queue': ("Runs waiting for a worker", lambda: execution_queue.qsize()),
+}
+
+def observe(name, labels, seconds):
+    """Record a duration in a histogram"""
+    bucket = bisect.bisect_left(METRICS_BUCKETS, seconds)
+    key = (name, labels)
+    with metrics_lock:
+        counts = metric_histograms.get(key)
+        if counts is None:
+            counts = metric_histograms[key] = [0] * (len(METRICS_BUCKETS) + 1) + [0.0]
+        counts[bucket] += 1
+        counts[-1] += seconds
+
+def count_metric(name, labels, value=1):
+    """Add to a counter"""
+    with metrics_lock:
+        metric_counters[(name, labels)] += value
+
+def _metric_labels(names, values, extra=None):
+    """Prometheus label set for a series"""
+    pairs = [f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    with metrics_lock:
+        histograms = {key: list(counts) for key, counts in metric_histograms.items()}
+        counters = dict(metric_counters)
+    
+    lines = []
+    for name, (kind, label_names, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == 'histogram':
+            for (series, labels), counts in sorted(histograms.items()):
+                if series != name:
+                    continue
+                total = 0
+                for bound, count in zip(METRICS_BUCKETS + (float('inf'),), counts):
+                    total += count
+                    le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                    lines.append(f"{name}_bucket{_metric_labels(label_names, labels, le)} {total}")
+                lines.append(f"{name}_sum{_metric_labels(label_names, labels)} {counts[-1]}")
+                lines.append(f"{name}_count{_metric_labels(label_names, labels)} {total}")
+        else:
+            for (series, labels), value in sorted(counters.items()):
+                if series == name:
+                    lines.append(f"{name}{_metric_labels(label_names, labels)} {value:.17g}")
+    for name, (help_text, read) in METRIC_GAUGES.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {read()}")
+    return '\n'.join(lines) + '\n'
+
+def _payload_bytes(value):
+    """Rough JSON size of a payload, without serializing it"""
+    if isinstance(value, str):
+        return len(value) + 2
+    if isinstance(value, dict):
+        return 2 + sum(len(key) + 4 + _payload_bytes(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return 2 + sum(_payload_bytes(item) + 1 for item in value)
+    return 4
+
+@app.before_request
+def start_request_timer():
+    """Note when a request started"""
+    request.environ['codesync.started'] = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Record a request's latency by route"""
+    started = request.environ.get('codesync.started')
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        observe('codesync_http_request_seconds', (endpoint, request.method, str(response.status_code)),
+                time.perf_counter() - started)
+    return response
+
+class MeteredSocketIO(SocketIO):
+    """SocketIO that times its event handlers and counts what it broadcasts to rooms"""
+    
+    def on(self, message, namespace=None):
+        register = super().on(message, namespace)
+        
+        def decorator(handler):
+            @functools.wraps(handler)
+            def timed(*args):
+                started = time.perf_counter()
+                try:
+                    return handler(*args)
+                except Exception:
+                    count_metric('codesync_socket_event_errors_total', (message,))
+                    raise
+                finally:
+                    observe('codesync_socket_event_seconds', (message,), time.perf_counter() - started)
+            register(timed)
+            return handler
+        return decorator
+    
+    def emit(self, event, *args, **kwargs):
+        room = kwargs.get('to') or kwargs.get('room')
+        users = room_users.get(room) if room is not None else None
+        if users:
+            recipients = len(users) - (1 if kwargs.get('skip_sid') or kwargs.get('include_self') is False else 0)
+            count_metric('codesync_broadcast_messages_total', (room,))
+            count_metric('codesync_broadcast_bytes_total', (room,),
+                         max(recipients, 0) * ((_payload_bytes(args[0]) if args else 0) + len(event)))
+        return super().emit(event, *args, **kwargs)
+
+# Metrics
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics for this worker"""
+    return app.response_class(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# ============ Room State Backends ============
+#
+# Room state that every worker serving a room must agree on lives behind a
+# state backend: who is in the room (and where their cursor is), document
+# revisions with their recent ops and snapshots, and which worker owns a
+# room's terminal. Backends share one interface:
+#
+#   room_lock(room_id)                         context manager serializing room edits
+#   add_member / remove_member / room_members  room membership
+#   set_presence / room_presence               latest cursor/selection per sid
+#   document_state / create_document / document_ops / append_document_op
+#   document_snapshot / save_document_snapshot / drop_document
+#   rename_document / expire_document          document revisions
+#   claim_terminal / release_terminal / terminal_owner
+#
+# 'memory' keeps it in this process (single worker). 'sqlite:///path' shares
+# it between workers on one machine with no outside services, and
+# 'redis://...' shares it between machines.
+
+WORKER_ID = f"{platform.node()}:{os.getpid()}"
+
+class MemoryStateBackend:
+    """Room state kept in this process"""
+
+    def __init__(self):
+        self.members = {}  # room_id -> {sid: info}
+        self.presence = {}  # room_id -> {sid: state}
+        self.documents = {}  # (room_id, filename) -> record
+        self.terminals = {}  # room_id -> owner
+
+    def room_lock(self, room_id):
+        return local_room_lock(room_id)
+
+    def add_member(self, room_id, sid, info):
+        self.members.setdefault(room_id, {})[sid] = info
+
+    def remove_member(self, room_id, sid):
+        self.presence.get(room_id, {}).pop(sid, None)
+        users = self.members.get(room_id)
+        if not users:
+            return None
+        info = users.pop(sid, None)
+        if not users:
+            del self.members[room_id]
+            self.presence.pop(room_id, None)
+        return info
+
+    def room_members(self, room_id):
+        return dict(self.members.get(room_id, {}))
+
+    def set_presence(self, room_id, sid, state):
+        if sid in self.members.get(room_id, {}):
+            self.presence.setdefault(room_id, {})[sid] = state
+
+    def room_presence(self, room_id):
+        return list(self.presence.get(room_id, {}).values())
+
+    def document_state(self, room_id, filename):
+        record = self.documents.get((room_id, filename))
+        if record is None:
+            return None
+        return record['epoch'], record['revision']
+
+    def create_document(self, room_id, filename, epoch, content):
+        self.documents[(room_id, filename)] = {
+            'epoch': epoch,
+            'revision': 0,
+            'ops': deque(maxlen=DOCUMENT_HISTORY_LIMIT),
+            'snapshot': (0, content),
+            'updated': time.time()
+        }
+
+    def document_ops(self, room_id, filename, since):
+        record = self.documents.get((room_id, filename))
+        if record is None:
+            return None
+        ops = record['ops']
+        missed = record['revision'] - since
+        if missed < 0 or missed > len(ops):
+            return None
+        return list(itertools.islice(ops, len(ops) - missed, None))
+
+    def append_document_op(self, room_id, filename, revision, op):
+        record = self.documents[(room_id, filename)]
+        record['ops'].append(op)
+        record['revision'] = revision
+        record['updated'] = time.time()
+
+    def document_snapshot(self, room_id, filename):
+        record = self.documents.get((room_id, filename))
+        return record['snapshot'] if record else None
+
+    def save_document_snapshot(self, room_id, filename, revision, content):
+        record = self.documents.get((room_id, filename))
+        if record is not None:
+            record['snapshot'] = (revision, content)
+
+    def drop_document(self, room_id, filename):
+        self.documents.pop((room_id, filename), None)
+
+    def rename_document(self, room_id, old_name, new_name):
+        record = self.documents.pop((room_id, old_name), None)
+        if record is not None:
+            self.documents[(room_id, new_name)] = record
+
+    def expire_document(self, room_id, filename, max_idle):
+        record = self.documents.get((room_id, filename))
+        if record is not None and time.time() - record['updated'] > max_idle:
+            del self.documents[(room_id, filename)]
+
+    def claim_terminal(self, room_id, owner):
+        return self.terminals.setdefault(room_id, owner) == owner
+
+    def release_terminal(self, room_id, owner):
+        if self.terminals.get(room_id) == owner:
+            del self.terminals[room_id]
+
+    def terminal_owner(self, room_id):
+        return self.terminals.get(room_id)
+
+class SQLiteStateBackend:
+    """Room state in a SQLite file shared by the workers on one machine"""
+
+    LOCK_STRIPES = 64
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS members (
+            room TEXT, sid TEXT, info TEXT, presence TEXT,
+            PRIMARY KEY (room, sid));
+        CREATE TABLE IF NOT EXISTS documents (
+            room TEXT, file TEXT, epoch TEXT, revision INTEGER,
+            snapshot_rev INTEGER, snapshot TEXT, updated REAL,
+            PRIMARY KEY (room, file));
+        CREATE TABLE IF NOT EXISTS document_ops (
+            room TEXT, file TEXT, revision INTEGER, op TEXT,
+            PRIMARY KEY (room, file, revision));
+        CREATE TABLE IF NOT EXISTS terminals (
+            room TEXT PRIMARY KEY, owner TEXT);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock_dir = path + '.locks'
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.stripe_locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        self.stripe_files = {}
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def room_lock(self, room_id):
+        # A thread lock orders this process; flock on the stripe's lock
+        # file orders the other workers
+        stripe = zlib.crc32(room_id.encode('utf-8')) % self.LOCK_STRIPES
+        with self.stripe_locks[stripe]:
+            f = self.stripe_files.get(stripe)
+            if f is None:
+                f = open(os.path.join(self.lock_dir, f'{stripe}.lock'), 'a')
+                self.stripe_files[stripe] = f
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def add_member(self, room_id, sid, info):
+        with self._conn() as conn:
+            conn.execute('INSERT OR REPLACE INTO members (room, sid, info) VALUES (?, ?, ?)',
+                         (room_id, sid, json.dumps(info)))
+
+    def remove_member(self, room_id, sid):
+        with self._conn() as conn:
+            row = conn.execute('SELECT info FROM members WHERE room = ? AND sid = ?',
+                               (room_id, sid)).fetchone()
+            conn.execute('DELETE FROM members WHERE room = ? AND sid = ?', (room_id, sid))
+        return json.loads(row[0]) if row else None
+
+    def room_members(self, room_id):
+        rows = self._conn().execute('SELECT sid, info FROM members WHERE room = ?', (room_id,))
+        return {sid: json.loads(info) for sid, info in rows}
+
+    def set_presence(self, room_id, sid, state):
+        with self._conn() as conn:
+            conn.execute('UPDATE members SET presence = ? WHERE room = ? AND sid = ?',
+                         (json.dumps(state), room_id, sid))
+
+    def room_presence(self, room_id):
+        rows = self._conn().execute(
+            'SELECT presence FROM members WHERE room = ? AND presence IS NOT NULL', (room_id,))
+        return [json.loads(presence) for presence, in rows]
+
+    def document_state(self, room_id, filename):
+        row = self._conn().execute('SELECT epoch, revision FROM documents WHERE room = ? AND file = ?',
+                                   (room_id, filename)).fetchone()
+        return tuple(row) if row else None
+
+    def create_document(self, room_id, filename, epoch, content):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM document_ops WHERE room = ? AND file = ?', (room_id, filename))
+            conn.execute('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, 0, 0, ?, ?)',
+                         (room_id, filename, epoch, content, time.time()))
+
+    def document_ops(self, room_id, filename, since):
+        state = self.document_state(room_id, filename)
+        if state is None or state[1] < since:
+            return None
+        rows = self._conn().execute(
+            'SELECT op FROM document_ops WHERE room = ? AND file = ? AND revision > ? ORDER BY revision',
+            (room_id, filename, since)).fetchall()
+        if len(rows) != state[1] - since:
+            return None
+        return [json.loads(op) for op, in rows]
+
+    def append_document_op(self, room_id, filename, revision, op):
+        with self._conn() as conn:
+            conn.execute('INSERT OR REPLACE INTO document_ops VALUES (?, ?, ?, ?)',
+                         (room_id, filename, revision, json.dumps(op)))
+            conn.execute('UPDATE documents SET revision = ?, updated = ? WHERE room = ? AND file = ?',
+                         (revision, time.time(), room_id, filename))
+            conn.execute('DELETE FROM document_ops WHERE room = ? AND file = ? AND revision <= ?',
+                         (room_id, filename, revision - DOCUMENT_HISTORY_LIMIT))
+
+    def document_snapshot(self, room_id, filename):
+        row = self._conn().execute('SELECT snapshot_rev, snapshot FROM documents WHERE room = ? AND file = ?',
+                                   (room_id, filename)).fetchone()
+        return tuple(row) if row else None
+
+    def save_document_snapshot(self, room_id, filename, revision, content):
+        with self._conn() as conn:
+            conn.execute('UPDATE documents SET snapshot_rev = ?, snapshot = ? WHERE room = ? AND file = ?',
+                         (revision, content, room_id, filename))
+
+    def drop_document(self, room_id, filename):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM documents WHERE room = ? AND file = ?', (room_id, filename))
+            conn.execute('DELETE FROM document_ops WHERE room = ? AND file = ?', (room_id, filename))
+
+    def rename_document(self, room_id, old_name, new_name):
+        with self._conn() as conn:
+            conn.execute('UPDATE documents SET file = ? WHERE room = ? AND file = ?', (new_name, room_id, old_name))
+            conn.execute('UPDATE document_ops SET file = ? WHERE room = ? AND file = ?', (new_name, room_id, old_name))
+
+    def expire_document(self, room_id, filename, max_idle):
+        with self._conn() as conn:
+            cur = conn.execute('DELETE FROM documents WHERE room = ? AND file = ? AND updated < ?',
+                               (room_id, filename, time.time() - max_idle))
+            if cur.rowcount:
+                conn.execute('DELETE FROM document_ops WHERE room = ? AND file = ?', (room_id, filename))
+
+    def claim_terminal(self, room_id, owner):
+        with self._conn() as conn:
+            conn.execute('INSERT OR IGNORE INTO terminals VALUES (?, ?)', (room_id, owner))
+        return self.terminal_owner(room_id) == owner
+
+    def release_terminal(self, room_id, owner):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM terminals WHERE room = ? AND owner = ?', (room_id, owner))
+
+    def terminal_owner(self, room_id):
+        row = self._conn().execute('SELECT owner FROM terminals WHERE room = ?', (room_id,)).fetchone()
+        return row[0] if row else None
+
+class RedisStateBackend:
+    """Room state in Redis, shared by workers on any number of machines"""
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+
+    @contextmanager
+    def room_lock(self, room_id):
+        with local_room_lock(room_id):
+            with self.redis.lock(f'codesync:lock:{room_id}', timeout=30, blocking_timeout=30):
+                yield
+
+    def add_member(self, room_id, sid, info):
+        self.redis.hset(f'codesync:members:{room_id}', sid, json.dumps(info))
+
+    def remove_member(self, room_id, sid):
+        pipe = self.redis.pipeline()
+        pipe.hget(f'codesync:members:{room_id}', sid)
+        pipe.hdel(f'codesync:members:{room_id}', sid)
+        pipe.hdel(f'codesync:presence:{room_id}', sid)
+        info = pipe.execute()[0]
+        return json.loads(info) if info else None
+
+    def room_members(self, room_id):
+        users = self.redis.hgetall(f'codesync:members:{room_id}')
+        return {sid.decode(): json.loads(info) for sid, info in users.items()}
+
+    def set_presence(self, room_id, sid, state):
+        if self.redis.hexists(f'codesync:members:{room_id}', sid):
+            self.redis.hset(f'codesync:presence:{room_id}', sid, json.dumps(state))
+
+    def room_presence(self, room_id):
+        return [json.loads(state) for state in self.redis.hvals(f'codesync:presence:{room_id}')]
+
+    def _doc_key(self, room_id, filename):
+        return f'codesync:doc:{room_id}:{filename}', f'codesync:ops:{room_id}:{filename}'
+
+    def document_state(self, room_id, filename):
+        doc_key, _ = self._doc_key(room_id, filename)
+        epoch, revision = self.redis.hmget(doc_key, 'epoch', 'revision')
+        if epoch is None:
+            return None
+        return epoch.decode(), int(revision)
+
+    def create_document(self, room_id, filename, epoch, content):
+        doc_key, ops_key = self._doc_key(room_id, filename)
+        pipe = self.redis.pipeline()
+        pipe.delete(doc_key, ops_key)
+        pipe.hset(doc_key, mapping={'epoch': epoch, 'revision': 0, 'snapshot_rev': 0,
+                                    'snapshot': content, 'updated': time.time()})
+        pipe.execute()
+
+    def document_ops(self, room_id, filename, since):
+        state = self.document_state(room_id, filename)
+        if state is None or state[1] < since:
+            return None
+        missed = state[1] - since
+        if not missed:
+            return []
+        _, ops_key = self._doc_key(room_id, filename)
+        ops = self.redis.lrange(ops_key, -missed, -1)
+        if len(ops) != missed:
+            return None
+        return [json.loads(op) for op in ops]
+
+    def append_document_op(self, room_id, filename, revision, op):
+        doc_key, ops_key = self._doc_key(room_id, filename)
+        pipe = self.redis.pipeline()
+        pipe.rpush(ops_key, json.dumps(op))
+        pipe.ltrim(ops_key, -DOCUMENT_HISTORY_LIMIT, -1)
+        pipe.hset(doc_key, mapping={'revision': revision, 'updated': time.time()})
+        pipe.execute()
+
+    def document_snapshot(self, room_id, filename):
+        doc_key, _ = self._doc_key(room_id, filename)
+        revision, content = self.redis.hmget(doc_key, 'snapshot_rev', 'snapshot')
+        if revision is None:
+            return None
+        return int(revision), content.decode('utf-8')
+
+    def save_document_snapshot(self, room_id, filename, revision, content):
+        doc_key, _ = self._doc_key(room_id, filename)
+        if self.redis.exists(doc_key):
+            self.redis.hset(doc_key, mapping={'snapshot_rev': revision, 'snapshot': content})
+
+    def drop_document(self, room_id, filename):
+        self.redis.delete(*self._doc_key(room_id, filename))
+
+    def rename_document(self, room_id, old_name, new_name):
+        for old_key, new_key in zip(self._doc_key(room_id, old_name), self._doc_key(room_id, new_name)):
+            if self.redis.exists(old_key):
+                self.redis.rename(old_key, new_key)
+
+    def expire_document(self, room_id, filename, max_idle):
+        doc_key, _ = self._doc_key(room_id, filename)
+        updated = self.redis.hget(doc_key, 'updated')
+        if updated is not None and time.time() - float(updated) > max_idle:
+            self.drop_document(room_id, filename)
+
+    def claim_terminal(self, room_id, owner):
+        self.redis.set(f'codesync:terminal:{room_id}', owner, nx=True)
+        return self.terminal_owner(room_id) == owner
+
+    def release_terminal(self, room_id, owner):
+        if self.terminal_owner(room_id) == owner:
+            self.redis.delete(f'codesync:terminal:{room_id}')
+
+    def terminal_owner(self, room_id):
+        owner = self.redis.get(f'codesync:terminal:{room_id}')
+        return owner.decode() if owner else None
+
+class SQLitePubSubManager(PubSubManager):
+    """Socket.IO message queue over a SQLite table, for workers on one machine"""
+
+    name = 'sqlite'
+
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None, json=None):
+        self.path = url.split('://', 1)[1]
+        self.local = threading.local()
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        with self._conn() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS socketio_messages ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT, payload TEXT, created REAL)')
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    def _publish(self, data):
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute('INSERT INTO socketio_messages (channel, payload, created) VALUES (?, ?, ?)',
+                         (self.channel, self.json.dumps(data), now))
+            conn.execute('DELETE FROM socketio_messages WHERE created < ?', (now - MESSAGE_QUEUE_RETENTION,))
+
+    def _listen(self):
+        conn = self._conn()
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM socketio_messages').fetchone()[0]
+        while True:
+            rows = conn.execute('SELECT id, payload FROM socketio_messages WHERE id > ? AND channel = ? ORDER BY id',
+                                (last_id, self.channel)).fetchall()
+            for last_id, payload in rows:
+                yield payload
+            if not rows:
+                self.server.sleep(MESSAGE_QUEUE_POLL_INTERVAL)
+
+def create_state_backend(url):
+    """Build the room state backend named by a URL"""
+    if url == 'memory':
+        return MemoryStateBackend()
+    if url.startswith('sqlite://'):
+        return SQLiteStateBackend(url.split('://', 1)[1])
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisStateBackend(url)
+    raise ValueError(f"Unknown state backend '{url}'")
+
+def message_queue_options(url):
+    """SocketIO options that fan emits out through a message queue"""
+    if not url:
+        return {}
+    if url.startswith('sqlite://'):
+        return {'client_manager': SQLitePubSubManager(url)}
+    return {'message_queue': url}
+
+state_backend = create_state_backend(STATE_BACKEND)
+socketio = MeteredSocketIO(app, cors_allowed_origins="*", ping_timeout=60, ping_interval=25,
+                           **message_queue_options(MESSAGE_QUEUE))
+
+# ============ Background Tasks ============
+
+def ensure_background_task(name, target, *args):
+    """Start a named background task once per process"""
+    if name not in background_tasks:
+        background_tasks[name] = socketio.start_background_task(target, *args)
+
 # ============ File Management Functions ============
 
 def ensure_dir(path):
@@ -150,6 +909,9 @@ def get_settings_path(room_id):
 
 def create_room(room_id):
     """Create a new room with default structure"""
+    if room_id in created_rooms:
+        return True
+    
     path = get_room_path(room_id)
     ensure_dir(path)
     
@@ -161,47 +923,13 @@ def create_room(room_id):
     # Create default settings
     settings_path = get_settings_path(room_id)
     if not os.path.exists(settings_path):
-        default_settings = {
-            'theme': 'monokai',
-            'font_size': 14,
-            'tab_size': 4,
-            'auto_save': True,
-            'created_at': datetime.now().isoformat()
-        }
+        default_settings = dict(DEFAULT_SETTINGS, created_at=datetime.now().isoformat())
         save_room_settings(room_id, default_settings)
     
+    created_rooms.add(room_id)
+    ensure_background_task('room_reaper', room_reaper)
     return True
 
-def list_files(room_id):
-    """List all files in room with metadata"""
-    path = get_room_path(room_id)
-    if not os.path.exists(path):
-        return []
-    
-    files = []
-    for root, dirs, filenames in os.walk(path):
-        for filename in filenames:
-            full_path = os.path.join(root, filename)
-            rel_path = os.path.relpath(full_path, path)
-            
-            # Get file stats
-            stat = os.stat(full_path)
-            
-            # Determine language/type
-            ext = os.path.splitext(filename)[1]
-            lang = detect_language(filename)
-            
-            files.append({
-                "name": filename,
-                "path": rel_path,
-                "type": lang,
-                "size": stat.st_size,
-                "modified": datetime.fromtimestamp(stat.st_mtime).isoformat(),
-                "extension": ext
-            })
-    
-    return sorted(files, key=lambda x: x['name'])
-
 def detect_language(filename):
     """Detect programming language from filename"""
     ext = os.path.splitext(filename)[1].lower()
@@ -228,7 +956,15 @@ def detect_language(filename):
     return ext_map.get(ext, 'text')
 
 def get_file_content(room_id, filename):
-    """Get content of a file"""
+    """Get content of a file, preferring its live document"""
+    doc = documents.get((room_id, filename))
+    if doc is not None:
+        doc['last_access'] = time.time()
+        return doc['content']
+    return read_file_from_disk(room_id, filename)
+
+def read_file_from_disk(room_id, filename):
+    """Read a file's content straight from disk"""
     path = os.path.join(get_room_path(room_id), filename)
     
     # Security check
@@ -244,7 +980,32 @@ def get_file_content(room_id, filename):
     return ""
 
 def save_file_content(room_id, filename, content):
-    """Save content to a file"""
+    """Save content to a file (into its live document when one is open)"""
+    if (room_id, filename) in documents:
+        return set_document_content(room_id, filename, content) is not None
+    if file_content_equals(room_id, filename, content):
+        return True
+    if not write_file_to_disk(room_id, filename, content):
+        return False
+    journal_append(room_id, {'t': 'base', 'f': filename, 'e': uuid.uuid4().hex[:8], 'r': 0, 'c': content})
+    return True
+
+def file_content_equals(room_id, filename, content):
+    """Whether a file on disk already holds exactly this content"""
+    path = os.path.join(get_room_path(room_id), filename)
+    if not is_safe_path(room_id, path):
+        return False
+    data = content.encode('utf-8')
+    try:
+        if os.path.getsize(path) != len(data):
+            return False
+        with open(path, 'rb') as f:
+            return f.read() == data
+    except OSError:
+        return False
+
+def write_file_to_disk(room_id, filename, content):
+    """Write content to a file on disk"""
     path = os.path.join(get_room_path(room_id), filename)
     
     # Security check
@@ -259,12 +1020,28 @@ def save_file_content(room_id, filename, content):
     ensure_dir(os.path.dirname(path))
     
     try:
-        with open(path, "w", encoding='utf-8') as f:
-            f.write(content)
+        atomic_write(path, content)
+        index_path_changed(room_id, path)
         return True
     except Exception:
         return False
 
+def atomic_write(path, content):
+    """Write a file via a temp file and rename so readers never see it half-written"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        else:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 def create_new_file(room_id, filename, content=""):
     """Create a new file"""
     path = os.path.join(get_room_path(room_id), filename)
@@ -283,6 +1060,8 @@ def create_new_file(room_id, filename, content=""):
     try:
         with open(path, "w", encoding='utf-8') as f:
             f.write(content)
+        index_path_changed(room_id, path)
+        journal_append(room_id, {'t': 'base', 'f': filename, 'e': uuid.uuid4().hex[:8], 'r': 0, 'c': content})
         return True
     except Exception:
         return False
@@ -297,6 +1076,8 @@ def delete_file(room_id, filename):
     if os.path.exists(path) and os.path.isfile(path):
         try:
             os.remove(path)
+            drop_document(room_id, filename)
+            index_path_changed(room_id, path)
             return True
         except Exception:
             return False
@@ -312,267 +1093,3391 @@ def rename_file(room_id, old_name, new_name):
     
     if os.path.exists(old_path) and not os.path.exists(new_path):
         try:
+            flush_document(room_id, old_name)
             ensure_dir(os.path.dirname(new_path))
             os.rename(old_path, new_path)
+            move_document(room_id, old_name, new_name)
+            index_path_changed(room_id, old_path)
+            index_path_changed(room_id, new_path)
             return True
         except Exception:
             return False
     return False
 
+def create_directory(room_id, dirname):
+    """Create a directory in a room"""
+    path = os.path.join(get_room_path(room_id), dirname)
+    
+    if not is_safe_path(room_id, path):
+        return False
+    
+    try:
+        os.makedirs(path, exist_ok=False)
+        index_path_changed(room_id, path)
+        return True
+    except OSError:
+        return False
+
 def is_safe_path(room_id, path):
     """Check if path is within room directory (security)"""
     room_path = os.path.abspath(get_room_path(room_id))
     target_path = os.path.abspath(path)
     return target_path.startswith(room_path)
 
-# ============ Code Execution Functions ============
+# ============ File Index ============
+#
+# Each room's file listing is built once and then kept current by our own file
+# operations. Changes made behind our back (terminal, runs, other workers) are
+# caught by re-stating directories: creating, deleting or renaming an entry
+# bumps its directory's mtime, so only changed directories are rescanned.
 
-def execute_code(language, code, input_data="", room_id=None, filename=None):
-    """Execute code in specified language"""
-    if language not in LANGUAGE_CONFIG:
-        return {"output": f"Language '{language}' not supported", "error": True}
-    
-    config = LANGUAGE_CONFIG[language]
+def _file_entry(rel_path, stat):
+    """Listing entry for a file"""
+    filename = os.path.basename(rel_path)
+    return {
+        "name": filename,
+        "path": rel_path,
+        "type": detect_language(filename),
+        "size": stat.st_size,
+        "modified": datetime.fromtimestamp(stat.st_mtime).isoformat(),
+        "extension": os.path.splitext(filename)[1]
+    }
+
+def _index_scan_dir(index, room_path, rel_dir, recursive):
+    """(Re)read one directory into the index; returns True if anything changed"""
+    full_dir = os.path.join(room_path, rel_dir)
+    try:
+        dir_mtime = os.stat(full_dir).st_mtime_ns
+        names = os.listdir(full_dir)
+    except OSError:
+        return _index_drop_dir(index, rel_dir)
+    known = rel_dir in index['dirs']
+    index['dirs'][rel_dir] = dir_mtime
     
-    # HTML/CSS can't be executed
-    if language in ['html', 'css']:
-        return {"output": "HTML/CSS files are rendered in preview, not executed.", "error": False}
+    changed = False
+    seen_files = set()
+    seen_dirs = set()
+    for name in names:
+        rel_path = os.path.join(rel_dir, name)
+        full_path = os.path.join(room_path, rel_path)
+        if os.path.isdir(full_path):
+            seen_dirs.add(rel_path)
+            if rel_path not in index['dirs'] or recursive:
+                changed = _index_scan_dir(index, room_path, rel_path, True) or changed
+        elif not name.startswith('.tmp-'):
+            seen_files.add(rel_path)
+            changed = _index_stat_file(index, room_path, rel_path) or changed
     
-    temp_dir_manager = None
+    if not known:
+        # Nothing under a directory seen for the first time can be stale
+        return changed
+    for rel_path in [p for p in index['files'] if os.path.dirname(p) == rel_dir and p not in seen_files]:
+        del index['files'][rel_path]
+        changed = True
+    for rel_path in [d for d in index['dirs'] if d and os.path.dirname(d) == rel_dir and d not in seen_dirs]:
+        changed = _index_drop_dir(index, rel_path) or changed
+    return changed
+
+def _index_drop_dir(index, rel_dir):
+    """Forget a directory and everything under it"""
+    prefix = os.path.join(rel_dir, '')
+    files = [p for p in index['files'] if p.startswith(prefix)]
+    for rel_path in files:
+        del index['files'][rel_path]
+    for d in [d for d in index['dirs'] if d == rel_dir or d.startswith(prefix)]:
+        del index['dirs'][d]
+    return bool(files)
+
+def _index_stat_file(index, room_path, rel_path):
+    """Refresh one file's entry from disk; returns True if it changed"""
     try:
-        # Determine Execution Context
-        if room_id and filename:
-            # Run in Room Directory (Integrated)
-            cwd = get_room_path(room_id)
-            if not os.path.exists(cwd):
-                return {"output": "Room directory not found", "error": True}
-                
-            source_file = os.path.join(cwd, filename)
-            
-            # Ensure latest code is saved
-            saved = save_file_content(room_id, filename, code)
-            if not saved:
-                return {"output": "Failed to save file before execution.", "error": True}
-                
-            # For Java, derive classname from filename
-            classname = os.path.splitext(os.path.basename(filename))[0]
-            
+        stat = os.stat(os.path.join(room_path, rel_path))
+    except OSError:
+        return index['files'].pop(rel_path, None) is not None
+    
+    known = index['files'].get(rel_path)
+    if known is not None and known[1] == (stat.st_mtime_ns, stat.st_size):
+        return False
+    index['files'][rel_path] = (_file_entry(rel_path, stat), (stat.st_mtime_ns, stat.st_size))
+    return True
+
+def _index_changed(index):
+    """Record a change to an index"""
+    index['counter'] += 1
+    index['sorted'] = None
+
+def get_file_index(room_id):
+    """A room's file index, built on first use and revalidated against disk"""
+    room_path = get_room_path(room_id)
+    index = file_indexes.get(room_id)
+    if index is None:
+        index = {
+            'files': {},  # rel path -> (entry, (mtime_ns, size))
+            'dirs': {},  # rel dir -> mtime_ns
+            'epoch': uuid.uuid4().hex[:8],
+            'counter': 0,
+            'sorted': None,
+            'checked': time.time()
+        }
+        if os.path.isdir(room_path):
+            _index_scan_dir(index, room_path, '', True)
+        file_indexes[room_id] = index
+        ensure_background_task('room_reaper', room_reaper)
+        return index
+    
+    if time.time() - index['checked'] >= FILE_INDEX_CHECK_INTERVAL:
+        index['checked'] = time.time()
+        changed = False
+        for rel_dir, mtime in list(index['dirs'].items()):
+            if rel_dir not in index['dirs']:
+                continue
+            try:
+                current = os.stat(os.path.join(room_path, rel_dir)).st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime:
+                changed = _index_scan_dir(index, room_path, rel_dir, False) or changed
+        if not index['dirs'] and os.path.isdir(room_path):
+            changed = _index_scan_dir(index, room_path, '', True) or changed
+        if changed:
+            _index_changed(index)
+    return index
+
+def file_index_version(index):
+    """Opaque version string; changes whenever the listing does"""
+    return f"{index['epoch']}.{index['counter']}"
+
+def list_files(room_id, prefix='', offset=0, limit=None):
+    """List files in room with metadata; returns (page, total, index version)"""
+    with file_index_lock:
+        index = get_file_index(room_id)
+        if index['sorted'] is None:
+            index['sorted'] = sorted(index['files'], key=lambda p: (os.path.basename(p), p))
+        paths = index['sorted']
+        if prefix:
+            paths = [p for p in paths if p.startswith(prefix)]
+        total = len(paths)
+        page = paths[offset:offset + limit if limit is not None else None]
+        
+        # Entries about to be returned are re-stated, catching in-place edits
+        room_path = get_room_path(room_id)
+        changed = False
+        for rel_path in page:
+            changed = _index_stat_file(index, room_path, rel_path) or changed
+        if changed:
+            _index_changed(index)
+        
+        files = [index['files'][p][0] for p in page if p in index['files']]
+        return files, total, file_index_version(index)
+
+def index_path_changed(room_id, path):
+    """Update a room's index right after we create, write or remove something at path"""
+    with file_index_lock:
+        index = file_indexes.get(room_id)
+        if index is None:
+            return
+        room_path = get_room_path(room_id)
+        rel_path = os.path.relpath(os.path.abspath(path), os.path.abspath(room_path))
+        
+        if os.path.isdir(path):
+            changed = _index_scan_dir(index, room_path, rel_path, True)
+        elif os.path.isfile(path):
+            changed = _index_stat_file(index, room_path, rel_path)
         else:
-            # Run in Temporary Directory (Isolated)
-            temp_dir_manager = tempfile.TemporaryDirectory()
-            cwd = temp_dir_manager.name
-            
-            # Setup file
-            ext = config['extension']
-            if language == 'java':
-                class_match = re.search(r'public\s+class\s+(\w+)', code)
-                classname = class_match.group(1) if class_match else "Main"
-                source_file = os.path.join(cwd, f"{classname}.java")
-            else:
-                classname = "program"
-                source_file = os.path.join(cwd, f"code{ext}")
-                
-            with open(source_file, 'w', encoding='utf-8') as f:
-                f.write(code)
+            changed = index['files'].pop(rel_path, None) is not None or _index_drop_dir(index, rel_path)
+            index['dirs'].pop(rel_path, None)
+        
+        # Directories created along the way are scanned in; the parent's own mtime change is
+        # left for the next check so concurrent outside changes there aren't masked
+        missing = None
+        parent = os.path.dirname(rel_path)
+        while parent not in index['dirs']:
+            missing = parent
+            if not parent:
+                break
+            parent = os.path.dirname(parent)
+        if missing is not None:
+            changed = _index_scan_dir(index, room_path, missing, True) or changed
+        
+        if changed:
+            _index_changed(index)
 
-        # Prepare Executable Path (for compiled langs)
-        executable = os.path.join(cwd, 'program.exe' if sys.platform == 'win32' else 'program')
+# ============ Search Index ============
+#
+# Each room's text is indexed by trigram: a query is only checked against
+# files that contain every trigram of the literal text it needs, so most files
+# are never looked at. The index holds trigrams and symbols only; candidates
+# are checked against their live document, or against file text kept in a
+# bounded cache (keyed by the file's mtime and size) so repeated searches
+# don't re-read the disk.
+# Definitions (functions, classes, ...) go into a symbol
+# table kept as a sorted name list for prefix lookups. The index follows the
+# file index for saves, creates, deletes and renames, and re-reads files
+# whose live documents were edited the next time it is queried.
 
-        # Execution Logic
-        if 'compile' in config:
-            # Special handling for Java
-            if language == 'java':
-                 # Compile
-                 compile_cmd = [cmd.replace('{file}', source_file) for cmd in config['compile']]
-                 compile_result = subprocess.run(compile_cmd, cwd=cwd, capture_output=True, text=True, timeout=CODE_EXECUTION_TIMEOUT)
-                 if compile_result.returncode != 0:
-                     return {"output": f"Compilation Error:\n{compile_result.stderr}", "error": True}
-                 # Run
-                 run_cmd = [cmd.replace('{classname}', classname) for cmd in config['run']]
+SYMBOL_PATTERNS = {
+    'python': r'^\s*(?:async\s+)?(?P<kind>def|class)\s+(?P<name>\w+)',
+    'javascript': r'^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?(?P<kind>function\*?|class)\s+(?P<name>[\w$]+)'
+                  r'|^\s*(?:export\s+)?(?P<kind2>const|let|var)\s+(?P<name2>[\w$]+)\s*=\s*(?:async\s+)?(?:function|\([^)]*\)\s*=>|\w+\s*=>)',
+    'typescript': r'^\s*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?(?:async\s+)?(?P<kind>function|class|interface|type|enum)\s+(?P<name>[\w$]+)'
+                  r'|^\s*(?:export\s+)?(?P<kind2>const|let)\s+(?P<name2>[\w$]+)\s*=\s*(?:async\s+)?\([^)]*\)\s*=>',
+    'java': r'^\s*(?:(?:public|private|protected|static|final|abstract)\s+)*(?P<kind>class|interface|enum|record)\s+(?P<name>\w+)'
+            r'|^\s*(?:(?:public|private|protected|static|final|abstract|synchronized)\s+)+[\w<>\[\], ]+\s+(?P<name2>\w+)\s*\(',
+    'c': r'^(?P<kind>struct|enum|union)\s+(?P<name>\w+)\s*\{|^[A-Za-z_][\w \*]*?\b(?P<name2>\w+)\s*\([^;]*$',
+    'cpp': r'^\s*(?P<kind>class|struct|enum|union|namespace)\s+(?P<name>\w+)'
+           r'|^[A-Za-z_][\w:<> \*&]*?\b(?P<name2>[\w:~]+)\s*\([^;]*$',
+    'go': r'^(?P<kind>func)\s+(?:\([^)]*\)\s*)?(?P<name>\w+)|^(?P<kind2>type)\s+(?P<name2>\w+)',
+    'rust': r'^\s*(?:pub(?:\([^)]*\))?\s+)?(?:async\s+)?(?:unsafe\s+)?(?P<kind>fn|struct|enum|trait|mod|type)\s+(?P<name>\w+)',
+    'ruby': r'^\s*(?P<kind>def|class|module)\s+(?:self\.)?(?P<name>[\w:]+[?!=]?)',
+    'php': r'^\s*(?:(?:public|private|protected|static|abstract|final)\s+)*(?P<kind>function|class|interface|trait)\s+&?(?P<name>\w+)',
+    'bash': r'^\s*(?:(?P<kind>function)\s+(?P<name>[\w-]+)|(?P<name2>[\w-]+)\s*\(\)\s*\{)',
+}
+SYMBOL_PATTERNS = {language: re.compile(pattern, re.MULTILINE) for language, pattern in SYMBOL_PATTERNS.items()}
+
+def _trigrams(text):
+    """Set of lower-cased trigrams in a string"""
+    text = text.lower()
+    return set(map(''.join, zip(text, text[1:], text[2:])))
+
+def _extract_symbols(path, content):
+    """(name, kind, line) for the definitions in a file"""
+    pattern = SYMBOL_PATTERNS.get(detect_language(path))
+    if pattern is None:
+        return []
+    symbols = []
+    line = 1
+    last = 0
+    for match in pattern.finditer(content):
+        line += content.count('\n', last, match.start())
+        last = match.start()
+        groups = match.groupdict()
+        name = groups.get('name') or groups.get('name2')
+        if not name or name in ('if', 'for', 'while', 'switch', 'return', 'catch'):
+            continue
+        kind = groups.get('kind') or groups.get('kind2') or 'function'
+        symbols.append((name, kind.rstrip('*'), line))
+    return symbols
+
+def _search_remove(index, path):
+    """Drop a file from a search index"""
+    forget_search_texts(index['room_id'], path)
+    entry = index['files'].pop(path, None)
+    if entry is None:
+        return
+    for gram in entry['trigrams']:
+        paths = index['postings'].get(gram)
+        if paths is not None:
+            paths.discard(path)
+            if not paths:
+                del index['postings'][gram]
+    for name, _, _ in entry['symbols']:
+        key = name.lower()
+        paths = index['symbols'].get(key)
+        if paths is not None:
+            paths.discard(path)
+            if not paths:
+                del index['symbols'][key]
+                names = index['symbol_names']
+                if names is not None:
+                    del names[bisect.bisect_left(names, key)]
+
+def _search_content(room_id, path, stat):
+    """Searchable text of a file from its live document, the text cache or disk; '' if too big or binary"""
+    doc = documents.get((room_id, path))
+    if doc is not None:
+        content = doc['content']
+        if content == "[Binary file - cannot display]" or len(content) > SEARCH_MAX_FILE_BYTES:
+            return ''
+        return content
+    
+    key = (room_id, path)
+    with search_texts_lock:
+        cached = search_texts.get(key)
+        if cached is not None and cached[0] == stat:
+            search_texts.move_to_end(key)
+            return cached[1]
+    
+    content = read_file_from_disk(room_id, path) if stat[1] <= SEARCH_MAX_FILE_BYTES else None
+    if content is None or content == "[Binary file - cannot display]" or len(content) > SEARCH_MAX_FILE_BYTES:
+        content = ''
+    with search_texts_lock:
+        old = search_texts.pop(key, None)
+        if old is not None:
+            search_texts_size[0] -= len(old[1])
+        search_texts[key] = (stat, content)
+        search_texts_size[0] += len(content)
+        while search_texts_size[0] > SEARCH_TEXT_CACHE_CHARS:
+            _, (_, dropped) = search_texts.popitem(last=False)
+            search_texts_size[0] -= len(dropped)
+    return content
+
+def forget_search_texts(room_id, path=None):
+    """Drop cached file text for a room, or for one of its files"""
+    with search_texts_lock:
+        keys = [(room_id, path)] if path is not None else [key for key in search_texts if key[0] == room_id]
+        for key in keys:
+            cached = search_texts.pop(key, None)
+            if cached is not None:
+                search_texts_size[0] -= len(cached[1])
+
+def _search_add(index, room_id, path, stat):
+    """(Re)index a file from its live document, or from disk"""
+    _search_remove(index, path)
+    content = _search_content(room_id, path, stat)
+    
+    entry = index['files'][path] = {
+        'searchable': bool(content),
+        'stat': stat,
+        'trigrams': _trigrams(content),
+        'symbols': _extract_symbols(path, content)
+    }
+    for gram in entry['trigrams']:
+        index['postings'][gram].add(path)
+    for name, _, _ in entry['symbols']:
+        key = name.lower()
+        if key not in index['symbols'] and index['symbol_names'] is not None:
+            bisect.insort(index['symbol_names'], key)
+        index['symbols'][key].add(path)
+
+def _sync_search_index(room_id, index):
+    """Bring a room's search index in line with its file index and live edits"""
+    with file_index_lock:
+        files = get_file_index(room_id)
+        version = file_index_version(files)
+        stats = None
+        if version != index['file_version']:
+            stats = {path: stat for path, (_, stat) in files['files'].items()}
+    
+    if stats is not None:
+        for path in [p for p in index['files'] if p not in stats]:
+            _search_remove(index, path)
+        for path, stat in stats.items():
+            entry = index['files'].get(path)
+            if entry is None or entry['stat'] != stat:
+                _search_add(index, room_id, path, stat)
+        index['file_version'] = version
+    
+    while index['edited']:
+        path = index['edited'].pop()
+        if path in index['files']:
+            _search_add(index, room_id, path, index['files'][path]['stat'])
+
+def get_search_index(room_id):
+    """A room's search index, built on first use; caller holds its lock before using it"""
+    with search_lock:
+        index = search_indexes.get(room_id)
+        if index is None:
+            index = search_indexes[room_id] = {
+                'room_id': room_id,
+                'files': {},  # path -> {searchable, stat, trigrams, symbols}
+                'postings': defaultdict(set),  # trigram -> paths containing it
+                'symbols': defaultdict(set),  # lower-cased symbol name -> paths defining it
+                'symbol_names': None,  # sorted symbol names, built by the first symbol search
+                'file_version': None,  # file index version last synced with
+                'edited': set(),  # paths with live edits not yet indexed
+                'lock': threading.Lock()
+            }
+        search_indexes.move_to_end(room_id)
+        while len(search_indexes) > SEARCH_INDEX_ROOMS:
+            search_indexes.popitem(last=False)
+        return index
+
+def search_path_edited(room_id, filename):
+    """Note a live edit; the file is indexed again on the next search"""
+    index = search_indexes.get(room_id)
+    if index is not None:
+        index['edited'].add(filename)
+
+def _class_end(pattern, i):
+    """Index of the `]` closing the character class that opens at pattern[i]"""
+    i += 1
+    if pattern.startswith('^', i):
+        i += 1
+    # A `]` straight after the opening bracket is a literal member
+    if pattern.startswith(']', i):
+        i += 1
+    while i < len(pattern) and pattern[i] != ']':
+        i += 2 if pattern[i] == '\\' else 1
+    return i
+
+def _regex_literals(pattern):
+    """Literal strings every match of a regex must contain (possibly none).
+
+    Deliberately conservative: alternations and verbose mode give up, and
+    groups, classes and anything followed by an optional quantifier are
+    skipped. A repeated character (`b+`) ends one literal and starts the next.
+    """
+    if '|' in pattern or re.search(r'\(\?[a-zA-Z]*x', pattern):
+        return []
+    literals = []
+    current = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern):
+            escaped = pattern[i + 1]
+            i += 2
+            if escaped.isalnum():
+                literals.append(current)
+                current = ''
+                # Skip the digits or name that belong to the escape (\x41, \N{...}, \12)
+                if escaped == 'N' and pattern.startswith('{', i):
+                    i = pattern.find('}', i) + 1 or len(pattern)
+                elif escaped in 'xuU':
+                    i += {'x': 2, 'u': 4, 'U': 8}[escaped]
+                elif escaped.isdigit():
+                    while i < len(pattern) and pattern[i].isdigit():
+                        i += 1
             else:
-                 # Compile C/C++/Rust
-                 compile_cmd = [
-                     cmd.replace('{file}', source_file).replace('{executable}', executable)
-                     for cmd in config['compile']
-                 ]
-                 compile_result = subprocess.run(compile_cmd, cwd=cwd, capture_output=True, text=True, timeout=CODE_EXECUTION_TIMEOUT)
-                 if compile_result.returncode != 0:
-                     return {"output": f"Compilation Error:\n{compile_result.stderr}", "error": True}
-                 
-                 run_cmd = [cmd.replace('{executable}', executable) for cmd in config['command']]
+                current += escaped
+            continue
+        if c in '?*{':
+            current = current[:-1]
+            literals.append(current)
+            current = ''
+            if c == '{':
+                i = pattern.find('}', i) if '}' in pattern[i:] else len(pattern)
+        elif c in '([':
+            literals.append(current)
+            current = ''
+            # Skip to the matching close
+            if c == '[':
+                i = _class_end(pattern, i)
+            else:
+                depth = 0
+                while i < len(pattern):
+                    if pattern[i] == '\\':
+                        i += 1
+                    elif pattern[i] == '[':
+                        i = _class_end(pattern, i)
+                    elif pattern[i] == '(':
+                        depth += 1
+                    elif pattern[i] == ')':
+                        depth -= 1
+                        if depth == 0:
+                            break
+                    i += 1
+            # A quantifier after the group/class doesn't affect the literals around it
+            if i + 1 < len(pattern) and pattern[i + 1] in '?*+{':
+                i += 1
+                if pattern[i] == '{':
+                    i = pattern.find('}', i) if '}' in pattern[i:] else len(pattern)
+        elif c == '+':
+            literals.append(current)
+            current = current[-1:]
+        elif c in '.^$)]':
+            literals.append(current)
+            current = ''
         else:
-            # Interpreted
-            run_cmd = [cmd.replace('{file}', source_file) for cmd in config['command']]
+            current += c
+        i += 1
+    literals.append(current)
+    return [literal for literal in literals if len(literal) >= 3]
 
-        # Run the command
-        result = subprocess.run(
-            run_cmd,
-            input=input_data,
-            cwd=cwd,
-            capture_output=True,
-            text=True,
-            timeout=CODE_EXECUTION_TIMEOUT
-        )
+def _candidates(index, literals):
+    """Paths whose text contains the trigrams of all the literals"""
+    grams = set()
+    for literal in literals:
+        grams |= _trigrams(literal)
+    if not grams:
+        return set(index['files'])
+    postings = sorted((index['postings'].get(gram, ()) for gram in grams), key=len)
+    result = set(postings[0])
+    for paths in postings[1:]:
+        if not result:
+            break
+        result &= paths
+    return result
+
+def _match_lines(content, pattern, limit):
+    """(line number, line text) for the first `limit` matches in content"""
+    lines = []
+    line = 1
+    last = 0
+    for match in pattern.finditer(content):
+        line += content.count('\n', last, match.start())
+        last = match.start()
+        if lines and lines[-1]['line'] == line:
+            continue
+        start = content.rfind('\n', 0, match.start()) + 1
+        end = content.find('\n', match.start())
+        lines.append({'line': line, 'text': content[start:end if end >= 0 else None][:SEARCH_LINE_CHARS]})
+        if len(lines) == limit:
+            break
+    return lines
+
+def search_text(room_id, query, regex=False, case_sensitive=False, offset=0, limit=SEARCH_PAGE_SIZE):
+    """Ranked files matching a substring or regex; returns (page, total).
+
+    Raises re.error for an invalid regex.
+    """
+    flags = 0 if case_sensitive else re.IGNORECASE
+    pattern = re.compile(query if regex else re.escape(query), flags | re.MULTILINE)
+    literals = _regex_literals(query) if regex else [query]
+    needle = query.lower()
+    
+    index = get_search_index(room_id)
+    with index['lock']:
+        _sync_search_index(room_id, index)
+        ranked = []
+        for path in _candidates(index, literals):
+            if not index['files'][path]['searchable']:
+                continue
+            content = _search_content(room_id, path, index['files'][path]['stat'])
+            count = sum(1 for _ in itertools.islice(pattern.finditer(content), SEARCH_MAX_COUNT))
+            if not count:
+                continue
+            score = count
+            if not regex and needle in os.path.basename(path).lower():
+                score += SEARCH_MAX_COUNT
+            if needle in index['symbols'] and path in index['symbols'][needle]:
+                score += 2 * SEARCH_MAX_COUNT
+            ranked.append((-score, path, count))
+        ranked.sort()
         
-        # Prepare output
-        output = result.stdout
-        if result.stderr:
-            output += f"\n[stderr]:\n{result.stderr}"
+        page = [{
+            'path': path,
+            'score': -score,
+            'count': count,
+            'matches': _match_lines(_search_content(room_id, path, index['files'][path]['stat']), pattern,
+                                    SEARCH_MATCHES_PER_FILE)
+        } for score, path, count in ranked[offset:offset + limit]]
+        return page, len(ranked)
+
+def search_symbols(room_id, query, offset=0, limit=SEARCH_PAGE_SIZE):
+    """Definitions whose name starts with query, exact matches first; returns (page, total)"""
+    needle = query.lower()
+    index = get_search_index(room_id)
+    with index['lock']:
+        _sync_search_index(room_id, index)
+        if index['symbol_names'] is None:
+            index['symbol_names'] = sorted(index['symbols'])
+        names = index['symbol_names']
         
-        return {
-            "output": output if output else "[No output]",
-            "error": result.returncode != 0,
+        found = []
+        for i in range(bisect.bisect_left(names, needle), len(names)):
+            key = names[i]
+            if not key.startswith(needle):
+                break
+            for path in index['symbols'][key]:
+                for name, kind, line in index['files'][path]['symbols']:
+                    if name.lower() == key:
+                        found.append((key != needle, len(key), path, line, name, kind))
+        found.sort()
+        
+        page = [{'name': name, 'kind': kind, 'path': path, 'line': line}
+                for _, _, path, line, name, kind in found[offset:offset + limit]]
+        return page, len(found)
+
+# ============ Document Store ============
+#
+# While a file is open its live document is the source of truth. Edits only
+# touch memory; dirty documents are written behind on a coalescing timer (or
+# straight away once enough has changed) and idle ones are evicted.
+#
+# Edits arrive as text operations (see ot.py). Revisions, recent ops and a
+# snapshot live in the state backend so several workers can edit the same
+# document: each worker keeps its own copy of the content and catches up from
+# the shared ops under the room lock.
+
+def _new_document(content, revision, epoch):
+    """Build the in-memory state for a loaded document"""
+    return {
+        'content': content,
+        'revision': revision,
+        'epoch': epoch,
+        'dirty': False,
+        'dirty_since': 0,
+        'dirty_bytes': 0,
+        'auto_save': True,
+        'last_access': time.time()
+    }
+
+def _catch_up(doc, ops):
+    """Apply ops committed by other workers to a local copy"""
+    for op in ops:
+        doc['content'] = apply_text_op(doc['content'], op)
+        doc['revision'] += 1
+
+def _load_document(room_id, filename):
+    """Load a document from the backend's snapshot, or from disk as a new epoch"""
+    state = state_backend.document_state(room_id, filename)
+    if state is not None:
+        snapshot = state_backend.document_snapshot(room_id, filename)
+        ops = state_backend.document_ops(room_id, filename, snapshot[0]) if snapshot else None
+        if ops is not None:
+            doc = _new_document(snapshot[1], snapshot[0], state[0])
+            try:
+                _catch_up(doc, ops)
+                return doc
+            except ValueError:
+                pass
+    
+    content = read_file_from_disk(room_id, filename)
+    if content is None or content == "[Binary file - cannot display]":
+        return None  # binary files are never opened for editing
+    epoch = uuid.uuid4().hex[:8]
+    state_backend.create_document(room_id, filename, epoch, content)
+    journal_append(room_id, {'t': 'base', 'f': filename, 'e': epoch, 'r': 0, 'c': content})
+    return _new_document(content, 0, epoch)
+
+def get_document(room_id, filename):
+    """Get the up-to-date live document for a file; caller holds the room lock"""
+    key = (room_id, filename)
+    doc = documents.get(key)
+    state = state_backend.document_state(room_id, filename)
+    
+    if doc is not None and state is not None and state[0] == doc['epoch']:
+        if state[1] > doc['revision']:
+            ops = state_backend.document_ops(room_id, filename, doc['revision'])
+            try:
+                if ops is None:
+                    raise ValueError("Missed ops are no longer available")
+                _catch_up(doc, ops)
+            except ValueError:
+                doc = None
+    else:
+        doc = None
+    
+    if doc is None:
+        previous = documents.get(key)
+        doc = _load_document(room_id, filename)
+        if doc is None:
+            return None
+        if previous is not None and previous['dirty'] and previous['epoch'] == doc['epoch']:
+            _mark_dirty(doc, previous['dirty_bytes'])
+        documents[key] = doc
+        ensure_background_task('document_flusher', document_flusher)
+    
+    doc['last_access'] = time.time()
+    return doc
+
+def _mark_dirty(doc, changed_units):
+    """Record a change that still has to reach the disk"""
+    if not doc['dirty']:
+        doc['dirty'] = True
+        doc['dirty_since'] = time.time()
+    doc['dirty_bytes'] += changed_units
+
+def apply_document_op(room_id, filename, base_revision, op, epoch=None, auto_save=True):
+    """Apply a client op made against base_revision.
+
+    Returns (revision, transformed_op), or None when the client is too far
+    behind (or ahead, or on an evicted copy) and has to resync.
+    """
+    with state_backend.room_lock(room_id):
+        doc = get_document(room_id, filename)
+        if doc is None:
+            return None
+        if epoch is not None and epoch != doc['epoch']:
+            return None
+
+        missed = doc['revision'] - base_revision
+        if missed < 0:
+            return None
+        concurrent = state_backend.document_ops(room_id, filename, base_revision) if missed else []
+        if concurrent is None:
+            return None
+
+        for other in concurrent:
+            op = transform_text_op(op, other, 'right')
+
+        try:
+            content = apply_text_op(doc['content'], op)
+        except ValueError:
+            return None
+        # The cap is in UTF-8 bytes; only long documents need encoding to check it
+        if len(content) > MAX_FILE_SIZE // 4 and len(content.encode('utf-8', 'surrogatepass')) > MAX_FILE_SIZE:
+            return None
+
+        doc['content'] = content
+        doc['revision'] += 1
+        doc['auto_save'] = auto_save
+        search_path_edited(room_id, filename)
+        state_backend.append_document_op(room_id, filename, doc['revision'], op)
+        journal_append(room_id, {'t': 'op', 'f': filename, 'e': doc['epoch'], 'r': doc['revision'], 'op': op})
+        _mark_dirty(doc, sum(component_length(c) for c in op if not isinstance(c, int)))
+
+        # Big bursts (pastes, generated code) are written out right away
+        if auto_save and doc['dirty_bytes'] >= DOCUMENT_FLUSH_BYTES:
+            _flush_document_locked(room_id, filename, doc)
+
+        return doc['revision'], op
+
+def set_document_content(room_id, filename, content):
+    """Replace a document's content wholesale.
+
+    Returns (revision, epoch), or None when the document can't be loaded or
+    the content is over the size cap.
+    """
+    with state_backend.room_lock(room_id):
+        doc = get_document(room_id, filename)
+        if doc is None:
+            return None
+        if content == doc['content']:
+            return doc['revision'], doc['epoch']
+        if len(content) > MAX_FILE_SIZE // 4 and len(content.encode('utf-8', 'surrogatepass')) > MAX_FILE_SIZE:
+            return None
+
+        op = []
+        append_component(op, {'d': utf16_len(doc['content'])})
+        append_component(op, content)
+
+        doc['content'] = content
+        doc['revision'] += 1
+        search_path_edited(room_id, filename)
+        state_backend.append_document_op(room_id, filename, doc['revision'], op)
+        journal_append(room_id, {'t': 'op', 'f': filename, 'e': doc['epoch'], 'r': doc['revision'], 'op': op})
+        _mark_dirty(doc, len(content))
+        return doc['revision'], doc['epoch']
+
+def _flush_document_locked(room_id, filename, doc):
+    """Write a dirty document to disk; caller holds the room lock"""
+    if not doc['dirty']:
+        return True
+    if not write_file_to_disk(room_id, filename, doc['content']):
+        return False
+    state_backend.save_document_snapshot(room_id, filename, doc['revision'], doc['content'])
+    journal_append(room_id, {'t': 'saved', 'f': filename, 'e': doc['epoch'], 'r': doc['revision']}, sync=True)
+    doc['dirty'] = False
+    doc['dirty_bytes'] = 0
+    return True
+
+def flush_document(room_id, filename):
+    """Write a live document to disk if it has unsaved changes"""
+    with state_backend.room_lock(room_id):
+        if (room_id, filename) not in documents:
+            return True
+        doc = get_document(room_id, filename)
+        if doc is None:
+            return False
+        return _flush_document_locked(room_id, filename, doc)
+
+def flush_all_documents():
+    """Write every dirty document to disk"""
+    for room_id, filename in list(documents):
+        flush_document(room_id, filename)
+
+def drop_document(room_id, filename):
+    """Forget a live document without saving it (file deleted)"""
+    with state_backend.room_lock(room_id):
+        documents.pop((room_id, filename), None)
+        state_backend.drop_document(room_id, filename)
+        journal_append(room_id, {'t': 'delete', 'f': filename})
+    forget_diagnostics(room_id, filename)
+
+def move_document(room_id, old_name, new_name):
+    """Re-key a live document after its file was renamed"""
+    with state_backend.room_lock(room_id):
+        doc = documents.pop((room_id, old_name), None)
+        if doc is not None:
+            documents[(room_id, new_name)] = doc
+        state_backend.rename_document(room_id, old_name, new_name)
+        
+        # History follows the file: the new name starts from its current content
+        journal_append(room_id, {'t': 'delete', 'f': old_name})
+        if doc is not None:
+            journal_append(room_id, {'t': 'base', 'f': new_name, 'e': doc['epoch'], 'r': doc['revision'], 'c': doc['content']})
+        else:
+            journal_append(room_id, {'t': 'base', 'f': new_name, 'e': uuid.uuid4().hex[:8], 'r': 0,
+                                     'c': read_file_from_disk(room_id, new_name)})
+    forget_diagnostics(room_id, old_name)
+
+def document_flusher():
+    """Background task: write behind dirty documents and evict idle ones"""
+    while True:
+        socketio.sleep(DOCUMENT_FLUSH_INTERVAL)
+        now = time.time()
+        for key in list(documents):
+            room_id, filename = key
+            saved = False
+            evicted = False
+            with state_backend.room_lock(room_id):
+                doc = documents.get(key)
+                if doc is None:
+                    continue
+                idle = now - doc['last_access'] > DOCUMENT_IDLE_TIMEOUT
+                due = doc['auto_save'] and now - doc['dirty_since'] >= DOCUMENT_FLUSH_DELAY
+                if doc['dirty'] and (due or idle):
+                    doc = get_document(room_id, filename)
+                    if doc is None:
+                        continue
+                    saved = _flush_document_locked(room_id, filename, doc)
+                    revision = doc['revision']
+                if idle and not doc['dirty']:
+                    del documents[key]
+                    state_backend.expire_document(room_id, filename, DOCUMENT_IDLE_TIMEOUT)
+                    evicted = True
+            if evicted:
+                forget_diagnostics(room_id, filename)
+            if saved:
+                socketio.emit('file_saved', {'file': filename, 'rev': revision}, room=room_id)
+
+# ============ Batch File Operations ============
+#
+# A batch is an ordered list of file operations applied in one request. Every
+# path is checked before anything is touched, then the operations run in turn
+# with a result each, and the room is told about all the changes at once.
+
+BATCH_ERRORS = {
+    'create': "File already exists or could not be written",
+    'save': "File could not be saved",
+    'rename': "Source not found or target already exists",
+    'delete': "File not found",
+    'mkdir': "Directory already exists or could not be created"
+}
+
+def save_file_and_notify(room_id, filename, content):
+    """Save a file, replacing its live document and telling editors about it"""
+    if (room_id, filename) not in documents:
+        success = save_file_content(room_id, filename, content)
+        if success:
+            schedule_diagnostics(room_id, filename)
+        return success
+    
+    success = save_file_content(room_id, filename, content) and flush_document(room_id, filename)
+    if success:
+        doc = documents.get((room_id, filename))
+        if doc is not None:
+            socketio.emit('update_code', {
+                'file': filename,
+                'content': doc['content'],
+                'rev': doc['revision'],
+                'epoch': doc['epoch'],
+                'user': 'Unknown'
+            }, room=room_id)
+        schedule_diagnostics(room_id, filename)
+    return success
+
+def validate_batch(room_id, operations):
+    """Error for each operation (None if it is fine), checked before any is applied"""
+    room_path = os.path.abspath(get_room_path(room_id))
+    errors = []
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get('op') not in BATCH_ERRORS:
+            errors.append("Unknown operation")
+            continue
+        names = [operation.get('path')] + ([operation.get('new_path')] if operation['op'] == 'rename' else [])
+        content = operation.get('content', '')
+        if content is None and operation['op'] == 'create':
+            content = ''  # null creates the file from its language template
+        if not all(isinstance(name, str) and name.strip('/') for name in names):
+            errors.append("Missing path")
+        elif not all(is_safe_path(room_id, os.path.join(room_path, name)) and
+                     os.path.abspath(os.path.join(room_path, name)) != room_path for name in names):
+            errors.append("Unsafe path")
+        elif not isinstance(content, str):
+            errors.append("Content must be a string")
+        elif len(content.encode('utf-8')) > MAX_FILE_SIZE:
+            errors.append("File too large")
+        else:
+            errors.append(None)
+    return errors
+
+def apply_batch(room_id, operations):
+    """Apply validated operations in order; returns (results, changed paths, removed paths)"""
+    results = []
+    touched = {}  # path -> True if it exists after the batch, in order of first change
+    for operation in operations:
+        op = operation['op']
+        path = operation['path']
+        if op == 'create':
+            content = operation.get('content')
+            if content is None:
+                content = LANGUAGE_CONFIG.get(operation.get('language'), {}).get('template', '')
+            success = create_new_file(room_id, path, content)
+        elif op == 'save':
+            success = save_file_and_notify(room_id, path, operation.get('content', ''))
+        elif op == 'rename':
+            success = rename_file(room_id, path, operation['new_path'])
+        elif op == 'delete':
+            success = delete_file(room_id, path)
+        else:
+            success = create_directory(room_id, path)
+        
+        result = {'op': op, 'path': path, 'success': success}
+        if not success:
+            result['error'] = BATCH_ERRORS[op]
+        results.append(result)
+        
+        if success and op in ('rename', 'delete'):
+            touched[path] = False
+        if success and op != 'delete':
+            touched[operation['new_path'] if op == 'rename' else path] = True
+    return (results, [path for path, exists in touched.items() if exists],
+            [path for path, exists in touched.items() if not exists])
+
+# ============ Room Archives ============
+#
+# Exports stream a zip or tar.gz of the room (plus its settings) as it is
+# produced: each file is read and compressed in ARCHIVE_CHUNK_BYTES pieces, so
+# memory use doesn't depend on the room's size. Imports read the upload as a
+# stream too. Zips are read front to back from their local headers instead of
+# the central directory at the end. Entries are checked for path safety and
+# quotas while they are unpacked into a staging directory. The room is only
+# touched once the whole archive has been accepted.
+
+ARCHIVE_SETTINGS_NAME = '.codesync/settings.json'
+
+class _ChunkWriter:
+    """Write-only file object that collects output until it is taken"""
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+def _archive_members(room_id):
+    """(archive name, path on disk) for everything in a room export"""
+    # Unsaved edits go into the export
+    for key in [key for key in documents if key[0] == room_id]:
+        flush_document(*key)
+    
+    room_path = get_room_path(room_id)
+    for root, dirs, files in os.walk(room_path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.startswith('.tmp-'):
+                continue
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, room_path).replace(os.sep, '/'), path
+    settings_path = get_settings_path(room_id)
+    if os.path.isfile(settings_path):
+        yield ARCHIVE_SETTINGS_NAME, settings_path
+
+def export_zip(room_id):
+    """Generate a zip of a room, chunk by chunk"""
+    out = _ChunkWriter()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, path in _archive_members(room_id):
+            try:
+                src = open(path, 'rb')
+                info = zipfile.ZipInfo.from_file(path, name)
+            except OSError:
+                continue
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with src, archive.open(info, 'w', force_zip64=info.file_size > 1 << 30) as dest:
+                for chunk in iter(lambda: src.read(ARCHIVE_CHUNK_BYTES), b''):
+                    dest.write(chunk)
+                    if out.size >= ARCHIVE_CHUNK_BYTES:
+                        yield out.take()
+    yield out.take()
+
+def export_tar(room_id):
+    """Generate a tar.gz of a room, chunk by chunk"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for name, path in _archive_members(room_id):
+        try:
+            src = open(path, 'rb')
+            size = os.fstat(src.fileno()).st_size
+        except OSError:
+            continue
+        with src:
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = int(os.path.getmtime(path))
+            info.mode = 0o644
+            yield compressor.compress(info.tobuf(tarfile.PAX_FORMAT))
+            
+            # The header promised `size` bytes: cut off or pad a file that changed meanwhile
+            remaining = size
+            while remaining:
+                chunk = src.read(min(remaining, ARCHIVE_CHUNK_BYTES)) or b'\0' * min(remaining, ARCHIVE_CHUNK_BYTES)
+                remaining -= len(chunk)
+                yield compressor.compress(chunk)
+            yield compressor.compress(b'\0' * (-size % tarfile.BLOCKSIZE))
+    yield compressor.compress(b'\0' * (2 * tarfile.BLOCKSIZE)) + compressor.flush()
+
+class _PrefixedStream:
+    """A stream with some already-read bytes put back in front"""
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size < 0:
+            data, self.prefix = self.prefix + self.stream.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+class _ZipStreamReader:
+    """Reads a zip front to back from a non-seekable stream, using the local file headers"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = b''
+
+    def _read(self, size):
+        while len(self.buffer) < size:
+            chunk = self.stream.read(max(size - len(self.buffer), ARCHIVE_CHUNK_BYTES))
+            if not chunk:
+                raise ValueError("Truncated archive")
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def _read_some(self):
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+            return data
+        data = self.stream.read(ARCHIVE_CHUNK_BYTES)
+        if not data:
+            raise ValueError("Truncated archive")
+        return data
+
+    def _stored(self, size):
+        while size:
+            data = self._read(min(size, ARCHIVE_CHUNK_BYTES))
+            size -= len(data)
+            yield data
+
+    def _deflated(self):
+        decompressor = zlib.decompressobj(-15)
+        while not decompressor.eof:
+            data = decompressor.unconsumed_tail or self._read_some()
+            output = decompressor.decompress(data, ARCHIVE_CHUNK_BYTES)
+            if output:
+                yield output
+        self.buffer = decompressor.unused_data + self.buffer
+
+    def entries(self):
+        """(name, chunk) for each piece of each entry, then (name, None) when it ends"""
+        while True:
+            header = self._read(4)
+            if header != b'PK\x03\x04':
+                return  # central directory: no more entries
+            (_, flags, method, _, _, crc, compressed_size, size,
+             name_length, extra_length) = struct.unpack('<HHHHHIIIHH', self._read(26))
+            name = self._read(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+            extra = self._read(extra_length)
+            zip64 = False
+            while len(extra) >= 4:
+                field, length = struct.unpack('<HH', extra[:4])
+                if field == 1:
+                    zip64 = True
+                    values = list(struct.unpack(f"<{length // 8}Q", extra[4:4 + length // 8 * 8]))
+                    if size == 0xFFFFFFFF and values:
+                        size = values.pop(0)
+                    if compressed_size == 0xFFFFFFFF and values:
+                        compressed_size = values.pop(0)
+                extra = extra[4 + length:]
+            
+            if flags & 1:
+                raise ValueError(f"{name}: encrypted entries are not supported")
+            if method == 8:
+                chunks = self._deflated()
+            elif method == 0 and not flags & 8:
+                chunks = self._stored(compressed_size)
+            else:
+                raise ValueError(f"{name}: unsupported compression")
+            
+            checksum = 0
+            for chunk in chunks:
+                checksum = zlib.crc32(chunk, checksum)
+                yield name, chunk
+            yield name, None
+            
+            if flags & 8:
+                descriptor = self._read(4)
+                if descriptor == b'PK\x07\x08':
+                    descriptor = self._read(4)
+                crc = struct.unpack('<I', descriptor)[0]
+                self._read(16 if zip64 else 8)
+            if checksum != crc:
+                raise ValueError(f"{name}: checksum mismatch")
+
+def _zip_entries(stream):
+    """(name, chunk) pairs of a streamed zip; a None chunk ends each file"""
+    for name, chunk in _ZipStreamReader(stream).entries():
+        if not name.endswith('/'):
+            yield name, chunk
+
+def _tar_entries(stream):
+    """(name, chunk) pairs of a streamed (optionally compressed) tar; a None chunk ends each file"""
+    try:
+        with tarfile.open(fileobj=stream, mode='r|*') as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue  # directories are implied, links and devices are skipped
+                src = archive.extractfile(member)
+                for chunk in iter(lambda: src.read(ARCHIVE_CHUNK_BYTES), b''):
+                    yield member.name, chunk
+                yield member.name, None
+    except (tarfile.TarError, EOFError, zlib.error) as e:
+        raise ValueError(f"Invalid archive: {e}")
+
+def _archive_path(name):
+    """Room-relative path for an archive entry name, or None if it isn't safe"""
+    name = name.replace('\\', '/')
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if not parts or name.startswith('/') or '..' in parts or ':' in parts[0] or '\0' in name:
+        return None
+    return '/'.join(parts)
+
+def import_archive(room_id, stream):
+    """Unpack a streamed zip or tar(.gz) into a room.
+
+    Returns (imported paths, error); nothing in the room changes on error.
+    """
+    magic = stream.read(4)
+    stream = _PrefixedStream(magic, stream)
+    entries = _zip_entries(stream) if magic == b'PK\x03\x04' else _tar_entries(stream)
+    
+    room_path = get_room_path(room_id)
+    ensure_dir(room_path)
+    staging = tempfile.mkdtemp(prefix='codesync_import_')
+    try:
+        staged = []
+        total = 0
+        out = None
+        current = None
+        for name, chunk in entries:
+            if out is None:
+                current = _archive_path(name)
+                if current is None or not is_safe_path(room_id, os.path.join(room_path, current)):
+                    return [], f"Unsafe path in archive: {name}"
+                if len(staged) >= IMPORT_MAX_FILES:
+                    return [], f"Archive has more than {IMPORT_MAX_FILES} files"
+                staged_path = os.path.join(staging, str(len(staged)))
+                out = open(staged_path, 'wb')
+                size = 0
+            if chunk is None:
+                out.close()
+                out = None
+                staged.append((current, staged_path))
+                continue
+            size += len(chunk)
+            total += len(chunk)
+            if size > MAX_FILE_SIZE:
+                return [], f"{current} is larger than {MAX_FILE_SIZE} bytes"
+            if total > IMPORT_MAX_BYTES:
+                return [], f"Archive unpacks to more than {IMPORT_MAX_BYTES} bytes"
+            out.write(chunk)
+        if out is not None:
+            return [], "Truncated archive"
+        
+        return _apply_import(room_id, staged), None
+    except ValueError as e:
+        return [], str(e)
+    finally:
+        if out is not None:
+            out.close()
+        shutil.rmtree(staging, ignore_errors=True)
+
+def _apply_import(room_id, staged):
+    """Move staged archive entries into a room; returns the paths written"""
+    room_path = get_room_path(room_id)
+    imported = []
+    for rel_path, staged_path in staged:
+        if rel_path == ARCHIVE_SETTINGS_NAME:
+            try:
+                with open(staged_path, 'r', encoding='utf-8') as f:
+                    settings = json.load(f)
+            except (ValueError, UnicodeDecodeError):
+                continue
+            if isinstance(settings, dict) and save_room_settings(room_id, settings) is not None:
+                settings, version = get_room_settings_version(room_id)
+                socketio.emit('settings_updated', {'settings': settings, 'version': version}, room=room_id)
+            continue
+        
+        with open(staged_path, 'rb') as f:
+            data = f.read()
+        try:
+            content = data.decode('utf-8')
+        except UnicodeDecodeError:
+            content = None
+        
+        if content is not None:
+            if not save_file_and_notify(room_id, rel_path, content):
+                continue
+        else:
+            # Binary files are moved in as they are
+            target = os.path.join(room_path, rel_path)
+            try:
+                ensure_dir(os.path.dirname(target))
+                os.replace(staged_path, target)
+            except OSError:
+                continue
+            if (room_id, rel_path) in documents:
+                drop_document(room_id, rel_path)
+            index_path_changed(room_id, target)
+        imported.append(rel_path)
+    return imported
+
+# ============ Large Files ============
+#
+# Files over LARGE_FILE_BYTES never become live documents: they are read in
+# windows straight from an mmap and patched by byte or line range. To find
+# lines, a per-file index stores how many newlines come before each
+# LINE_INDEX_BLOCK_BYTES block. A lookup bisects to the right block and then
+# scans at most one block. An edit only throws away the blocks after it. The
+# index is rebuilt from there on the next read.
+
+RANGE_CONFLICT = "File changed since it was read"
+RANGE_LIVE_DOCUMENT = "File is open as a live document"
+
+def file_version(stat):
+    """Version token for a file on disk"""
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+def large_file_info(room_id, filename):
+    """Size and version of a file too big to open as a document, else None"""
+    path = os.path.join(get_room_path(room_id), filename)
+    if not is_safe_path(room_id, path) or (room_id, filename) in documents:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if stat.st_size <= LARGE_FILE_BYTES:
+        return None
+    return {"large": True, "size": stat.st_size, "version": file_version(stat)}
+
+def get_line_index(room_id, filename, signature):
+    """A file's line index; caller holds its lock and extends it before use"""
+    key = (room_id, filename)
+    with line_index_lock:
+        index = line_indexes.get(key)
+        if index is None or index['signature'] != signature:
+            index = line_indexes[key] = {
+                'signature': signature,  # (mtime_ns, size) the index describes
+                'blocks': array.array('q'),  # newlines before each block
+                'newlines': 0,  # newlines in the scanned part
+                'scanned': 0,  # bytes scanned so far
+                'lock': threading.Lock()
+            }
+        line_indexes.move_to_end(key)
+        while len(line_indexes) > LINE_INDEX_CACHE_SIZE:
+            line_indexes.popitem(last=False)
+        return index
+
+def _extend_line_index(index, mm):
+    """Count newlines in the part of the file not scanned yet"""
+    size = len(mm)
+    step = LINE_INDEX_BLOCK_BYTES
+    while index['scanned'] < size:
+        start = index['scanned']
+        chunk = mm[start:start + 64 * step]
+        for i in range(0, len(chunk), step):
+            index['blocks'].append(index['newlines'])
+            index['newlines'] += chunk.count(b'\n', i, i + step)
+        index['scanned'] = start + len(chunk)
+
+def _line_count(index, mm):
+    """Lines in a file; a last line without a newline counts too"""
+    return index['newlines'] + (1 if len(mm) and mm[-1:] != b'\n' else 0)
+
+def _line_start(index, mm, line):
+    """Byte offset where a 0-based line starts (the file size past the end)"""
+    if line <= 0:
+        return 0
+    if line > index['newlines']:
+        return len(mm)
+    blocks = index['blocks']
+    block = bisect.bisect_left(blocks, line) - 1
+    pos = block * LINE_INDEX_BLOCK_BYTES
+    for _ in range(line - blocks[block]):
+        pos = mm.find(b'\n', pos) + 1
+    return pos
+
+def _line_at(index, mm, offset):
+    """0-based line containing a byte offset"""
+    block = offset // LINE_INDEX_BLOCK_BYTES
+    if block >= len(index['blocks']):
+        return index['newlines']
+    return index['blocks'][block] + mm[block * LINE_INDEX_BLOCK_BYTES:offset].count(b'\n')
+
+def _char_boundary(mm, offset, forward):
+    """Nearest UTF-8 character boundary at or around a byte offset"""
+    while 0 < offset < len(mm) and 0x80 <= mm[offset] < 0xC0:
+        offset += 1 if forward else -1
+    return offset
+
+def read_file_range(room_id, filename, offset=None, length=None, line=None, count=None):
+    """Read a byte range or a window of lines from a file; None if it can't be read.
+
+    Byte ranges are widened to whole UTF-8 characters, and line windows stop
+    at RANGE_MAX_BYTES (cutting a longer single line, marked `truncated`).
+    """
+    path = os.path.join(get_room_path(room_id), filename)
+    if not is_safe_path(room_id, path):
+        return None
+    flush_document(room_id, filename)
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+    with f:
+        stat = os.fstat(f.fileno())
+        result = {'size': stat.st_size, 'version': file_version(stat), 'truncated': False}
+        if not stat.st_size:
+            return dict(result, text='', offset=0, end=0, line=0, count=0, total_lines=0)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            index = get_line_index(room_id, filename, (stat.st_mtime_ns, stat.st_size))
+            with index['lock']:
+                _extend_line_index(index, mm)
+                if line is not None:
+                    line = max(0, line)
+                    start = _line_start(index, mm, line)
+                    end = _line_start(index, mm, line + min(max(count or 0, 1), RANGE_MAX_LINES))
+                    if end - start > RANGE_MAX_BYTES:
+                        cut = mm.rfind(b'\n', start, start + RANGE_MAX_BYTES) + 1
+                        end = cut or _char_boundary(mm, start + RANGE_MAX_BYTES, False)
+                        result['truncated'] = not cut
+                else:
+                    start = _char_boundary(mm, min(max(offset or 0, 0), len(mm)), False)
+                    end = _char_boundary(mm, min(start + min(length or 0, RANGE_MAX_BYTES), len(mm)), True)
+                    line = _line_at(index, mm, start)
+                text = mm[start:end].decode('utf-8', errors='replace')
+                lines = text.count('\n') + (1 if text and not text.endswith('\n') else 0)
+                return dict(result, text=text, offset=start, end=end, line=line, count=lines,
+                            total_lines=_line_count(index, mm))
+
+def _copy_range(src, dst, offset, length):
+    """Append length bytes of src from offset to dst, in the kernel when possible"""
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while length:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), length, offset)
+                if not copied:
+                    break
+                offset += copied
+                length -= copied
+        except OSError:
+            pass
+    src.seek(offset)
+    while length:
+        chunk = src.read(min(length, ARCHIVE_CHUNK_BYTES))
+        if not chunk:
+            raise OSError("File shrank while it was being copied")
+        dst.write(chunk)
+        length -= len(chunk)
+
+def edit_file_range(room_id, filename, text, offset=None, length=None, line=None, count=None, version=None):
+    """Replace a byte range or whole lines of a file without loading it.
+
+    Returns (info, error). A same-length edit is written in place; anything
+    else copies the file around the edit into a temp file that replaces it.
+    Large files aren't journaled, so their earlier history is dropped. A
+    file open as a live document on any worker is refused.
+    """
+    path = os.path.join(get_room_path(room_id), filename)
+    if not is_safe_path(room_id, path):
+        return None, "Unsafe path"
+    data = text.encode('utf-8')
+    
+    # Any worker may have the file open; the shared document state says so
+    with state_backend.room_lock(room_id):
+        if (room_id, filename) in documents or state_backend.document_state(room_id, filename) is not None:
+            return None, RANGE_LIVE_DOCUMENT
+    
+    with range_edit_lock:
+        try:
+            src = open(path, 'rb')
+        except OSError:
+            return None, "File not found"
+        with src:
+            stat = os.fstat(src.fileno())
+            if version is not None and version != file_version(stat):
+                return None, RANGE_CONFLICT
+            size = stat.st_size
+            
+            if line is not None:
+                if not size:
+                    start = end = 0
+                else:
+                    with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        index = get_line_index(room_id, filename, (stat.st_mtime_ns, size))
+                        with index['lock']:
+                            _extend_line_index(index, mm)
+                            start = _line_start(index, mm, line)
+                            end = _line_start(index, mm, line + max(count or 0, 0))
+            else:
+                start = offset or 0
+                end = start + (length or 0)
+                if not 0 <= start <= end <= size:
+                    return None, "Range is outside the file"
+                if size:
+                    with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        if _char_boundary(mm, start, True) != start or _char_boundary(mm, end, True) != end:
+                            return None, "Range splits a UTF-8 character"
+            if size - (end - start) + len(data) > LARGE_FILE_MAX_BYTES:
+                return None, f"File would be larger than {LARGE_FILE_MAX_BYTES} bytes"
+            
+            try:
+                if len(data) == end - start:
+                    with open(path, 'r+b') as dst:
+                        dst.seek(start)
+                        dst.write(data)
+                else:
+                    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+                    try:
+                        with os.fdopen(fd, 'wb', buffering=0) as dst:
+                            _copy_range(src, dst, 0, start)
+                            dst.write(data)
+                            _copy_range(src, dst, end, size - end)
+                        os.chmod(tmp_path, stat.st_mode & 0o777)
+                        os.replace(tmp_path, path)
+                    except BaseException:
+                        if os.path.exists(tmp_path):
+                            os.remove(tmp_path)
+                        raise
+            except OSError:
+                return None, "File could not be written"
+        
+        # Keep the index up to where the edit starts
+        new_stat = os.stat(path)
+        with line_index_lock:
+            index = line_indexes.get((room_id, filename))
+        if index is not None:
+            with index['lock']:
+                if index['signature'] == (stat.st_mtime_ns, size):
+                    keep = start // LINE_INDEX_BLOCK_BYTES
+                    if keep < len(index['blocks']):
+                        index['newlines'] = index['blocks'][keep]
+                        del index['blocks'][keep:]
+                        index['scanned'] = keep * LINE_INDEX_BLOCK_BYTES
+                    index['signature'] = (new_stat.st_mtime_ns, new_stat.st_size)
+    
+    drop_document(room_id, filename)
+    index_path_changed(room_id, path)
+    return {'size': new_stat.st_size, 'version': file_version(new_stat), 'offset': start, 'end': start + len(data)}, None
+
+# ============ Edit Journal ============
+#
+# Every change to a file is appended to a per-room journal of JSON lines, cut
+# into segments. When a segment fills up, the state of every file at that
+# point is written out as a snapshot, so current content can be rebuilt from
+# the latest snapshot plus the segments after it. The oldest segments and
+# snapshots are deleted once a room's journal outgrows JOURNAL_MAX_BYTES,
+# which bounds how far back history reaches.
+#
+# Records: base (full content, starts an epoch), op (one revision), saved
+# (that revision reached the disk) and delete.
+
+def get_journal_path(room_id):
+    """Get path for a room's journal directory"""
+    return os.path.join(JOURNAL_DIR, room_id)
+
+def _journal_file(room_id, seq, suffix):
+    """Path of a journal segment (.log) or snapshot (.snap)"""
+    return os.path.join(get_journal_path(room_id), f"{seq:08d}{suffix}")
+
+def _journal_seqs(room_id, suffix):
+    """Sequence numbers of a room's segments or snapshots, oldest first"""
+    try:
+        names = os.listdir(get_journal_path(room_id))
+    except OSError:
+        return []
+    return sorted(int(n[:-len(suffix)]) for n in names
+                  if n.endswith(suffix) and n[:-len(suffix)].isdigit())
+
+def _close_journal_writer(writer):
+    """Close a room's open journal files"""
+    for name in ('fd', 'lock_fd'):
+        if writer[name] is not None:
+            os.close(writer[name])
+            writer[name] = None
+
+def forget_journal_writer(room_id):
+    """Close a room's journal files unless someone is writing to it"""
+    with journal_locks_guard:
+        if room_id not in journal_locks and room_id in journal_writers:
+            _close_journal_writer(journal_writers.pop(room_id))
+
+@contextmanager
+def journal_lock(room_id):
+    """Serialize journal writers in this process and across workers; yields the room's open journal files"""
+    with journal_locks_guard:
+        entry = journal_locks.get(room_id)
+        if entry is None:
+            entry = journal_locks[room_id] = {'lock': threading.Lock(), 'holders': 0}
+        entry['holders'] += 1
+        writer = journal_writers.get(room_id)
+        if writer is None:
+            writer = journal_writers[room_id] = {'fd': None, 'lock_fd': None}
+        journal_writers.move_to_end(room_id)
+        # Rooms nobody is writing to give up their files, oldest first
+        idle = [other for other in journal_writers if other not in journal_locks]
+        for other in idle[:max(0, len(journal_writers) - JOURNAL_OPEN_ROOMS)]:
+            _close_journal_writer(journal_writers.pop(other))
+    try:
+        with entry['lock']:
+            if fcntl is None:
+                yield writer
+                return
+            if writer['lock_fd'] is None:
+                ensure_dir(get_journal_path(room_id))
+                writer['lock_fd'] = os.open(os.path.join(get_journal_path(room_id), '.lock'),
+                                            os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            fcntl.flock(writer['lock_fd'], fcntl.LOCK_EX)
+            try:
+                yield writer
+            finally:
+                fcntl.flock(writer['lock_fd'], fcntl.LOCK_UN)
+    finally:
+        with journal_locks_guard:
+            entry['holders'] -= 1
+            if not entry['holders']:
+                del journal_locks[room_id]
+
+def _read_segment(room_id, seq):
+    """Records in a segment, skipping a line torn by a crash"""
+    try:
+        with open(_journal_file(room_id, seq, '.log'), encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+    except OSError:
+        return
+
+def _read_snapshot(room_id, seq):
+    """File states stored in a snapshot"""
+    try:
+        with open(_journal_file(room_id, seq, '.snap'), encoding='utf-8') as f:
+            return json.load(f)['files']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+def _replay_record(files, record):
+    """Apply one journal record to a {filename: state} map"""
+    name = record['f']
+    kind = record['t']
+    if kind == 'base':
+        files[name] = {'epoch': record['e'], 'rev': record['r'], 'content': record['c'],
+                       'saved': True, 'ts': record['ts']}
+    elif kind == 'delete':
+        files.pop(name, None)
+    else:
+        state = files.get(name)
+        if state is None or state['epoch'] != record['e']:
+            return
+        if kind == 'op' and record['r'] == state['rev'] + 1:
+            try:
+                state['content'] = apply_text_op(state['content'], record['op'])
+            except ValueError:
+                del files[name]
+                return
+            state['rev'] = record['r']
+            state['saved'] = False
+            state['ts'] = record['ts']
+        elif kind == 'saved' and record['r'] == state['rev']:
+            state['saved'] = True
+
+def journal_state(room_id):
+    """Latest journaled state of every file: the newest snapshot plus the segments after it"""
+    snapshots = _journal_seqs(room_id, '.snap')
+    start = snapshots[-1] if snapshots else 0
+    files = _read_snapshot(room_id, start) if snapshots else {}
+    for seq in _journal_seqs(room_id, '.log'):
+        if seq >= start:
+            for record in _read_segment(room_id, seq):
+                _replay_record(files, record)
+    return files
+
+def _journal_walk(room_id, filename):
+    """Yield a file's journaled state after every record, from the oldest history kept"""
+    segments = _journal_seqs(room_id, '.log')
+    snapshots = _journal_seqs(room_id, '.snap')
+    start = segments[0] if segments else (snapshots[0] if snapshots else 0)
+    files = {}
+    if start in snapshots:
+        state = _read_snapshot(room_id, start).get(filename)
+        if state is not None:
+            files[filename] = state
+            yield state
+    for seq in segments:
+        for record in _read_segment(room_id, seq):
+            if record.get('f') == filename:
+                _replay_record(files, record)
+                yield files.get(filename)
+
+def journal_append(room_id, record, sync=False):
+    """Append a record to a room's journal, rolling to a new segment when the current one is full"""
+    record['ts'] = time.time()
+    line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+    
+    with journal_lock(room_id) as writer:
+        # The open segment is reused until it fills up; only then is the directory
+        # scanned again, since a full segment is also what makes any worker roll
+        if writer['fd'] is not None and os.fstat(writer['fd']).st_size >= JOURNAL_SEGMENT_BYTES:
+            os.close(writer['fd'])
+            writer['fd'] = None
+        if writer['fd'] is None:
+            ensure_dir(get_journal_path(room_id))
+            segments = _journal_seqs(room_id, '.log')
+            seq = segments[-1] if segments else 1
+            path = _journal_file(room_id, seq, '.log')
+            if os.path.exists(path) and os.path.getsize(path) >= JOURNAL_SEGMENT_BYTES:
+                seq = _roll_journal(room_id, seq)
+                path = _journal_file(room_id, seq, '.log')
+            writer['fd'] = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        
+        os.write(writer['fd'], line)
+        if sync:
+            os.fsync(writer['fd'])
+
+def _roll_journal(room_id, seq):
+    """Snapshot the state a new segment starts from, then compact; returns the new segment number"""
+    snapshot = {'seq': seq + 1, 'ts': time.time(), 'files': journal_state(room_id)}
+    atomic_write(_journal_file(room_id, seq + 1, '.snap'), json.dumps(snapshot, separators=(',', ':')))
+    compact_journal(room_id)
+    return seq + 1
+
+def compact_journal(room_id):
+    """Delete the oldest segments and snapshots while the journal is over its size budget"""
+    snapshots = _journal_seqs(room_id, '.snap')
+    if not snapshots:
+        return
+    paths = [_journal_file(room_id, seq, suffix)
+             for seq in sorted(set(snapshots) | set(_journal_seqs(room_id, '.log')))
+             for suffix in ('.snap', '.log')]
+    sizes = {p: os.path.getsize(p) for p in paths if os.path.exists(p)}
+    total = sum(sizes.values())
+    
+    # Always keep the latest snapshot and everything after it
+    for seq in sorted(set(snapshots) | set(_journal_seqs(room_id, '.log'))):
+        if total <= JOURNAL_MAX_BYTES or seq >= snapshots[-1]:
+            break
+        for suffix in ('.snap', '.log'):
+            path = _journal_file(room_id, seq, suffix)
+            if path in sizes:
+                os.remove(path)
+                total -= sizes[path]
+
+def journal_history(room_id, filename):
+    """Versions of a file still in the journal, one per epoch"""
+    versions = {}
+    for state in _journal_walk(room_id, filename):
+        if state is None:
+            continue
+        version = versions.get(state['epoch'])
+        if version is None:
+            version = versions[state['epoch']] = {
+                'epoch': state['epoch'],
+                'first_rev': state['rev'],
+                'started': state['ts']
+            }
+        version['last_rev'] = state['rev']
+        version['updated'] = state['ts']
+    return sorted(versions.values(), key=lambda v: v['started'])
+
+def journal_content(room_id, filename, epoch, revision):
+    """Content of a file at a past revision, or None if it is no longer in the journal"""
+    for state in _journal_walk(room_id, filename):
+        if state is not None and state['epoch'] == epoch and state['rev'] == revision:
+            return state['content']
+    return None
+
+def recover_journals():
+    """Write back journaled edits that never reached the disk (after a crash); returns the file count"""
+    if not os.path.isdir(JOURNAL_DIR):
+        return 0
+    recovered = 0
+    for room_id in os.listdir(JOURNAL_DIR):
+        with state_backend.room_lock(room_id):
+            for filename, state in journal_state(room_id).items():
+                if state['saved'] or (room_id, filename) in documents:
+                    continue
+                if write_file_to_disk(room_id, filename, state['content']):
+                    journal_append(room_id, {'t': 'saved', 'f': filename, 'e': state['epoch'], 'r': state['rev']}, sync=True)
+                    recovered += 1
+    return recovered
+
+# ============ Compile Cache ============
+#
+# Compiled artifacts (executables, .class files) are cached by language,
+# toolchain version, compiler flags and a hash of the sources, so re-running
+# unchanged code skips the compiler. Entries are evicted least recently used
+# once the cache grows past COMPILE_CACHE_MAX_BYTES.
+
+# Other files in a room that can change what a compile produces
+COMPILE_DEPENDENCY_EXTENSIONS = {
+    'c': ('.c', '.h'),
+    'cpp': ('.cpp', '.cc', '.cxx', '.h', '.hpp', '.hh'),
+    'rust': ('.rs',),
+    'java': ('.java',)
+}
+
+def toolchain_version(program):
+    """Version banner of a compiler, cached per binary (None if unavailable)"""
+    path = shutil.which(program)
+    if path is None:
+        return None
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns)
+    if key not in toolchain_versions:
+        try:
+            result = subprocess.run([path, '--version'], capture_output=True, text=True, timeout=CODE_EXECUTION_TIMEOUT)
+            toolchain_versions[key] = (result.stdout or result.stderr).strip()
+        except (OSError, subprocess.TimeoutExpired):
+            toolchain_versions[key] = None
+    return toolchain_versions[key]
+
+def compile_cache_key(language, source_file, cwd, classname, room_mode):
+    """Cache key for compiling source_file, or None when it can't be cached"""
+    config = LANGUAGE_CONFIG[language]
+    version = toolchain_version(config['compile'][0])
+    if version is None:
+        return None
+    
+    digest = hashlib.sha256()
+    digest.update(json.dumps([language, version, config['compile'], classname]).encode('utf-8'))
+    with open(source_file, 'rb') as f:
+        digest.update(hashlib.sha256(f.read()).digest())
+    
+    # Room files may include each other; fold their contents into the key.
+    # Contents rather than mtimes, since every room run rewrites the file it runs
+    if room_mode:
+        extensions = COMPILE_DEPENDENCY_EXTENSIONS.get(language, ())
+        for root, dirs, filenames in os.walk(cwd):
+            dirs.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(extensions):
+                    path = os.path.join(root, filename)
+                    with open(path, 'rb') as f:
+                        file_digest = hashlib.sha256(f.read()).hexdigest()
+                    digest.update(f"{os.path.relpath(path, cwd)}:{file_digest}\n".encode('utf-8'))
+    
+    return digest.hexdigest()
+
+def _load_compile_cache():
+    """Index the artifacts already on disk, oldest first"""
+    if compile_cache_stats['loaded']:
+        return
+    compile_cache_stats['loaded'] = True
+    ensure_dir(COMPILE_CACHE_DIR)
+    
+    entries = []
+    for key in os.listdir(COMPILE_CACHE_DIR):
+        path = os.path.join(COMPILE_CACHE_DIR, key)
+        if '.tmp-' in key or not os.path.isdir(path):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        entries.append((os.path.getmtime(path), key, size))
+    
+    for _, key, size in sorted(entries):
+        compile_cache[key] = size
+        compile_cache_stats['bytes'] += size
+    _evict_compile_cache()
+
+def _evict_compile_cache():
+    """Drop least recently used entries until the cache fits"""
+    while compile_cache and compile_cache_stats['bytes'] > COMPILE_CACHE_MAX_BYTES:
+        key, size = compile_cache.popitem(last=False)
+        shutil.rmtree(os.path.join(COMPILE_CACHE_DIR, key), ignore_errors=True)
+        compile_cache_stats['bytes'] -= size
+        compile_cache_stats['evictions'] += 1
+
+def restore_compile_artifacts(key, cwd):
+    """Copy cached artifacts into cwd; returns False on a miss"""
+    with compile_cache_lock:
+        _load_compile_cache()
+        if key not in compile_cache:
+            compile_cache_stats['misses'] += 1
+            return False
+        compile_cache.move_to_end(key)
+        compile_cache_stats['hits'] += 1
+    
+    path = os.path.join(COMPILE_CACHE_DIR, key)
+    try:
+        os.utime(path)
+        for filename in os.listdir(path):
+            shutil.copy2(os.path.join(path, filename), os.path.join(cwd, filename))
+        return True
+    except OSError:
+        # Evicted underneath us; compile as usual
+        return False
+
+def store_compile_artifacts(key, artifacts):
+    """Add freshly compiled artifacts to the cache"""
+    path = os.path.join(COMPILE_CACHE_DIR, key)
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+    try:
+        os.makedirs(tmp_path)
+        for artifact in artifacts:
+            shutil.copy2(artifact, os.path.join(tmp_path, os.path.basename(artifact)))
+        size = sum(os.path.getsize(a) for a in artifacts)
+        
+        with compile_cache_lock:
+            if key in compile_cache:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return
+            os.rename(tmp_path, path)
+            compile_cache[key] = size
+            compile_cache_stats['bytes'] += size
+            _evict_compile_cache()
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def _class_files(cwd):
+    """Map of .class files in a directory to their modification times"""
+    return {f: os.stat(os.path.join(cwd, f)).st_mtime_ns
+            for f in os.listdir(cwd) if f.endswith('.class')}
+
+def compile_with_cache(language, compile_cmd, source_file, cwd, executable, classname, room_mode, job=None):
+    """Compile through the artifact cache; returns the compiler result, or None on a cache hit"""
+    try:
+        key = compile_cache_key(language, source_file, cwd, classname, room_mode)
+    except OSError:
+        key = None
+    if key is not None and restore_compile_artifacts(key, cwd):
+        return None
+    
+    before = _class_files(cwd) if language == 'java' else None
+    result = run_subprocess(compile_cmd, cwd, job=job)
+    
+    if key is not None and result.returncode == 0:
+        if language == 'java':
+            after = _class_files(cwd)
+            artifacts = [os.path.join(cwd, f) for f, mtime in after.items() if before.get(f) != mtime]
+        else:
+            artifacts = [executable]
+        if artifacts and all(os.path.isfile(a) for a in artifacts):
+            store_compile_artifacts(key, artifacts)
+    return result
+
+# ============ Warm Python Pool ============
+#
+# Optional pool of pre-started Python interpreters. Each one waits on a
+# control pipe for a single script, runs it as __main__ with the same argv,
+# sys.path, cwd and traceback format as `python file.py`, then exits and is
+# replaced, so no state leaks between runs.
+
+WARM_PYTHON_BOOTSTRAP = r'''
+def _run():
+    import os, sys, json, importlib.machinery
+    for name in sys.argv[2:]:
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+    with os.fdopen(int(sys.argv[1]), 'rb') as control:
+        spec = control.read()
+    if not spec:
+        raise SystemExit(0)
+    spec = json.loads(spec)
+    path = spec['file']
+    os.chdir(spec['cwd'])
+    sys.argv[:] = [path]
+    sys.path[0] = os.path.dirname(os.path.abspath(path))
+    try:
+        with open(path, 'rb') as f:
+            code = compile(f.read(), path, 'exec')
+    except SyntaxError as e:
+        sys.excepthook(type(e), e.with_traceback(None), None)
+        raise SystemExit(1)
+    namespace = sys.modules['__main__'].__dict__
+    dunders = {k: v for k, v in namespace.items() if k.startswith('__')}
+    namespace.clear()
+    namespace.update(dunders)
+    namespace.update(__loader__=importlib.machinery.SourceFileLoader('__main__', path),
+                     __file__=path, __cached__=None)
+    try:
+        exec(code, namespace)
+    except SystemExit:
+        raise
+    except BaseException as e:
+        e.with_traceback(e.__traceback__.tb_next)
+        sys.excepthook(type(e), e, e.__traceback__)
+        raise SystemExit(1)
+_run()
+'''
+
+def spawn_warm_python():
+    """Start an interpreter that waits for one script on a control pipe"""
+    read_fd, write_fd = os.pipe()
+    try:
+        proc = subprocess.Popen(
+            [sys.executable, '-c', WARM_PYTHON_BOOTSTRAP, str(read_fd), *PYTHON_POOL_PRELOAD],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            text=True, pass_fds=(read_fd,)
+        )
+    except OSError:
+        os.close(write_fd)
+        raise
+    finally:
+        os.close(read_fd)
+    proc.control = write_fd
+    return proc
+
+def _discard_warm_python(proc):
+    """Close a pooled interpreter that will not be used"""
+    try:
+        os.close(proc.control)
+    except OSError:
+        pass
+    proc.kill()
+    proc.communicate()
+
+def refill_python_pool():
+    """Top the pool back up; called between runs so warm-up doesn't slow a running job"""
+    if PYTHON_POOL_SIZE <= 0 or os.name != 'posix':
+        return
+    with python_pool_lock:
+        try:
+            while len(python_pool) < PYTHON_POOL_SIZE:
+                python_pool.append(spawn_warm_python())
+        except OSError:
+            pass
+
+def take_warm_python(source_file, cwd):
+    """Hand a script to a pre-started interpreter; None when the pool is off or empty"""
+    with python_pool_lock:
+        proc = python_pool.popleft() if python_pool else None
+    
+    if proc is None:
+        return None
+    if proc.poll() is not None:
+        _discard_warm_python(proc)
+        return None
+    
+    spec = json.dumps({'file': source_file, 'cwd': cwd}).encode('utf-8')
+    try:
+        os.write(proc.control, spec)
+    except OSError:
+        _discard_warm_python(proc)
+        return None
+    finally:
+        try:
+            os.close(proc.control)
+        except OSError:
+            pass
+    return proc
+
+def shutdown_python_pool():
+    """Let idle pooled interpreters exit"""
+    with python_pool_lock:
+        while python_pool:
+            _discard_warm_python(python_pool.popleft())
+
+# ============ Code Execution Functions ============
+
+def run_subprocess(cmd, cwd, input_data=None, job=None, proc=None, stream=False):
+    """Run a command (or an already started process) to completion, letting a job cancel it while it runs"""
+    if proc is None:
+        proc = subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, text=True)
+    if job is not None:
+        job['process'] = proc
+        if job['cancel_requested']:
+            proc.kill()
+    try:
+        if stream:
+            return stream_subprocess(proc, cmd, input_data, job)
+        stdout, stderr = proc.communicate(input_data, timeout=CODE_EXECUTION_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise
+    finally:
+        if job is not None:
+            job['process'] = None
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+def _pipe_reader(pipe, name, chunks):
+    """Thread: forward raw reads from a child pipe until EOF"""
+    fd = pipe.fileno()
+    while True:
+        try:
+            data = os.read(fd, STREAM_CHUNK_BYTES)
+        except OSError:
+            data = b''
+        chunks.put((name, data))
+        if not data:
+            return
+
+def _feed_stdin(proc, job):
+    """Write interactive input queued for a job; None closes stdin"""
+    while not job['stdin'].empty():
+        data = job['stdin'].get_nowait()
+        if proc.stdin.closed:
+            continue
+        try:
+            if data is None:
+                proc.stdin.close()
+            else:
+                proc.stdin.write(data)
+                proc.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError):
+            pass
+
+def _emit_run_output(job, pending):
+    """Queue coalesced output segments, merging adjacent ones from the same stream"""
+    target = job['room_id'] or job['sid']
+    merged = []
+    for stream, text in pending:
+        if merged and merged[-1][0] == stream:
+            merged[-1][1].append(text)
+        else:
+            merged.append((stream, [text]))
+    for stream, texts in merged:
+        worker_events.put(('run_output', {'job_id': job['id'], 'stream': stream, 'data': ''.join(texts)}, target))
+
+def stream_subprocess(proc, cmd, input_data, job):
+    """Send a process's output to the room as it is produced, feeding it interactive stdin"""
+    chunks = queue.Queue()
+    for name in ('stdout', 'stderr'):
+        threading.Thread(target=_pipe_reader, args=(getattr(proc, name), name, chunks), daemon=True).start()
+    
+    # Input sent with the run is fed up front; otherwise stdin stays open for run_input
+    if input_data:
+        job['stdin'].put(input_data)
+        job['stdin'].put(None)
+    
+    decoders = {name: codecs.getincrementaldecoder('utf-8')(errors='replace') for name in ('stdout', 'stderr')}
+    output = {'stdout': [], 'stderr': []}
+    pending = []
+    pending_bytes = 0
+    pending_since = None
+    total_bytes = 0
+    open_pipes = 2
+    deadline = time.time() + CODE_EXECUTION_TIMEOUT
+    
+    while open_pipes:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            proc.kill()
+            proc.wait()
+            _emit_run_output(job, pending)
+            raise subprocess.TimeoutExpired(cmd, CODE_EXECUTION_TIMEOUT)
+        
+        _feed_stdin(proc, job)
+        try:
+            name, data = chunks.get(timeout=min(STREAM_FLUSH_INTERVAL, remaining))
+        except queue.Empty:
+            name, data = None, None
+        
+        if data is not None:
+            if data:
+                text = decoders[name].decode(data)
+            else:
+                open_pipes -= 1
+                text = decoders[name].decode(b'', final=True)
+            
+            if text and not job['output_truncated']:
+                total_bytes += len(data)
+                if total_bytes > STREAM_OUTPUT_LIMIT:
+                    job['output_truncated'] = True
+                    proc.kill()
+                    text = f"\n[Output limit of {STREAM_OUTPUT_LIMIT} bytes exceeded, process killed]\n"
+                    name = 'stderr'
+                output[name].append(text)
+                pending.append((name, text))
+                pending_bytes += len(data)
+                pending_since = pending_since or time.time()
+        
+        if pending and (pending_bytes >= STREAM_CHUNK_BYTES or not open_pipes or
+                        time.time() - pending_since >= STREAM_FLUSH_INTERVAL):
+            _emit_run_output(job, pending)
+            pending, pending_bytes, pending_since = [], 0, None
+    
+    try:
+        proc.wait(timeout=max(0, deadline - time.time()))
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        raise
+    if not proc.stdin.closed:
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+    return subprocess.CompletedProcess(cmd, proc.returncode, ''.join(output['stdout']), ''.join(output['stderr']))
+
+def record_phase(language, phase, started):
+    """Record how long a run phase took; returns the time the next phase starts"""
+    now = time.perf_counter()
+    observe('codesync_execution_phase_seconds', (language, phase), now - started)
+    return now
+
+def execute_code(language, code, input_data="", room_id=None, filename=None, job=None):
+    """Execute code in specified language"""
+    if language not in LANGUAGE_CONFIG:
+        return {"output": f"Language '{language}' not supported", "error": True}
+    
+    config = LANGUAGE_CONFIG[language]
+    
+    # HTML/CSS can't be executed
+    if language in ['html', 'css']:
+        return {"output": "HTML/CSS files are rendered in preview, not executed.", "error": False}
+    
+    temp_dir_manager = None
+    phase_started = time.perf_counter()
+    try:
+        # Determine Execution Context
+        if room_id and filename:
+            # Run in Room Directory (Integrated)
+            cwd = os.path.abspath(get_room_path(room_id))
+            if not os.path.exists(cwd):
+                return {"output": "Room directory not found", "error": True}
+                
+            source_file = os.path.join(cwd, filename)
+            
+            # Ensure latest code is on disk; a live document is authoritative
+            if (room_id, filename) in documents:
+                saved = flush_document(room_id, filename)
+            else:
+                saved = save_file_content(room_id, filename, code)
+            if not saved:
+                return {"output": "Failed to save file before execution.", "error": True}
+                
+            # For Java, derive classname from filename
+            classname = os.path.splitext(os.path.basename(filename))[0]
+            
+        else:
+            # Run in Temporary Directory (Isolated)
+            temp_dir_manager = tempfile.TemporaryDirectory()
+            cwd = temp_dir_manager.name
+            
+            # Setup file
+            ext = config['extension']
+            if language == 'java':
+                class_match = re.search(r'public\s+class\s+(\w+)', code)
+                classname = class_match.group(1) if class_match else "Main"
+                source_file = os.path.join(cwd, f"{classname}.java")
+            else:
+                classname = "program"
+                source_file = os.path.join(cwd, f"code{ext}")
+                
+            with open(source_file, 'w', encoding='utf-8') as f:
+                f.write(code)
+
+        # Prepare Executable Path (for compiled langs)
+        executable = os.path.join(cwd, 'program.exe' if sys.platform == 'win32' else 'program')
+        phase_started = record_phase(language, 'write', phase_started)
+
+        # Execution Logic
+        if 'compile' in config:
+            # Special handling for Java
+            if language == 'java':
+                 compile_cmd = [cmd.replace('{file}', source_file) for cmd in config['compile']]
+                 run_cmd = [cmd.replace('{classname}', classname) for cmd in config['run']]
+            else:
+                 # C/C++/Rust
+                 compile_cmd = [
+                     cmd.replace('{file}', source_file).replace('{executable}', executable)
+                     for cmd in config['compile']
+                 ]
+                 run_cmd = [cmd.replace('{executable}', executable) for cmd in config['command']]
+            
+            # Compile (skipped when the cache already has the artifacts)
+            compile_result = compile_with_cache(language, compile_cmd, source_file, cwd, executable,
+                                                classname, bool(room_id and filename), job=job)
+            phase_started = record_phase(language, 'compile', phase_started)
+            if compile_result is not None and compile_result.returncode != 0:
+                return {"output": f"Compilation Error:\n{compile_result.stderr}", "error": True}
+        else:
+            # Interpreted
+            run_cmd = [cmd.replace('{file}', source_file) for cmd in config['command']]
+
+        # Run the command, on a warm interpreter when one is available
+        warm_proc = take_warm_python(source_file, cwd) if language == 'python' else None
+        stream = job is not None and job['stream']
+        result = run_subprocess(run_cmd, cwd, input_data, job=job, proc=warm_proc, stream=stream)
+        phase_started = record_phase(language, 'run', phase_started)
+        if job is not None and job['cancel_requested']:
+            return {"output": "Execution cancelled", "error": True}
+        
+        # Prepare output
+        output = result.stdout
+        if result.stderr:
+            output += f"\n[stderr]:\n{result.stderr}"
+        
+        return {
+            "output": output if output else "[No output]",
+            "error": result.returncode != 0 or (stream and job['output_truncated']),
             "exit_code": result.returncode
         }
 
-    except subprocess.TimeoutExpired:
-        return {"output": f"Error: Execution timed out (max {CODE_EXECUTION_TIMEOUT}s)", "error": True}
-    except FileNotFoundError as e:
-        return {"output": f"Error: Compiler/Interpreter not found via PATH. ({str(e)})", "error": True}
-    except Exception as e:
-        return {"output": f"Execution Error: {str(e)}", "error": True}
-    finally:
-        if temp_dir_manager:
-            temp_dir_manager.cleanup()
+    except subprocess.TimeoutExpired:
+        return {"output": f"Error: Execution timed out (max {CODE_EXECUTION_TIMEOUT}s)", "error": True}
+    except FileNotFoundError as e:
+        return {"output": f"Error: Compiler/Interpreter not found via PATH. ({str(e)})", "error": True}
+    except Exception as e:
+        return {"output": f"Execution Error: {str(e)}", "error": True}
+    finally:
+        cleanup_started = time.perf_counter()
+        if temp_dir_manager:
+            temp_dir_manager.cleanup()
+        if language == 'python':
+            refill_python_pool()
+        record_phase(language, 'cleanup', cleanup_started)
+
+# ============ Execution Jobs ============
+#
+# Runs are queued as jobs and executed by a fixed pool of worker threads, so
+# a burst of compiles can't stall the server. Worker threads never emit
+# directly; a background task relays their events to the room sockets.
+
+def submit_job(language, code, input_data="", room_id=None, filename=None, priority=5, stream=False, sid=None):
+    """Queue a run; returns (job, None) or (None, error message) when overloaded"""
+    with execution_lock:
+        queued = sum(1 for j in execution_jobs.values() if j['status'] == 'queued')
+        if queued >= EXECUTION_QUEUE_LIMIT:
+            return None, "Execution queue is full, try again shortly"
+        if room_id:
+            active = sum(1 for j in execution_jobs.values()
+                         if j['room_id'] == room_id and j['status'] in ('queued', 'running'))
+            if active >= EXECUTION_ROOM_LIMIT:
+                return None, "Too many runs in progress for this room"
+        
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'priority': priority,
+            'language': language,
+            'code': code,
+            'input': input_data,
+            'room_id': room_id,
+            'filename': filename,
+            'submitted': time.time(),
+            'started': None,
+            'finished': None,
+            'result': None,
+            'process': None,
+            'cancel_requested': False,
+            'stream': stream,
+            'sid': sid,
+            'stdin': queue.Queue() if stream else None,
+            'output_truncated': False,
+            'done': threading.Event()
+        }
+        execution_jobs[job['id']] = job
+        execution_queue.put((priority, job['submitted'], job['id']))
+        
+        while len(execution_workers) < EXECUTION_WORKERS:
+            worker = threading.Thread(target=execution_worker, daemon=True)
+            worker.start()
+            execution_workers.append(worker)
+    
+    ensure_background_task('worker_notifier', worker_notifier)
+    return job, None
+
+def parse_priority(value, default=5):
+    """Clamp a requested job priority to 0 (first) .. 9 (last)"""
+    try:
+        return max(0, min(9, int(value)))
+    except (TypeError, ValueError):
+        return default
+
+def cancel_job(job_id):
+    """Cancel a queued job or kill a running one"""
+    with execution_lock:
+        job = execution_jobs.get(job_id)
+        if job is None or job['status'] not in ('queued', 'running'):
+            return False
+        job['cancel_requested'] = True
+        if job['status'] == 'queued':
+            _finish_job(job, 'cancelled', {"output": "Execution cancelled", "error": True})
+            return True
+        proc = job['process']
+    if proc is not None:
+        proc.kill()
+    return True
+
+def job_info(job):
+    """Public view of a job"""
+    info = {
+        'job_id': job['id'],
+        'status': job['status'],
+        'language': job['language'],
+        'filename': job['filename'],
+        'stream': job['stream'],
+        'submitted': job['submitted'],
+        'started': job['started'],
+        'finished': job['finished']
+    }
+    if job['status'] == 'queued':
+        info['position'] = sum(1 for j in execution_jobs.values()
+                               if j['status'] == 'queued' and
+                               (j['priority'], j['submitted']) < (job['priority'], job['submitted']))
+    if job['result'] is not None:
+        info['result'] = job['result']
+    return info
+
+def _finish_job(job, status, result):
+    """Record a job's outcome and queue its completion event"""
+    job['status'] = status
+    job['result'] = result
+    job['finished'] = time.time()
+    job['code'] = None
+    job['done'].set()
+    target = job['room_id'] or job['sid']
+    if target:
+        worker_events.put(('job_complete', job_info(job), target))
+
+def execution_worker():
+    """Worker thread: run queued jobs one at a time"""
+    while True:
+        _, _, job_id = execution_queue.get()
+        with execution_lock:
+            job = execution_jobs.get(job_id)
+            if job is None or job['status'] != 'queued':
+                continue
+            job['status'] = 'running'
+            job['started'] = time.time()
+        
+        try:
+            result = execute_code(job['language'], job['code'], job['input'],
+                                  job['room_id'], job['filename'], job=job)
+        except Exception as e:
+            result = {"output": f"Execution Error: {str(e)}", "error": True}
+        
+        with execution_lock:
+            if job['cancel_requested']:
+                _finish_job(job, 'cancelled', {"output": "Execution cancelled", "error": True})
+            else:
+                _finish_job(job, 'done', result)
+
+def wait_for_event(event, timeout):
+    """Wait for a threading.Event without blocking other sockets; returns True once set"""
+    deadline = time.time() + timeout
+    while not event.is_set():
+        if time.time() > deadline:
+            return False
+        socketio.sleep(0.05)
+    return True
+
+def wait_for_job(job, timeout):
+    """Wait for a job without blocking other sockets; returns True once finished"""
+    return wait_for_event(job['done'], timeout)
+
+def worker_notifier():
+    """Background task: emit events queued by worker threads and forget old finished jobs"""
+    while True:
+        try:
+            while True:
+                event, payload, room_id = worker_events.get_nowait()
+                socketio.emit(event, payload, room=room_id)
+        except queue.Empty:
+            pass
+        
+        now = time.time()
+        with execution_lock:
+            for job_id, job in list(execution_jobs.items()):
+                if job['finished'] and now - job['finished'] > EXECUTION_JOB_TTL:
+                    del execution_jobs[job_id]
+        socketio.sleep(0.05)
+
+# ============ AI Providers ============
+#
+# Providers are looked up in a registry, so a local fake can stand in for the
+# real services. Clients are pooled per (provider, API key) to reuse their
+# HTTP connections, answers are cached for a while, and identical requests
+# that arrive while one is already upstream wait for it instead of repeating it.
+# Upstream calls run on a small thread pool per provider, so a slow provider
+# can only hold a bounded number of threads and never a request worker.
+
+class GeminiProvider:
+    """Google Gemini via its generativelanguage service client"""
+
+    def client(self, api_key):
+        from google.ai import generativelanguage as glm
+        return glm.GenerativeServiceClient(client_options={'api_key': api_key})
+
+    def _request(self, model, system_instruction, prompt):
+        return {
+            'model': model if model.startswith('models/') else f"models/{model}",
+            'contents': [{'role': 'user', 'parts': [{'text': f"{system_instruction}\n\n{prompt}"}]}]
+        }
+
+    def complete(self, client, model, system_instruction, prompt):
+        response = client.generate_content(**self._request(model, system_instruction, prompt))
+        return ''.join(part.text for part in response.candidates[0].content.parts)
+
+    def stream(self, client, model, system_instruction, prompt):
+        for response in client.stream_generate_content(**self._request(model, system_instruction, prompt)):
+            if response.candidates:
+                yield ''.join(part.text for part in response.candidates[0].content.parts)
+
+class OpenAIProvider:
+    """OpenAI chat completions"""
+
+    def client(self, api_key):
+        import openai
+        return openai.OpenAI(api_key=api_key)
+
+    def complete(self, client, model, system_instruction, prompt):
+        response = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_instruction},
+                {"role": "user", "content": prompt}
+            ]
+        )
+        return response.choices[0].message.content
+
+    def stream(self, client, model, system_instruction, prompt):
+        response = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_instruction},
+                {"role": "user", "content": prompt}
+            ],
+            stream=True
+        )
+        try:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            response.close()
+
+class AnthropicProvider:
+    """Anthropic messages"""
+
+    def client(self, api_key):
+        import anthropic
+        return anthropic.Anthropic(api_key=api_key)
+
+    def complete(self, client, model, system_instruction, prompt):
+        response = client.messages.create(
+            model=model,
+            max_tokens=2048,
+            messages=[{"role": "user", "content": prompt}],
+            system=system_instruction
+        )
+        return response.content[0].text
+
+    def stream(self, client, model, system_instruction, prompt):
+        with client.messages.stream(
+            model=model,
+            max_tokens=2048,
+            messages=[{"role": "user", "content": prompt}],
+            system=system_instruction
+        ) as response:
+            yield from response.text_stream
+
+class FakeAIProvider:
+    """Local stand-in that answers deterministically, for tests and benchmarks"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+
+    def client(self, api_key):
+        return {'api_key': api_key}
+
+    def complete(self, client, model, system_instruction, prompt):
+        self.calls += 1
+        time.sleep(self.delay)
+        return f"[{model}] {system_instruction.split('.')[0]}: {len(prompt)} characters of prompt"
+
+    def stream(self, client, model, system_instruction, prompt):
+        self.calls += 1
+        words = f"[{model}] {system_instruction.split('.')[0]}: {len(prompt)} characters of prompt".split(' ')
+        for i, word in enumerate(words):
+            time.sleep(self.delay / len(words))
+            yield word if i == 0 else ' ' + word
+
+ai_providers = {}
+
+def register_ai_provider(name, provider):
+    """Make a provider available to ai_chat under a name"""
+    ai_providers[name] = provider
+
+register_ai_provider('gemini', GeminiProvider())
+register_ai_provider('openai', OpenAIProvider())
+register_ai_provider('anthropic', AnthropicProvider())
+if AI_FAKE_PROVIDER:
+    register_ai_provider('fake', FakeAIProvider(delay=float(AI_FAKE_PROVIDER)))
+
+def get_ai_client(provider, api_key):
+    """Pooled client for a provider and API key"""
+    key = (provider, hashlib.sha256(api_key.encode('utf-8')).hexdigest())
+    with ai_lock:
+        client = ai_clients.get(key)
+        if client is not None:
+            ai_clients.move_to_end(key)
+            return client
+    
+    client = ai_providers[provider].client(api_key)
+    with ai_lock:
+        ai_clients[key] = client
+        while len(ai_clients) > AI_CLIENT_POOL_SIZE:
+            ai_clients.popitem(last=False)
+    return client
+
+def _ai_cache_get(key):
+    """Cached answer for a request, if still fresh"""
+    with ai_lock:
+        entry = ai_cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del ai_cache[key]
+            return None
+        ai_cache.move_to_end(key)
+        return entry[1]
+
+def _ai_cache_put(key, response):
+    """Cache an answer, evicting the least recently used ones"""
+    with ai_lock:
+        ai_cache[key] = (time.time() + AI_CACHE_TTL, response)
+        ai_cache.move_to_end(key)
+        while len(ai_cache) > AI_CACHE_SIZE:
+            ai_cache.popitem(last=False)
+
+def submit_ai_task(provider, fn, *args):
+    """Run fn on the provider's pool; None if too many requests are already waiting"""
+    with ai_lock:
+        pool = ai_pools.get(provider)
+        if pool is None:
+            pool = ai_pools[provider] = {
+                'executor': ThreadPoolExecutor(max_workers=AI_PROVIDER_CONCURRENCY, thread_name_prefix=f"ai-{provider}"),
+                'pending': 0
+            }
+        if pool['pending'] >= AI_PROVIDER_CONCURRENCY + AI_PROVIDER_QUEUE:
+            return None
+        pool['pending'] += 1
+    
+    def run():
+        try:
+            return fn(*args)
+        finally:
+            with ai_lock:
+                pool['pending'] -= 1
+    return pool['executor'].submit(run)
+
+def _ai_complete(provider, model, api_key, system_instruction, prompt):
+    """Complete answer from a provider; runs on the provider's pool"""
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        client = get_ai_client(provider, api_key)
+        answer = ai_providers[provider].complete(client, model, system_instruction, prompt)
+        outcome = 'ok'
+        return answer
+    finally:
+        observe('codesync_ai_request_seconds', (provider, outcome), time.perf_counter() - started)
+
+# ============ AI Features ============
+
+AI_SYSTEM_PROMPTS = {
+    'chat': "You are an intelligent coding assistant. Be helpful, concise, and professional.",
+    'explain': "Explain the following code clearly and concisely. Break down complex logic.",
+    'debug': "Analyze the code for bugs, errors, or issues. Provide specific fixes.",
+    'optimize': "Suggest optimizations for performance, readability, or best practices.",
+    'complete': "Complete the code intelligently. Return only the code completion.",
+    'refactor': "Refactor the code to improve structure, readability, and maintainability.",
+    'document': "Add comprehensive documentation and comments to the code.",
+    'test': "Generate unit tests for the code.",
+    'convert': "Convert the code to the requested language while maintaining functionality."
+}
+
+def build_ai_request(provider, model, prompt, code_context=None, task_type='chat'):
+    """System instruction, full prompt and cache key for an assistant request"""
+    system_instruction = AI_SYSTEM_PROMPTS.get(task_type, AI_SYSTEM_PROMPTS['chat'])
+    
+    # Format prompt with context
+    full_prompt = f"{prompt}\n\n"
+    code_hash = None
+    if code_context:
+        language = code_context.get('language', 'text')
+        code = code_context.get('code', '')
+        full_prompt += f"Code ({language}):\n```\n{code}\n```\n"
+        code_hash = hashlib.sha256(f"{language}\0{code}".encode('utf-8')).hexdigest()
+    
+    return system_instruction, full_prompt, (provider, model, task_type, prompt, code_hash)
+
+def ai_chat(provider, model, api_key, prompt, code_context=None, task_type='chat'):
+    """AI assistant interaction"""
+    if not api_key:
+        return "Error: API Key not provided. Please configure your API key in settings."
+    if provider not in ai_providers:
+        return "Error: Unknown AI provider"
+    
+    system_instruction, full_prompt, key = build_ai_request(provider, model, prompt, code_context, task_type)
+    
+    while True:
+        cached = _ai_cache_get(key)
+        if cached is not None:
+            return cached
+        
+        # Join an identical request that is already upstream
+        with ai_lock:
+            call = ai_inflight.get(key)
+            owner = call is None
+            if owner:
+                call = ai_inflight[key] = {'done': threading.Event(), 'result': None, 'ok': False}
+        if owner:
+            break
+        if not wait_for_event(call['done'], AI_REQUEST_TIMEOUT):
+            return "AI Error: Timed out waiting for the assistant"
+        if call['ok']:
+            return call['result']
+        # The other request failed (e.g. a bad key); try with ours
+    
+    try:
+        future = submit_ai_task(provider, _ai_complete, provider, model, api_key, system_instruction, full_prompt)
+        if future is None:
+            call['result'] = "AI Error: The assistant is busy, please try again shortly"
+        else:
+            finished = threading.Event()
+            future.add_done_callback(lambda f: finished.set())
+            if not wait_for_event(finished, AI_REQUEST_TIMEOUT):
+                call['result'] = "AI Error: Timed out waiting for the assistant"
+            else:
+                call['result'] = future.result()
+                call['ok'] = True
+                _ai_cache_put(key, call['result'])
+    except Exception as e:
+        call['result'] = f"AI Error: {str(e)}"
+    finally:
+        with ai_lock:
+            ai_inflight.pop(key, None)
+        call['done'].set()
+    return call['result']
+
+def ai_stream(stream_id, sid, provider, model, api_key, prompt, code_context=None, task_type='chat'):
+    """Stream an answer to one socket as ai_chunk events followed by ai_done; returns an error or None"""
+    if not api_key:
+        return "Error: API Key not provided. Please configure your API key in settings."
+    if provider not in ai_providers:
+        return "Error: Unknown AI provider"
+    
+    system_instruction, full_prompt, key = build_ai_request(provider, model, prompt, code_context, task_type)
+    ensure_background_task('worker_notifier', worker_notifier)
+    
+    cached = _ai_cache_get(key)
+    if cached is not None:
+        worker_events.put(('ai_chunk', {'id': stream_id, 'text': cached}, sid))
+        worker_events.put(('ai_done', {'id': stream_id, 'cancelled': False, 'error': None}, sid))
+        return None
+    
+    stream = {'cancel': threading.Event()}
+    with ai_lock:
+        if (sid, stream_id) in ai_streams:
+            return "Error: Stream already running"
+        ai_streams[(sid, stream_id)] = stream
+    future = submit_ai_task(provider, _ai_stream_worker, (sid, stream_id), stream,
+                            provider, model, api_key, system_instruction, full_prompt, key)
+    if future is None:
+        with ai_lock:
+            ai_streams.pop((sid, stream_id), None)
+        return "AI Error: The assistant is busy, please try again shortly"
+    return None
+
+def _ai_stream_worker(stream_key, stream, provider, model, api_key, system_instruction, prompt, cache_key):
+    """Pull tokens from a provider and queue them in coalesced chunks; runs on the provider's pool"""
+    sid, stream_id = stream_key
+    parts = []
+    pending = []
+    pending_chars = 0
+    last_flush = 0.0  # the first tokens go out at once
+    error = None
+    started = time.perf_counter()
+    try:
+        client = get_ai_client(provider, api_key)
+        tokens = ai_providers[provider].stream(client, model, system_instruction, prompt)
+        try:
+            for text in tokens:
+                if stream['cancel'].is_set():
+                    break
+                if not text:
+                    continue
+                parts.append(text)
+                pending.append(text)
+                pending_chars += len(text)
+                now = time.monotonic()
+                if now - last_flush >= AI_STREAM_FLUSH_INTERVAL or pending_chars >= AI_STREAM_CHUNK_CHARS:
+                    worker_events.put(('ai_chunk', {'id': stream_id, 'text': ''.join(pending)}, sid))
+                    pending = []
+                    pending_chars = 0
+                    last_flush = now
+        finally:
+            # Closing the generator closes the upstream connection on cancel
+            tokens.close()
+    except Exception as e:
+        error = f"AI Error: {str(e)}"
+    finally:
+        with ai_lock:
+            ai_streams.pop(stream_key, None)
+    
+    if pending:
+        worker_events.put(('ai_chunk', {'id': stream_id, 'text': ''.join(pending)}, sid))
+    cancelled = stream['cancel'].is_set()
+    outcome = 'error' if error else 'cancelled' if cancelled else 'ok'
+    observe('codesync_ai_request_seconds', (provider, outcome), time.perf_counter() - started)
+    if error is None and not cancelled:
+        _ai_cache_put(cache_key, ''.join(parts))
+    worker_events.put(('ai_done', {'id': stream_id, 'cancelled': cancelled, 'error': error}, sid))
+
+def cancel_ai_streams(sid, stream_id=None):
+    """Cancel one of a socket's streamed answers, or all of them"""
+    cancelled = False
+    with ai_lock:
+        for (owner, key), stream in ai_streams.items():
+            if owner == sid and stream_id in (None, key):
+                stream['cancel'].set()
+                cancelled = True
+    return cancelled
+
+# ============ Code Analysis ============
+#
+# Each language has a small lexical description. A line is lexed once, from the
+# state the previous line ended in (inside a block comment or a multi-line
+# string), into a record of its kind, its decision points and any suggestion
+# flags. Totals are kept alongside the records, so after an edit only the
+# changed lines are lexed again, plus any that follow until the lexer state
+# matches the one recorded before the edit.
+
+_WILDCARD_IMPORT = 1
+_EVAL_CALL = 2
+_TODO_COMMENT = 4
+_VAR_DECLARATION = 8
+_LOOSE_EQUALITY = 16
+_LONG_LINE = 32
+
+ANALYSIS_SUGGESTIONS = [
+    (_WILDCARD_IMPORT, 'warning', 'Avoid wildcard imports (import *)'),
+    (_EVAL_CALL, 'security', 'Avoid using exec() or eval() - security risk'),
+    (_TODO_COMMENT, 'info', 'Contains TODO/FIXME comments'),
+    (_VAR_DECLARATION, 'info', 'Consider using let/const instead of var'),
+    (_LOOSE_EQUALITY, 'warning', 'Use === for strict equality comparison'),
+]
+
+_BLANK, _CODE, _COMMENT = 0, 1, 2
+
+_DQ_STRING = r'"(?:\\.|[^"\\])*"?'
+_SQ_STRING = r"'(?:\\.|[^'\\])*'?"
+_C_BLOCK = ('comment', r'/\*', r'.*?\*/')
+_OPERATORS = r'===|!==|==|!=|&&|\|\||\?\?|\?\.|\?:|->|=>|::|<=|>=|\*\*|[^\w\s]'
+
+def _analysis_syntax(line_comment=None, multiline=(), strings=(_DQ_STRING, _SQ_STRING), decisions=(),
+                     counted_ops=(), flag_words=None, flag_ops=None, flag_pairs=None, ignore_case=False,
+                     word=r'[^\W\d][\w$]*|\$[\w$]*'):
+    """Compile a language's lexical description into a single scanner"""
+    groups = [('ws', r'\s+')]
+    if line_comment:
+        groups.append(('line', f"(?:{line_comment}).*"))
+    for i, (kind, opener, closer) in enumerate(multiline):
+        groups.append((f"c{i}", opener + closer))
+        groups.append((f"u{i}", opener + '.*'))
+    for i, pattern in enumerate(strings):
+        groups.append((f"s{i}", pattern))
+    groups += [('word', word), ('num', r'\d[\w.]*'), ('op', _OPERATORS), ('other', r'\S')]
+    return {
+        'scanner': re.compile('|'.join(f"(?P<{name}>{pattern})" for name, pattern in groups)),
+        'kinds': {f"c{i}": kind for i, (kind, _, _) in enumerate(multiline)},
+        'states': {f"u{i}": (kind, re.compile(closer)) for i, (kind, _, closer) in enumerate(multiline)},
+        'decisions': frozenset(decisions),
+        'counted_ops': frozenset(counted_ops),
+        'flag_words': flag_words or {},
+        'flag_ops': flag_ops or {},
+        'flag_pairs': flag_pairs or {},
+        'ignore_case': ignore_case
+    }
+
+_C_DECISIONS = ('if', 'for', 'while', 'case')
+_C_OPS = ('&&', '||', '?')
+_JS_SYNTAX = dict(line_comment='//', multiline=(_C_BLOCK, ('string', '`', r'(?:\\.|[^\\`])*`')),
+                  decisions=_C_DECISIONS + ('catch',), counted_ops=_C_OPS,
+                  flag_words={'var': _VAR_DECLARATION}, flag_ops={'==': _LOOSE_EQUALITY, '!=': _LOOSE_EQUALITY})
+
+ANALYSIS_SYNTAX = {
+    'python': _analysis_syntax(
+        line_comment='#',
+        multiline=(('string', '"""', r'(?:\\.|[^\\])*?"""'), ('string', "'''", r"(?:\\.|[^\\])*?'''")),
+        decisions=('if', 'elif', 'for', 'while', 'except', 'and', 'or', 'case'),
+        flag_words={'exec': _EVAL_CALL, 'eval': _EVAL_CALL},
+        flag_pairs={('import', '*'): _WILDCARD_IMPORT}),
+    'javascript': _analysis_syntax(**_JS_SYNTAX),
+    'typescript': _analysis_syntax(**_JS_SYNTAX),
+    'java': _analysis_syntax(line_comment='//', multiline=(_C_BLOCK,),
+                             decisions=_C_DECISIONS + ('catch',), counted_ops=_C_OPS),
+    'c': _analysis_syntax(line_comment='//', multiline=(_C_BLOCK,), decisions=_C_DECISIONS, counted_ops=_C_OPS),
+    'cpp': _analysis_syntax(line_comment='//', multiline=(_C_BLOCK,),
+                            decisions=_C_DECISIONS + ('catch',), counted_ops=_C_OPS),
+    'go': _analysis_syntax(line_comment='//', multiline=(_C_BLOCK, ('string', '`', r'[^`]*`')),
+                           decisions=('if', 'for', 'case'), counted_ops=('&&', '||')),
+    'rust': _analysis_syntax(line_comment='//', multiline=(_C_BLOCK,),
+                             strings=(_DQ_STRING, r"'(?:\\.|[^'\\])'"),
+                             decisions=('if', 'while', 'for'), counted_ops=('&&', '||', '=>')),
+    'ruby': _analysis_syntax(line_comment='#', word=r'[^\W\d]\w*[?!]?|[@$]+\w*',
+                             decisions=('if', 'elsif', 'unless', 'while', 'until', 'for', 'when', 'rescue', 'and', 'or'),
+                             counted_ops=_C_OPS),
+    'php': _analysis_syntax(line_comment='//|#', multiline=(_C_BLOCK,),
+                            decisions=('if', 'elseif', 'for', 'foreach', 'while', 'case', 'catch', 'and', 'or'),
+                            counted_ops=_C_OPS),
+    'bash': _analysis_syntax(line_comment=r'(?<![\w$\{])#',
+                             decisions=('if', 'elif', 'for', 'while', 'until'), counted_ops=('&&', '||')),
+    'sql': _analysis_syntax(line_comment='--', multiline=(_C_BLOCK,), decisions=('when',), ignore_case=True),
+    'html': _analysis_syntax(multiline=(('comment', '<!--', r'.*?-->'),)),
+    'css': _analysis_syntax(multiline=(_C_BLOCK,)),
+}
+_PLAIN_SYNTAX = _analysis_syntax(line_comment='#')
+
+def _todo_flag(text):
+    return _TODO_COMMENT if 'TODO' in text or 'FIXME' in text else 0
+
+def _lex_line(line, syntax, state):
+    """Lex one line starting in `state`; returns ((kind, decisions, flags), end state)"""
+    has_code = has_comment = False
+    decisions = 0
+    flags = _LONG_LINE if len(line) > ANALYSIS_LONG_LINE else 0
+    pos = 0
+    
+    if state is not None:
+        kind, closer = state
+        match = closer.match(line)
+        end = match.end() if match else len(line)
+        if kind == 'comment':
+            has_comment = bool(line[:end].strip())
+            flags |= _todo_flag(line[:end])
+        else:
+            has_code = bool(line[:end].strip())
+        if match is None:
+            return ((_CODE if has_code else _COMMENT if has_comment else _BLANK), 0, flags), state
+        state = None
+        pos = end
+    
+    decision_words = syntax['decisions']
+    flag_words = syntax['flag_words']
+    flag_pairs = syntax['flag_pairs']
+    previous = None
+    for match in syntax['scanner'].finditer(line, pos):
+        group = match.lastgroup
+        if group == 'ws':
+            continue
+        token = match.group()
+        if group == 'word':
+            has_code = True
+            if syntax['ignore_case']:
+                token = token.lower()
+            if token in decision_words:
+                decisions += 1
+            flags |= flag_words.get(token, 0)
+        elif group == 'op':
+            has_code = True
+            if token in syntax['counted_ops']:
+                decisions += 1
+            flags |= syntax['flag_ops'].get(token, 0)
+            if flag_pairs:
+                flags |= flag_pairs.get((previous, token), 0)
+        elif group == 'line':
+            has_comment = True
+            flags |= _todo_flag(token)
+        elif group in syntax['states']:
+            # Unterminated block comment or string: the next line starts inside it
+            state = syntax['states'][group]
+            if state[0] == 'comment':
+                has_comment = True
+                flags |= _todo_flag(token)
+            else:
+                has_code = True
+        elif syntax['kinds'].get(group) == 'comment':
+            has_comment = True
+            flags |= _todo_flag(token)
+        else:
+            has_code = True
+        previous = token
+    
+    return ((_CODE if has_code else _COMMENT if has_comment else _BLANK), decisions, flags), state
+
+def _lex_lines(lines, syntax, state, start=0, resume_state=None):
+    """Lex lines from `start` on.
+
+    Stops early at the first line whose starting state equals
+    resume_state(line), i.e. where an earlier analysis can take over again.
+    Returns (records, starting states, state after the last lexed line).
+    """
+    records = []
+    states = []
+    for i in range(start, len(lines)):
+        if resume_state is not None and resume_state(i) == state:
+            break
+        states.append(state)
+        record, state = _lex_line(lines[i], syntax, state)
+        records.append(record)
+    return records, states, state
+
+def _tally(entry, records, sign):
+    """Add (sign=1) or remove (sign=-1) line records from an entry's totals"""
+    counts = entry['counts']
+    flag_counts = entry['flag_counts']
+    for kind, decisions, flags in records:
+        counts[kind] += sign
+        entry['decisions'] += sign * decisions
+        while flags:
+            bit = flags & -flags
+            flag_counts[bit] = flag_counts.get(bit, 0) + sign
+            flags ^= bit
+
+def _changed_lines(old_lines, new_lines):
+    """(first changed line, its end in the old lines, its end in the new lines)"""
+    limit = min(len(old_lines), len(new_lines))
+    first = 0
+    while first < limit and old_lines[first] == new_lines[first]:
+        first += 1
+    tail = 0
+    while tail < limit - first and old_lines[-1 - tail] == new_lines[-1 - tail]:
+        tail += 1
+    return first, len(old_lines) - tail, len(new_lines) - tail
+
+def _op_changed_lines(old_content, op, old_count, new_count):
+    """The lines an op touches, in the same form as _changed_lines"""
+    pos = 0
+    start = end = None
+    for component in op:
+        if isinstance(component, int):
+            pos += component
+            continue
+        if start is None:
+            start = pos
+        if isinstance(component, dict):
+            pos += component['d']
+        end = pos
+    if start is None:
+        return 0, 0, 0
+    before, rest = split_utf16(old_content, start)
+    first = before.count('\n')
+    old_end = first + split_utf16(rest, end - start)[0].count('\n') + 1
+    return first, old_end, old_end + new_count - old_count
+
+def _content_hash(content):
+    return hashlib.sha256(content.encode('utf-8', 'surrogatepass')).hexdigest()
+
+def _new_analysis_entry(content, language):
+    """Analyze content from scratch"""
+    syntax = ANALYSIS_SYNTAX.get(language, _PLAIN_SYNTAX)
+    lines = content.split('\n')
+    records, states, state = _lex_lines(lines, syntax, None)
+    entry = {
+        'hash': _content_hash(content),
+        'content': content,
+        'lines': lines,
+        'syntax': syntax,
+        'records': records,
+        'states': states + [state],  # lexer state at the start of each line, then at the end
+        'counts': [0, 0, 0],  # blank, code and comment lines
+        'decisions': 0,
+        'flag_counts': {}
+    }
+    _tally(entry, records, 1)
+    return entry
+
+def _update_analysis_entry(entry, content, delta=None):
+    """Lex again only what changed between an entry's content and `content`"""
+    lines = content.split('\n')
+    old_lines = entry['lines']
+    region = None
+    if delta is not None:
+        try:
+            if apply_text_op(entry['content'], delta) == content:
+                region = _op_changed_lines(entry['content'], delta, len(old_lines), len(lines))
+        except (ValueError, TypeError, KeyError):
+            pass
+    if region is None:
+        region = _changed_lines(old_lines, lines)
+    first, old_end, new_end = region
+    
+    # Past the edit, stop as soon as a line starts in the state it had before
+    old_states = entry['states']
+    shift = old_end - new_end
+    records, states, state = _lex_lines(lines, entry['syntax'], old_states[first], first,
+                                        lambda i: old_states[i + shift] if i >= new_end else ())
+    stop = first + len(records) + shift
+    
+    _tally(entry, entry['records'][first:stop], -1)
+    _tally(entry, records, 1)
+    entry['records'][first:stop] = records
+    old_states[first:stop] = states
+    if stop == len(old_lines):
+        old_states[-1] = state
+    entry['lines'] = lines
+    entry['content'] = content
+    entry['hash'] = _content_hash(content)
+    return entry
+
+def _analysis_report(entry):
+    """Metrics and suggestions from an entry's totals"""
+    blank, code, comment = entry['counts']
+    complexity = 1 + entry['decisions']
+    analysis = {
+        'total_lines': len(entry['records']),
+        'code_lines': code,
+        'blank_lines': blank,
+        'comment_lines': comment,
+        'cyclomatic_complexity': complexity,
+        'complexity_rating': 'Low' if complexity < 10 else 'Medium' if complexity < 20 else 'High'
+    }
+    
+    flag_counts = entry['flag_counts']
+    suggestions = [{'type': kind, 'message': message}
+                   for flag, kind, message in ANALYSIS_SUGGESTIONS if flag_counts.get(flag)]
+    if flag_counts.get(_LONG_LINE):
+        long_lines = list(itertools.islice(
+            (i + 1 for i, record in enumerate(entry['records']) if record[2] & _LONG_LINE), 5))
+        suggestions.append({'type': 'style', 'message': f'Long lines detected: {long_lines}'})
+    return analysis, suggestions
+
+def _with_analysis(code, language, key, delta, read):
+    """Bring the cached analysis of code up to date and return read(entry)"""
+    code_hash = _content_hash(code)
+    cache_key = (key if key is not None else code_hash, language)
+    with analysis_lock:
+        # Taken out while in use, so concurrent requests never share an entry
+        entry = analysis_cache.pop(cache_key, None)
+    
+    if entry is None:
+        entry = _new_analysis_entry(code, language)
+        entry['report'] = _analysis_report(entry)
+    elif entry['hash'] != code_hash:
+        entry = _update_analysis_entry(entry, code, delta)
+        entry['report'] = _analysis_report(entry)
+    
+    result = read(entry)
+    with analysis_lock:
+        analysis_cache[cache_key] = entry
+        while len(analysis_cache) > ANALYSIS_CACHE_SIZE:
+            analysis_cache.popitem(last=False)
+    return result
+
+def analyze_code(code, language, key=None, delta=None):
+    """Metrics and suggestions for code, cached per (key, language).
+
+    key identifies the file, e.g. (room, filename); when an analysis of an
+    earlier version is cached, only the changed lines are lexed again. delta
+    may be the op that turned the cached content into `code`, which saves
+    searching for the change.
+    """
+    return _with_analysis(code, language, key, delta, lambda entry: entry['report'])
+
+def flagged_lines(code, language, key=None, delta=None, limit=100):
+    """(line number, flags) of up to `limit` lines that carry suggestion flags"""
+    def read(entry):
+        if not any(entry['flag_counts'].values()):
+            return []
+        return list(itertools.islice(
+            ((i + 1, record[2]) for i, record in enumerate(entry['records']) if record[2]), limit))
+    return _with_analysis(code, language, key, delta, read)
+
+def analyze_code_complexity(code, language):
+    """Analyze code complexity metrics"""
+    return analyze_code(code, language)[0]
+
+def get_code_suggestions(code, language):
+    """Get automated code suggestions"""
+    return analyze_code(code, language)[1]
+
+# ============ Diagnostics ============
+#
+# Edits and saves schedule a lint of the file once they have paused for
+# DIAGNOSTICS_DELAY. Lints run on their own thread pool: the analyzer's checks
+# first, then any external linters registered for the language. A newer edit
+# makes a running lint stale, which stops it (killing a linter process if need
+# be). Rooms are sent only the diagnostics added and removed since the last push.
+
+def make_diagnostic(source, line, message, severity='warning', column=None):
+    """A diagnostic whose id stays the same for as long as it applies"""
+    ident = hashlib.sha1(f"{source}\0{line}\0{column}\0{message}".encode('utf-8')).hexdigest()[:16]
+    return {'id': ident, 'source': source, 'line': line, 'column': column,
+            'severity': severity, 'message': message}
+
+class AnalysisLinter:
+    """The analyzer's suggestion checks, reported on the lines they apply to"""
+
+    name = 'codesync'
+    severities = {'warning': 'warning', 'security': 'warning', 'info': 'info', 'style': 'info'}
+
+    def lint(self, content, job):
+        diagnostics = []
+        for line, flags in flagged_lines(content, job['language'], (job['room'], job['file']), job['delta']):
+            for flag, kind, message in ANALYSIS_SUGGESTIONS:
+                if flags & flag:
+                    diagnostics.append(make_diagnostic(self.name, line, message, self.severities[kind]))
+            if flags & _LONG_LINE:
+                diagnostics.append(make_diagnostic(
+                    self.name, line, f"Line is longer than {ANALYSIS_LONG_LINE} characters", 'info'))
+        return diagnostics
+
+class ExternalLinter:
+    """A command-line checker run on a temporary copy of the file.
+
+    pattern is matched against each output line and needs `line` and
+    `message` groups; `column` and `severity` groups are optional.
+    """
+
+    def __init__(self, name, command, pattern, severity='warning'):
+        self.name = name
+        self.command = command
+        self.pattern = re.compile(pattern, re.MULTILINE)
+        self.severity = severity
+
+    def lint(self, content, job):
+        tmpdir = tempfile.mkdtemp(prefix='codesync_lint_')
+        try:
+            path = os.path.join(tmpdir, os.path.basename(job['file']))
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            proc = subprocess.Popen([part.replace('{file}', path) for part in self.command], cwd=tmpdir,
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    text=True, errors='replace')
+            deadline = time.time() + DIAGNOSTICS_TIMEOUT
+            while True:
+                try:
+                    output = proc.communicate(timeout=0.1)[0]
+                    break
+                except subprocess.TimeoutExpired:
+                    if job['stale']() or time.time() > deadline:
+                        proc.kill()
+                        proc.communicate()
+                        return None if job['stale']() else []
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        
+        diagnostics = []
+        for match in self.pattern.finditer(output):
+            groups = match.groupdict()
+            diagnostics.append(make_diagnostic(
+                self.name, int(groups['line']), groups['message'].strip(),
+                groups.get('severity') or self.severity,
+                int(groups['column']) if groups.get('column') else None))
+        return diagnostics
+
+diagnostic_linters = defaultdict(list)  # language -> linters, run in order
 
-# ============ AI Features ============
+def register_linter(language, linter):
+    """Run a linter on files of a language after they change"""
+    diagnostic_linters[language].append(linter)
 
-def ai_chat(provider, model, api_key, prompt, code_context=None, task_type='chat'):
-    """AI assistant interaction"""
-    if not api_key:
-        return "Error: API Key not provided. Please configure your API key in settings."
-    
-    system_prompts = {
-        'chat': "You are an intelligent coding assistant. Be helpful, concise, and professional.",
-        'explain': "Explain the following code clearly and concisely. Break down complex logic.",
-        'debug': "Analyze the code for bugs, errors, or issues. Provide specific fixes.",
-        'optimize': "Suggest optimizations for performance, readability, or best practices.",
-        'complete': "Complete the code intelligently. Return only the code completion.",
-        'refactor': "Refactor the code to improve structure, readability, and maintainability.",
-        'document': "Add comprehensive documentation and comments to the code.",
-        'test': "Generate unit tests for the code.",
-        'convert': "Convert the code to the requested language while maintaining functionality."
-    }
-    
-    system_instruction = system_prompts.get(task_type, system_prompts['chat'])
-    
-    # Format prompt with context
-    full_prompt = f"{prompt}\n\n"
-    if code_context:
-        full_prompt += f"Code ({code_context.get('language', 'text')}):\n```\n{code_context.get('code', '')}\n```\n"
+for _language in LANGUAGE_CONFIG:
+    register_linter(_language, AnalysisLinter())
+if pyflakes is not None:
+    register_linter('python', ExternalLinter(
+        'pyflakes', [sys.executable, '-m', 'pyflakes', '{file}'],
+        r'^.+?:(?P<line>\d+):(?:(?P<column>\d+):?)? (?P<message>.+)$'))
+if shutil.which('bash'):
+    register_linter('bash', ExternalLinter(
+        'bash', ['bash', '-n', '{file}'], r'^.+?: line (?P<line>\d+): (?P<message>.+)$', 'error'))
+if shutil.which('ruby'):
+    register_linter('ruby', ExternalLinter(
+        'ruby', ['ruby', '-wc', '{file}'],
+        r'^.+?:(?P<line>\d+): (?:(?P<severity>warning): )?(?P<message>.+)$', 'error'))
+if shutil.which('php'):
+    register_linter('php', ExternalLinter(
+        'php', ['php', '-l', '{file}'],
+        r'^(?:PHP )?(?P<message>(?:Parse|Fatal) error: .+?) in .+ on line (?P<line>\d+)$', 'error'))
+
+def schedule_diagnostics(room_id, filename, op=None):
+    """Lint a file once edits to it pause; op is the edit, when known"""
+    key = (room_id, filename)
+    with diagnostics_lock:
+        pending = diagnostics_pending.get(key)
+        if pending is None:
+            pending = diagnostics_pending[key] = {'delta': op}
+        elif pending['delta'] is not None and op is not None:
+            try:
+                pending['delta'] = compose_text_ops(pending['delta'], op)
+            except ValueError:
+                pending['delta'] = None
+        else:
+            pending['delta'] = None
+        pending['due'] = time.time() + DIAGNOSTICS_DELAY
+        # Makes any lint of this file that is already running stale
+        diagnostics_generation[key] = diagnostics_generation.get(key, 0) + 1
     
+    ensure_background_task('diagnostics_scheduler', diagnostics_scheduler)
+    ensure_background_task('worker_notifier', worker_notifier)
+
+def diagnostics_scheduler():
+    """Background task: start lints for files whose edits have settled"""
+    while True:
+        now = time.time()
+        jobs = []
+        with diagnostics_lock:
+            for key, pending in list(diagnostics_pending.items()):
+                if pending['due'] <= now and key not in diagnostics_running:
+                    del diagnostics_pending[key]
+                    diagnostics_running.add(key)
+                    jobs.append((key, pending['delta'], diagnostics_generation.get(key, 0)))
+        for (room_id, filename), delta, generation in jobs:
+            try:
+                diagnostics_executor.submit(run_diagnostics, room_id, filename, delta, generation)
+            except RuntimeError:
+                return  # the pool was shut down: the process is exiting
+        socketio.sleep(0.1)
+
+def _diagnostics_source(room_id, filename):
+    """(content, revision) to lint: the live document if there is one, else the file"""
+    with state_backend.room_lock(room_id):
+        if (room_id, filename) in documents:
+            doc = get_document(room_id, filename)
+            if doc is not None:
+                return doc['content'], doc['revision']
+    content = read_file_from_disk(room_id, filename)
+    if content == "[Binary file - cannot display]":
+        return None, None
+    return content, None
+
+def run_diagnostics(room_id, filename, delta, generation):
+    """Lint a file and push the changes to its room; runs on the diagnostics pool"""
+    key = (room_id, filename)
+    stale = lambda: diagnostics_generation.get(key) != generation
     try:
-        if provider == 'gemini':
-            import google.generativeai as genai
-            genai.configure(api_key=api_key)
-            model_instance = genai.GenerativeModel(model)
-            response = model_instance.generate_content(f"{system_instruction}\n\n{full_prompt}")
-            return response.text
-            
-        elif provider == 'openai':
-            import openai
-            client = openai.OpenAI(api_key=api_key)
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_instruction},
-                    {"role": "user", "content": full_prompt}
-                ]
-            )
-            return response.choices[0].message.content
-            
-        elif provider == 'anthropic':
-            import anthropic
-            client = anthropic.Anthropic(api_key=api_key)
-            response = client.messages.create(
-                model=model,
-                max_tokens=2048,
-                messages=[{"role": "user", "content": full_prompt}],
-                system=system_instruction
-            )
-            return response.content[0].text
-            
-        return "Error: Unknown AI provider"
+        content, revision = _diagnostics_source(room_id, filename)
+        if content is None:
+            return
         
-    except Exception as e:
-        return f"AI Error: {str(e)}"
+        job = {'room': room_id, 'file': filename, 'language': detect_language(filename),
+               'delta': delta, 'stale': stale}
+        diagnostics = []
+        for linter in diagnostic_linters.get(job['language'], ()):
+            if stale():
+                return
+            try:
+                found = linter.lint(content, job)
+            except Exception as e:
+                app.logger.warning("Linter %s failed on %s: %s", linter.name, filename, e)
+                continue
+            if found is None:
+                return
+            diagnostics.extend(found)
+        
+        if not stale():
+            publish_diagnostics(room_id, filename, revision, diagnostics)
+    finally:
+        with diagnostics_lock:
+            diagnostics_running.discard(key)
 
-def analyze_code_complexity(code, language):
-    """Analyze code complexity metrics"""
-    lines = code.split('\n')
-    total_lines = len(lines)
-    code_lines = len([l for l in lines if l.strip() and not l.strip().startswith(LANGUAGE_CONFIG.get(language, {}).get('comment', '#'))])
-    blank_lines = len([l for l in lines if not l.strip()])
-    
-    # Simple cyclomatic complexity (count decision points)
-    decision_keywords = ['if', 'else', 'elif', 'for', 'while', 'switch', 'case', 'catch', '&&', '||', '?']
-    complexity = 1  # Base complexity
-    for keyword in decision_keywords:
-        complexity += code.lower().count(keyword)
+def publish_diagnostics(room_id, filename, revision, diagnostics):
+    """Record a file's diagnostics and send its room what was added and removed"""
+    current = {diagnostic['id']: diagnostic for diagnostic in diagnostics}
+    with diagnostics_lock:
+        previous = diagnostics_results.get((room_id, filename), {}).get('items', {})
+        diagnostics_results[(room_id, filename)] = {'revision': revision, 'items': current}
     
-    return {
-        'total_lines': total_lines,
-        'code_lines': code_lines,
-        'blank_lines': blank_lines,
-        'comment_lines': total_lines - code_lines - blank_lines,
-        'cyclomatic_complexity': complexity,
-        'complexity_rating': 'Low' if complexity < 10 else 'Medium' if complexity < 20 else 'High'
-    }
+    added = [diagnostic for ident, diagnostic in current.items() if ident not in previous]
+    removed = [ident for ident in previous if ident not in current]
+    if added or removed:
+        worker_events.put(('diagnostics', {
+            'file': filename,
+            'revision': revision,
+            'added': added,
+            'removed': removed
+        }, room_id))
 
-def get_code_suggestions(code, language):
-    """Get automated code suggestions"""
-    suggestions = []
-    
-    # Check for common issues
-    if language == 'python':
-        if 'import *' in code:
-            suggestions.append({'type': 'warning', 'message': 'Avoid wildcard imports (import *)'})
-        if re.search(r'\bexec\b|\beval\b', code):
-            suggestions.append({'type': 'security', 'message': 'Avoid using exec() or eval() - security risk'})
-        if 'TODO' in code or 'FIXME' in code:
-            suggestions.append({'type': 'info', 'message': 'Contains TODO/FIXME comments'})
-    
-    if language == 'javascript':
-        if 'var ' in code:
-            suggestions.append({'type': 'info', 'message': 'Consider using let/const instead of var'})
-        if '==' in code and '===' not in code:
-            suggestions.append({'type': 'warning', 'message': 'Use === for strict equality comparison'})
-    
-    # Check line length
-    long_lines = [i+1 for i, line in enumerate(code.split('\n')) if len(line) > 100]
-    if long_lines:
-        suggestions.append({'type': 'style', 'message': f'Long lines detected: {long_lines[:5]}'})
-    
-    return suggestions
+def forget_diagnostics(room_id, filename=None):
+    """Drop what is known about a file's diagnostics (every file's, without a filename)"""
+    with diagnostics_lock:
+        for table in (diagnostics_pending, diagnostics_generation, diagnostics_results):
+            if filename is not None:
+                table.pop((room_id, filename), None)
+            else:
+                for key in [key for key in table if key[0] == room_id]:
+                    del table[key]
+
+def get_diagnostics(room_id, filename):
+    """Latest diagnostics for a file as (revision, list); schedules a lint if there are none"""
+    with diagnostics_lock:
+        result = diagnostics_results.get((room_id, filename))
+    if result is None:
+        schedule_diagnostics(room_id, filename)
+        return None, []
+    return result['revision'], sorted(result['items'].values(), key=lambda d: (d['line'], d['source']))
 
 # ============ Room Settings ============
+#
+# Settings are cached per room (least recently used rooms are dropped) and
+# written through to disk atomically. Each save bumps a version stored in the
+# file, which doubles as the settings ETag. A cached entry is re-validated
+# against the file's mtime every few seconds to pick up other workers' saves.
 
-def get_room_settings(room_id):
-    """Get room settings"""
+DEFAULT_SETTINGS = {
+    'theme': 'monokai',
+    'font_size': 14,
+    'tab_size': 4,
+    'auto_save': True
+}
+
+def _settings_signature(path):
+    """mtime and size of a settings file, None if it doesn't exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _settings_entry(room_id):
+    """Cached settings entry for a room; caller holds settings_lock"""
+    entry = settings_cache.get(room_id)
+    now = time.time()
+    if entry is not None:
+        settings_cache.move_to_end(room_id)
+        if now - entry['checked'] < SETTINGS_CHECK_INTERVAL:
+            return entry
+        entry['checked'] = now
+        if _settings_signature(get_settings_path(room_id)) == entry['signature']:
+            return entry
+    
     settings_path = get_settings_path(room_id)
-    if os.path.exists(settings_path):
+    signature = _settings_signature(settings_path)
+    settings = dict(DEFAULT_SETTINGS)
+    if signature is not None:
         try:
             with open(settings_path, 'r') as f:
-                return json.load(f)
+                settings = json.load(f)
         except Exception:
             pass
-    
-    return {
-        'theme': 'monokai',
-        'font_size': 14,
-        'tab_size': 4,
-        'auto_save': True
+    return _cache_settings(room_id, settings, signature)
+
+def _cache_settings(room_id, settings, signature):
+    """Store a room's settings in the cache, evicting the least recently used room"""
+    entry = {
+        'settings': settings,
+        'version': settings.get('version', 0),
+        'signature': signature,
+        'checked': time.time()
     }
+    settings_cache[room_id] = entry
+    settings_cache.move_to_end(room_id)
+    while len(settings_cache) > SETTINGS_CACHE_SIZE:
+        settings_cache.popitem(last=False)
+    return entry
+
+def get_room_settings(room_id):
+    """Get room settings"""
+    with settings_lock:
+        return dict(_settings_entry(room_id)['settings'])
+
+def get_room_settings_version(room_id):
+    """Get room settings with their version"""
+    with settings_lock:
+        entry = _settings_entry(room_id)
+        return dict(entry['settings']), entry['version']
 
 def save_room_settings(room_id, settings):
-    """Save room settings"""
+    """Save room settings; returns the new version, or None on failure"""
     settings_path = get_settings_path(room_id)
-    try:
-        with open(settings_path, 'w') as f:
-            json.dump(settings, f, indent=2)
-        return True
-    except Exception:
-        return False
+    with settings_lock:
+        settings = dict(settings, version=_settings_entry(room_id)['version'] + 1)
+        try:
+            atomic_write(settings_path, json.dumps(settings, indent=2))
+        except Exception:
+            return None
+        _cache_settings(room_id, settings, _settings_signature(settings_path))
+    return settings['version']
 
 # ============ Code Snippets ============
 
@@ -605,6 +4510,440 @@ def get_snippets(language):
     
     return default_snippets.get(language, [])
 
+# ============ Presence ============
+#
+# Cursor and selection updates only record the latest state per sid. A ticker
+# sends one batched presence frame per room at PRESENCE_TICK_RATE, leaving out
+# entries that did not change and holding back clients over their own rate.
+
+def update_presence(room_id, sid, **fields):
+    """Record a user's latest cursor/selection for the next presence tick"""
+    user = room_users.get(room_id, {}).get(sid)
+    if user is None:
+        return
+    user.update(fields)
+    presence_dirty[room_id].add(sid)
+    ensure_background_task('presence_ticker', presence_ticker)
+
+def collect_presence(room_id, now):
+    """Build the presence entries due for a room and requeue throttled ones"""
+    sids = presence_dirty.pop(room_id, None)
+    users = room_users.get(room_id)
+    if not sids or not users:
+        return []
+    
+    entries = []
+    deferred = set()
+    for sid in sids:
+        user = users.get(sid)
+        if user is None:
+            continue
+        if now - user['presence_sent'] < user['presence_interval']:
+            deferred.add(sid)
+            continue
+        
+        state = (user.get('file'), user['cursor'], user.get('selection'))
+        if state == user.get('presence_last'):
+            continue
+        user['presence_last'] = state
+        user['presence_sent'] = now
+        entries.append({
+            'sid': sid,
+            'username': user['username'],
+            'color': user['color'],
+            'file': user.get('file'),
+            'cursor': user['cursor'],
+            'selection': user.get('selection')
+        })
+    
+    if deferred:
+        presence_dirty[room_id].update(deferred)
+    return entries
+
+def presence_ticker():
+    """Background task: broadcast one presence frame per room per tick"""
+    while True:
+        socketio.sleep(1.0 / PRESENCE_TICK_RATE)
+        now = time.time()
+        for room_id in list(presence_dirty):
+            entries = collect_presence(room_id, now)
+            if entries:
+                for entry in entries:
+                    state_backend.set_presence(room_id, entry['sid'], entry)
+                socketio.emit('presence', {'users': entries}, room=room_id)
+
+# ============ Terminal Sessions ============
+#
+# Each room gets one long-lived shell on a PTY, so `cd`, variables and running
+# programs persist between commands. A background task drains every session
+# without blocking and sends its output to the room in batches.
+
+TERMINAL_SAFE_COMMANDS = [
+    'ls', 'dir', 'pwd', 'cd', 'echo', 'cat', 'grep', 'wc', 'head', 'tail', 
+    'mkdir', 'rm', 'touch', 'mv', 'cp', 
+    'python', 'python3', 'py', 'node', 'npm', 'npx',
+    'java', 'javac', 'gcc', 'g++', 'go', 'cargo', 'rustc', 'ruby', 'php', 
+    'git', 'pip', 'whoami', 'date'
+]
+
+def is_safe_terminal_command(command):
+    """Check that a command line starts with one of the allowed programs"""
+    cmd_parts = command.strip().split()
+    if not cmd_parts:
+        return False
+    # Cross-platform friendly: compare without directory or an extension like .exe
+    base_cmd = os.path.splitext(os.path.basename(cmd_parts[0]))[0]
+    return base_cmd in TERMINAL_SAFE_COMMANDS or cmd_parts[0] in TERMINAL_SAFE_COMMANDS
+
+def run_terminal_command(room_id, command):
+    """Run one command to completion (used where PTYs are unavailable)"""
+    if not is_safe_terminal_command(command):
+        cmd_parts = command.strip().split()
+        return f"Command '{cmd_parts[0] if cmd_parts else ''}' not in allowed list."
+    try:
+        result = subprocess.run(
+            command,
+            shell=True,
+            capture_output=True,
+            text=True,
+            timeout=10,
+            cwd=get_room_path(room_id)
+        )
+        return result.stdout + result.stderr
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+def open_terminal(room_id):
+    """Start a room's PTY shell; returns (session, None) or (None, error message)"""
+    if len(active_terminals) >= TERMINAL_MAX_SESSIONS:
+        return None, "Too many terminal sessions are open on this server, try again later"
+    if not state_backend.claim_terminal(room_id, WORKER_ID):
+        return None, "This room's terminal is attached to another server worker"
+    
+    cwd = os.path.abspath(get_room_path(room_id))
+    ensure_dir(cwd)
+    if shutil.which('bash'):
+        argv = ['bash', '--noprofile', '--norc', '--noediting', '-i']
+    else:
+        argv = ['sh', '-i']
+    env = dict(os.environ, TERM='dumb', PS1='$ ', PS2='> ')
+    
+    try:
+        pid, fd = pty.fork()
+    except OSError as e:
+        state_backend.release_terminal(room_id, WORKER_ID)
+        return None, f"Error: {str(e)}"
+    if pid == 0:
+        try:
+            os.chdir(cwd)
+            os.execvpe(argv[0], argv, env)
+        finally:
+            os._exit(127)
+    
+    os.set_blocking(fd, False)
+    session = {
+        'pid': pid,
+        'fd': fd,
+        'started': time.time(),
+        'last_activity': time.time(),
+        'decoder': codecs.getincrementaldecoder('utf-8')(errors='replace')
+    }
+    active_terminals[room_id] = session
+    ensure_background_task('terminal_reader', terminal_reader)
+    return session, None
+
+def write_terminal(session, data):
+    """Send input to a session's PTY"""
+    session['last_activity'] = time.time()
+    data = data.encode('utf-8')
+    while data:
+        try:
+            written = os.write(session['fd'], data)
+        except BlockingIOError:
+            socketio.sleep(TERMINAL_FLUSH_INTERVAL)
+            continue
+        except OSError:
+            return
+        data = data[written:]
+
+def shell_in_foreground(session):
+    """True when the shell itself (not a program it started) is reading input"""
+    try:
+        return os.tcgetpgrp(session['fd']) == session['pid']
+    except OSError:
+        return True
+
+def close_terminal(room_id):
+    """Kill a room's shell and everything it started"""
+    session = active_terminals.pop(room_id, None)
+    if session is None:
+        return
+    try:
+        os.killpg(session['pid'], signal.SIGKILL)
+    except OSError:
+        pass
+    try:
+        os.close(session['fd'])
+    except OSError:
+        pass
+    try:
+        os.waitpid(session['pid'], 0)
+    except ChildProcessError:
+        pass
+    state_backend.release_terminal(room_id, WORKER_ID)
+
+def close_all_terminals():
+    """Shut down every terminal session on this worker"""
+    for room_id in list(active_terminals):
+        close_terminal(room_id)
+
+def terminal_reader():
+    """Background task: batch PTY output to rooms and reap exited or idle sessions"""
+    while True:
+        now = time.time()
+        for room_id, session in list(active_terminals.items()):
+            chunks = []
+            size = 0
+            ended = False
+            while size < TERMINAL_BATCH_BYTES:
+                try:
+                    data = os.read(session['fd'], TERMINAL_BATCH_BYTES - size)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    # EIO: the shell and everything holding the PTY have exited
+                    data = b''
+                if not data:
+                    ended = True
+                    break
+                chunks.append(data)
+                size += len(data)
+            
+            if chunks:
+                session['last_activity'] = now
+                output = session['decoder'].decode(b''.join(chunks))
+                if output:
+                    socketio.emit('terminal_output', {'output': output}, room=room_id)
+            
+            if ended:
+                close_terminal(room_id)
+                socketio.emit('terminal_output', {'output': "\n[Terminal session ended]\n"}, room=room_id)
+            elif now - session['last_activity'] > TERMINAL_IDLE_TIMEOUT:
+                close_terminal(room_id)
+                socketio.emit('terminal_output', {'output': "\n[Terminal closed after being idle]\n"}, room=room_id)
+        
+        socketio.sleep(TERMINAL_FLUSH_INTERVAL)
+
+# ============ Room Lifecycle ============
+#
+# Each sid's rooms are indexed, so a disconnect only visits the rooms that sid
+# is in, and one socket may belong to several rooms. When a room's last user
+# on this worker leaves, its user table goes at once. A reaper also notices
+# rooms that were only used over HTTP. Once a room has gone ROOM_IDLE_GRACE
+# without local users, lock use or document access, _release_room frees
+# everything this worker keeps in memory for it. Room locks count their
+# holders, so a lock is never dropped while a thread is waiting on it.
+
+@contextmanager
+def local_room_lock(room_id):
+    """Hold a room's in-process lock"""
+    with room_locks_guard:
+        entry = room_locks.get(room_id)
+        if entry is None:
+            entry = room_locks[room_id] = {'lock': threading.Lock(), 'holders': 0, 'used': 0}
+            ensure_background_task('room_reaper', room_reaper)
+        entry['holders'] += 1
+    try:
+        with entry['lock']:
+            yield
+    finally:
+        with room_locks_guard:
+            entry['holders'] -= 1
+            entry['used'] = time.time()
+
+def add_room_user(room_id, sid, user):
+    """Put a sid in a room on this worker"""
+    with membership_lock:
+        room_users.setdefault(room_id, {})[sid] = user
+        sid_rooms.setdefault(sid, set()).add(room_id)
+        empty_rooms.pop(room_id, None)
+    ensure_background_task('room_reaper', room_reaper)
+
+def remove_room_user(room_id, sid):
+    """Take a sid out of a room on this worker; returns its user record, or None if it wasn't there"""
+    with membership_lock:
+        users = room_users.get(room_id)
+        user = users.pop(sid, None) if users else None
+        if user is None:
+            return None
+        rooms = sid_rooms.get(sid)
+        if rooms is not None:
+            rooms.discard(room_id)
+            if not rooms:
+                del sid_rooms[sid]
+        if not users:
+            del room_users[room_id]
+            empty_rooms[room_id] = time.time()
+    state_backend.remove_member(room_id, sid)
+    return user
+
+def forget_room_metrics(room_id):
+    """Drop a room's per-room metric series"""
+    with metrics_lock:
+        for key in [key for key in metric_counters if key[1] == (room_id,) and METRICS[key[0]][1] == ('room',)]:
+            del metric_counters[key]
+
+def _known_rooms():
+    """Every room this worker keeps some in-memory state for"""
+    rooms = set(room_users) | set(empty_rooms) | set(room_locks) | set(journal_locks) | set(journal_writers)
+    rooms |= set(active_terminals) | set(presence_dirty) | set(file_indexes) | set(search_indexes)
+    rooms |= set(settings_cache) | set(created_rooms)
+    rooms |= {room_id for room_id, _ in list(documents)} | {room_id for room_id, _ in list(line_indexes)}
+    with search_texts_lock:
+        rooms |= {room_id for room_id, _ in search_texts}
+    with diagnostics_lock:
+        for table in (diagnostics_pending, diagnostics_generation, diagnostics_results):
+            rooms |= {room_id for room_id, _ in table}
+    return rooms
+
+def _room_in_use(room_id, now):
+    """Whether a room without local users still had its lock or documents used within ROOM_IDLE_GRACE"""
+    with room_locks_guard:
+        entry = room_locks.get(room_id)
+        if entry is not None and (entry['holders'] or now - entry['used'] < ROOM_IDLE_GRACE):
+            return True
+    return any(key[0] == room_id and now - doc['last_access'] < ROOM_IDLE_GRACE
+               for key, doc in list(documents.items()))
+
+def _release_room(room_id):
+    """Free everything this worker keeps in memory for a room"""
+    # Live documents are written back before they are dropped
+    for key in [key for key in documents if key[0] == room_id]:
+        flush_document(*key)
+        with state_backend.room_lock(room_id):
+            doc = documents.get(key)
+            if doc is not None and not doc['dirty']:
+                del documents[key]
+                state_backend.expire_document(room_id, key[1], ROOM_IDLE_GRACE)
+    
+    # Another worker's users may still be using this worker's shell
+    if room_id in active_terminals and not state_backend.room_members(room_id):
+        close_terminal(room_id)
+    
+    presence_dirty.pop(room_id, None)
+    forget_diagnostics(room_id)
+    forget_room_metrics(room_id)
+    with file_index_lock:
+        file_indexes.pop(room_id, None)
+    with search_lock:
+        search_indexes.pop(room_id, None)
+    forget_search_texts(room_id)
+    forget_journal_writer(room_id)
+    with line_index_lock:
+        for key in [key for key in line_indexes if key[0] == room_id]:
+            del line_indexes[key]
+    with settings_lock:
+        settings_cache.pop(room_id, None)
+    created_rooms.discard(room_id)
+    with room_locks_guard:
+        entry = room_locks.get(room_id)
+        if entry is not None and not entry['holders']:
+            del room_locks[room_id]
+
+def reclaim_rooms(now):
+    """Release rooms that have gone ROOM_IDLE_GRACE without being used; returns how many were released"""
+    known = _known_rooms()
+    with membership_lock:
+        for room_id in known:
+            if room_id not in room_users:
+                empty_rooms.setdefault(room_id, now)
+        idle = [room_id for room_id, since in empty_rooms.items() if now - since >= ROOM_IDLE_GRACE]
+    
+    released = 0
+    for room_id in idle:
+        if _room_in_use(room_id, now):
+            with membership_lock:
+                if room_id in empty_rooms:
+                    empty_rooms[room_id] = now
+            continue
+        with membership_lock:
+            if room_id in room_users or empty_rooms.pop(room_id, None) is None:
+                continue
+        _release_room(room_id)
+        released += 1
+    
+    if released:
+        count_metric('codesync_rooms_reclaimed_total', (), released)
+    return released
+
+def room_reaper():
+    """Background task: release rooms nobody is using"""
+    while True:
+        socketio.sleep(ROOM_IDLE_GRACE / 2)
+        reclaim_rooms(time.time())
+
+def tracked_room_count():
+    """Rooms this worker holds any state for"""
+    return len(_known_rooms())
+
+# ============ HTTP Caching ============
+#
+# File content and listings carry strong ETags so clients can revalidate with
+# If-None-Match, and larger bodies are compressed with the best encoding the
+# client accepts. Compressed file bodies are cached by ETag, so hot files are
+# compressed once per revision.
+
+def _compress(body, encoding):
+    """Compress a response body"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+def _cached_compress(cache_key, etag, encoding, body):
+    """Compress a body, reusing an earlier result for the same ETag"""
+    key = (cache_key, etag, encoding)
+    with compressed_bodies_lock:
+        data = compressed_bodies.get(key)
+        if data is not None:
+            compressed_bodies.move_to_end(key)
+            return data
+    
+    data = _compress(body, encoding)
+    with compressed_bodies_lock:
+        if key not in compressed_bodies:
+            compressed_bodies[key] = data
+            compressed_bodies_size[0] += len(data)
+        while compressed_bodies_size[0] > COMPRESS_CACHE_BYTES:
+            _, dropped = compressed_bodies.popitem(last=False)
+            compressed_bodies_size[0] -= len(dropped)
+    return data
+
+def not_modified(etag):
+    """True if the request already holds this ETag"""
+    return request.if_none_match.contains(etag)
+
+def conditional_json(payload, etag, headers=None, cache_key=None):
+    """JSON response with a strong ETag, 304 handling and negotiated compression"""
+    if not_modified(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(payload)
+        body = response.get_data()
+        encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+        encoding = request.accept_encodings.best_match(encodings) if len(body) >= COMPRESS_MIN_BYTES else None
+        if encoding:
+            if cache_key is not None:
+                response.set_data(_cached_compress(cache_key, etag, encoding, body))
+            else:
+                response.set_data(_compress(body, encoding))
+            response.headers['Content-Encoding'] = encoding
+    
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers.update(headers or {})
+    return response
+
 # ============ Flask Routes ============
 
 @app.route('/')
@@ -621,33 +4960,101 @@ def room(room_id):
 # File operations
 @app.route('/api/files/<room_id>')
 def get_files(room_id):
-    """List files in room"""
-    return jsonify(list_files(room_id))
+    """List files in room; ?prefix=, ?offset=, ?limit= page it and ?version= makes it conditional"""
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        return jsonify({"error": "offset and limit must be integers"}), 400
+    
+    files, total, version = list_files(room_id, request.args.get('prefix', ''), offset, limit)
+    headers = {'X-Index-Version': version, 'X-Total-Count': str(total)}
+    if request.args.get('version') == version:
+        return '', 304, headers
+    return conditional_json(files, f"files-{version}", headers)
 
 @app.route('/api/files/<room_id>/<path:filename>')
 def get_file(room_id, filename):
-    """Get file content"""
-    content = get_file_content(room_id, filename)
+    """Get file content (ETag = document epoch and revision); large files only report their size"""
+    large = large_file_info(room_id, filename)
+    if large is not None:
+        return jsonify(large)
+    
+    path = os.path.join(get_room_path(room_id), filename)
+    with state_backend.room_lock(room_id):
+        # A GET never creates a document: the file must be open or on disk, and binary files stay read-only
+        live = (room_id, filename) in documents or state_backend.document_state(room_id, filename) is not None
+        if not live and not (is_safe_path(room_id, path) and os.path.isfile(path)):
+            return jsonify({"error": "File not found"}), 404
+        doc = get_document(room_id, filename)
+        if doc is None:
+            content = read_file_from_disk(room_id, filename)
+            if content == "[Binary file - cannot display]":
+                return jsonify({"content": content, "binary": True})
+            return jsonify({"error": "File not found"}), 404
+        payload = {"content": doc['content'], "revision": doc['revision'], "epoch": doc['epoch']}
+    return conditional_json(payload, f"{doc['epoch']}-{doc['revision']}", cache_key=(room_id, filename))
+@app.route('/api/history/<room_id>/<path:filename>')
+def get_file_history(room_id, filename):
+    """List a file's journaled versions, or get its content at ?epoch=&rev="""
+    if 'epoch' not in request.args:
+        return jsonify({"versions": journal_history(room_id, filename)})
+    
+    try:
+        revision = int(request.args.get('rev', 0))
+    except ValueError:
+        return jsonify({"error": "rev must be an integer"}), 400
+    content = journal_content(room_id, filename, request.args['epoch'], revision)
     if content is None:
+        return jsonify({"error": "Revision is not in history"}), 404
+    return jsonify({"content": content, "epoch": request.args['epoch'], "revision": revision})
+
+@app.route('/api/file_range/<room_id>/<path:filename>')
+def get_file_range(room_id, filename):
+    """Read part of a file: ?line=&count= for a window of lines, or ?offset=&length= for bytes"""
+    try:
+        if 'offset' in request.args:
+            result = read_file_range(room_id, filename, offset=int(request.args['offset']),
+                                     length=int(request.args.get('length', RANGE_MAX_BYTES)))
+        else:
+            result = read_file_range(room_id, filename, line=int(request.args.get('line', 0)),
+                                     count=int(request.args.get('count', 1000)))
+    except ValueError:
+        return jsonify({"error": "line, count, offset and length must be integers"}), 400
+    if result is None:
         return jsonify({"error": "File not found"}), 404
-    return jsonify({"content": content})
+    return jsonify(result)
+
+@app.route('/api/file_range/<room_id>/<path:filename>', methods=['POST'])
+def api_edit_file_range(room_id, filename):
+    """Replace part of a file: {text, line, count} or {text, offset, length}, optionally checked against {version}"""
+    data = request.json
+    text = data.get('text')
+    if not isinstance(text, str):
+        return jsonify({"success": False, "error": "text must be a string"}), 400
+    try:
+        if 'offset' in data:
+            info, error = edit_file_range(room_id, filename, text, offset=int(data['offset']),
+                                          length=int(data.get('length', 0)), version=data.get('version'))
+        else:
+            info, error = edit_file_range(room_id, filename, text, line=int(data.get('line', 0)),
+                                          count=int(data.get('count', 0)), version=data.get('version'))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "line, count, offset and length must be integers"}), 400
+    if error:
+        return jsonify({"success": False, "error": error}), 409 if error in (RANGE_CONFLICT, RANGE_LIVE_DOCUMENT) else 400
+    
+    with file_index_lock:
+        index = file_indexes.get(room_id)
+        version = file_index_version(index) if index is not None else None
+    socketio.emit('files_changed', {'changed': [filename], 'removed': [], 'version': version}, room=room_id)
+    return jsonify(dict(info, success=True))
+
 @app.route('/api/create_dir', methods=['POST'])
 def api_create_dir():
     """Create new directory"""
     data = request.json
-    room_id = data['room_id']
-    dirname = data['dirname']
-    
-    path = os.path.join(get_room_path(room_id), dirname)
-    
-    if not is_safe_path(room_id, path):
-        return jsonify({"success": False})
-    
-    try:
-        os.makedirs(path, exist_ok=False)
-        return jsonify({"success": True})
-    except:
-        return jsonify({"success": False})
+    return jsonify({"success": create_directory(data['room_id'], data['dirname'])})
 @app.route('/api/create_file', methods=['POST'])
 def api_create_file():
     """Create new file"""
@@ -678,8 +5085,59 @@ def api_rename_file():
 def api_save_file():
     """Save file content"""
     data = request.json
-    success = save_file_content(data['room_id'], data['filename'], data['content'])
-    return jsonify({"success": success})
+    return jsonify({"success": save_file_and_notify(data['room_id'], data['filename'], data['content'])})
+
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    """Apply a list of file operations; every path is checked before any is applied"""
+    data = request.json
+    room_id = data['room_id']
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"success": False, "error": "operations must be a non-empty list"}), 400
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonify({"success": False, "error": f"At most {BATCH_MAX_OPERATIONS} operations per batch"}), 400
+    
+    errors = validate_batch(room_id, operations)
+    if any(errors):
+        results = [{'index': i, 'success': False, 'error': error or "Not applied"} for i, error in enumerate(errors)]
+        return jsonify({"success": False, "results": results}), 400
+    
+    results, changed, removed = apply_batch(room_id, operations)
+    if changed or removed:
+        with file_index_lock:
+            index = file_indexes.get(room_id)
+            version = file_index_version(index) if index is not None else None
+        socketio.emit('files_changed', {'changed': changed, 'removed': removed, 'version': version}, room=room_id)
+    return jsonify({"success": all(result['success'] for result in results), "results": results})
+
+@app.route('/api/rooms/<room_id>/export')
+def api_export_room(room_id):
+    """Download a room and its settings as a zip (or ?format=tar for tar.gz), streamed"""
+    if not os.path.isdir(get_room_path(room_id)):
+        return jsonify({"error": "Room not found"}), 404
+    if request.args.get('format') == 'tar':
+        body, mimetype, name = export_tar(room_id), 'application/gzip', f"{room_id}.tar.gz"
+    else:
+        body, mimetype, name = export_zip(room_id), 'application/zip', f"{room_id}.zip"
+    return app.response_class(body, mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename="{name}"'})
+
+@app.route('/api/rooms/<room_id>/import', methods=['POST'])
+def api_import_room(room_id):
+    """Unpack an uploaded zip or tar(.gz) request body into a room"""
+    if request.content_length and request.content_length > IMPORT_MAX_BYTES:
+        return jsonify({"success": False, "error": f"Archive is larger than {IMPORT_MAX_BYTES} bytes"}), 413
+    
+    imported, error = import_archive(room_id, request.stream)
+    if error:
+        return jsonify({"success": False, "error": error}), 400
+    
+    if imported:
+        with file_index_lock:
+            index = file_indexes.get(room_id)
+            version = file_index_version(index) if index is not None else None
+        socketio.emit('files_changed', {'changed': imported, 'removed': [], 'version': version}, room=room_id)
+    return jsonify({"success": True, "files": imported})
 
 # Code execution
 @app.route('/api/run', methods=['POST'])
@@ -692,8 +5150,58 @@ def api_run_code():
     room_id = data.get('room_id')
     filename = data.get('filename')
     
-    result = execute_code(language, code, input_data, room_id, filename)
-    return jsonify(result)
+    job, error = submit_job(language, code, input_data, room_id, filename,
+                            priority=parse_priority(data.get('priority')))
+    if job is None:
+        return jsonify({"output": error, "error": True}), 503, {'Retry-After': '2'}
+    
+    if not wait_for_job(job, 3 * CODE_EXECUTION_TIMEOUT):
+        return jsonify({"output": "Run is still queued, poll /api/jobs/" + job['id'],
+                        "error": True, "job_id": job['id']}), 202
+    return jsonify(job['result'])
+
+@app.route('/api/jobs', methods=['POST'])
+def api_submit_job():
+    """Queue code for execution"""
+    data = request.json
+    job, error = submit_job(
+        data.get('language', 'python'),
+        data.get('code', ''),
+        data.get('input', ''),
+        data.get('room_id'),
+        data.get('filename'),
+        priority=parse_priority(data.get('priority'))
+    )
+    if job is None:
+        return jsonify({"success": False, "error": error}), 503, {'Retry-After': '2'}
+    return jsonify(dict(job_info(job), success=True)), 202
+
+@app.route('/api/jobs/<job_id>')
+def api_get_job(job_id):
+    """Poll a job"""
+    job = execution_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_info(job))
+
+@app.route('/api/compile_cache')
+def api_compile_cache():
+    """Compile cache statistics"""
+    with compile_cache_lock:
+        _load_compile_cache()
+        return jsonify({
+            'hits': compile_cache_stats['hits'],
+            'misses': compile_cache_stats['misses'],
+            'evictions': compile_cache_stats['evictions'],
+            'entries': len(compile_cache),
+            'bytes': compile_cache_stats['bytes'],
+            'max_bytes': COMPILE_CACHE_MAX_BYTES
+        })
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def api_cancel_job(job_id):
+    """Cancel a job"""
+    return jsonify({"success": cancel_job(job_id)})
 
 # AI features
 @app.route('/api/ai_chat', methods=['POST'])
@@ -714,25 +5222,70 @@ def api_ai_chat():
 def api_analyze_code():
     """Analyze code complexity"""
     data = request.json
-    analysis = analyze_code_complexity(data.get('code', ''), data.get('language', 'python'))
-    suggestions = get_code_suggestions(data.get('code', ''), data.get('language', 'python'))
+    room_id, filename = data.get('room'), data.get('file')
+    key = (room_id, filename) if room_id and filename else None
+    analysis, suggestions = analyze_code(data.get('code', ''), data.get('language', 'python'), key)
     return jsonify({
         "analysis": analysis,
         "suggestions": suggestions
     })
 
+@app.route('/api/search/<room_id>')
+def api_search(room_id):
+    """Search a room: ?q=, ?mode=text|regex|symbol, ?case=1, ?offset=, ?limit="""
+    query = request.args.get('q', '')
+    mode = request.args.get('mode', 'text')
+    if not query:
+        return jsonify({"error": "q is required"}), 400
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(max(1, int(request.args.get('limit', SEARCH_PAGE_SIZE))), 200)
+    except ValueError:
+        return jsonify({"error": "offset and limit must be integers"}), 400
+    
+    if mode == 'symbol':
+        results, total = search_symbols(room_id, query, offset, limit)
+    elif mode in ('text', 'regex'):
+        try:
+            results, total = search_text(room_id, query, regex=mode == 'regex',
+                                         case_sensitive=request.args.get('case') == '1',
+                                         offset=offset, limit=limit)
+        except re.error as e:
+            return jsonify({"error": f"Invalid regex: {e}"}), 400
+    else:
+        return jsonify({"error": "mode must be text, regex or symbol"}), 400
+    return jsonify({"results": results, "total": total, "offset": offset, "limit": limit})
+
+@app.route('/api/diagnostics/<room_id>/<path:filename>')
+def api_get_diagnostics(room_id, filename):
+    """Latest diagnostics for a file; changes are pushed as diagnostics events"""
+    revision, diagnostics = get_diagnostics(room_id, filename)
+    return jsonify({"file": filename, "revision": revision, "diagnostics": diagnostics})
+
 # Settings
 @app.route('/api/settings/<room_id>')
 def api_get_settings(room_id):
-    """Get room settings"""
-    return jsonify(get_room_settings(room_id))
+    """Get room settings (ETag = settings version)"""
+    settings, version = get_room_settings_version(room_id)
+    response = jsonify(settings)
+    response.set_etag(f"settings-{version}")
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route('/api/settings/<room_id>', methods=['POST'])
 def api_save_settings(room_id):
     """Save room settings"""
     settings = request.json
-    success = save_room_settings(room_id, settings)
-    return jsonify({"success": success})
+    if not isinstance(settings, dict):
+        return jsonify({"success": False, "error": "Settings must be a JSON object"}), 400
+    version = save_room_settings(room_id, settings)
+    if version is None:
+        return jsonify({"success": False})
+    
+    # Push the change so open editors don't have to poll for it
+    settings, version = get_room_settings_version(room_id)
+    socketio.emit('settings_updated', {'settings': settings, 'version': version}, room=room_id)
+    return jsonify({"success": True, "version": version})
 
 # Snippets
 @app.route('/api/snippets/<language>')
@@ -763,21 +5316,32 @@ def on_join(data):
     room = data['room']
     join_room(room)
     
-    if room not in room_users:
-        room_users[room] = {}
+    # Clients may ask for fewer presence updates than the server default
+    try:
+        rate = min(float(data.get('presence_rate', PRESENCE_MAX_RATE)), PRESENCE_MAX_RATE)
+    except (TypeError, ValueError):
+        rate = PRESENCE_MAX_RATE
     
-    room_users[room][request.sid] = {
+    color = data.get('color', '#' + ''.join([f'{ord(c):02x}' for c in username[:3]]))
+    add_room_user(room, request.sid, {
         'username': username,
         'cursor': {'row': 0, 'column': 0},
-        'color': data.get('color', '#' + ''.join([f'{ord(c):02x}' for c in username[:3]]))
-    }
+        'selection': None,
+        'color': color,
+        'presence_interval': 1.0 / rate if rate > 0 else float('inf'),
+        'presence_sent': 0
+    })
+    state_backend.add_member(room, request.sid, {'username': username, 'color': color})
     
     emit('user_joined', {
         'username': username,
-        'users': [u['username'] for u in room_users[room].values()],
+        'users': [u['username'] for u in state_backend.room_members(room).values()],
         'sid': request.sid
     }, room=room)
     
+    # Catch the newcomer up on everyone's cursors
+    emit('presence', {'users': state_backend.room_presence(room)})
+    
     emit('status', {
         'msg': f'{username} joined the room',
         'type': 'join'
@@ -787,14 +5351,14 @@ def on_join(data):
 def on_leave(data):
     """User leaves room"""
     room = data.get('room')
-    if room and room in room_users and request.sid in room_users[room]:
-        username = room_users[room][request.sid]['username']
-        del room_users[room][request.sid]
+    user = remove_room_user(room, request.sid) if room else None
+    if user is not None:
+        username = user['username']
         leave_room(room)
         
         emit('user_left', {
             'username': username,
-            'users': [u['username'] for u in room_users[room].values()],
+            'users': [u['username'] for u in state_backend.room_members(room).values()],
             'sid': request.sid
         }, room=room)
         
@@ -805,47 +5369,147 @@ def on_leave(data):
 
 @socketio.on('code_change')
 def on_code_change(data):
-    """Code changed by user"""
+    """Full content sync (fallback for clients without delta support)"""
     room = data['room']
     filename = data['file']
     content = data['content']
     
-    # Auto-save
-    if data.get('auto_save', True):
-        save_file_content(room, filename, content)
+    result = set_document_content(room, filename, content)
+    if result is None:
+        return
+    revision, epoch = result
+    schedule_diagnostics(room, filename)
     
     # Broadcast to others
     emit('update_code', {
         'file': filename,
         'content': content,
+        'rev': revision,
+        'epoch': epoch,
+        'user': room_users.get(room, {}).get(request.sid, {}).get('username', 'Unknown')
+    }, room=room, include_self=False)
+
+@socketio.on('code_delta')
+def on_code_delta(data):
+    """Code edit sent as an operation against a document revision"""
+    room = data['room']
+    filename = data['file']
+    op = data.get('op')
+    
+    rev = data.get('rev', 0)
+    
+    result = None
+    if check_text_op(op) and isinstance(rev, int) and not isinstance(rev, bool) and rev >= 0:
+        result = apply_document_op(room, filename, rev, op,
+                                   epoch=data.get('epoch'), auto_save=data.get('auto_save', True))
+    if result is None:
+        on_request_resync(data)
+        return
+    revision, op = result
+    schedule_diagnostics(room, filename, op)
+    
+    emit('code_ack', {'file': filename, 'rev': revision})
+    
+    # Broadcast only the op to others
+    emit('code_delta', {
+        'file': filename,
+        'rev': revision,
+        'op': op,
         'user': room_users.get(room, {}).get(request.sid, {}).get('username', 'Unknown')
     }, room=room, include_self=False)
 
+@socketio.on('request_resync')
+def on_request_resync(data):
+    """Send the full document to a client that lost track of revisions"""
+    room = data['room']
+    filename = data['file']
+    
+    with state_backend.room_lock(room):
+        doc = get_document(room, filename)
+        if doc is None:
+            return
+        content, revision, epoch = doc['content'], doc['revision'], doc['epoch']
+    
+    emit('resync', {
+        'file': filename,
+        'content': content,
+        'rev': revision,
+        'epoch': epoch
+    })
+
+@socketio.on('save_file')
+def on_save_file(data):
+    """Write a live document to disk now"""
+    room = data['room']
+    filename = data['file']
+    
+    success = flush_document(room, filename)
+    if success:
+        schedule_diagnostics(room, filename)
+    emit('file_saved', {
+        'file': filename,
+        'success': success
+    }, room=room)
+
 @socketio.on('cursor_move')
 def on_cursor_move(data):
     """Cursor position changed"""
-    room = data['room']
-    
-    if room in room_users and request.sid in room_users[room]:
-        room_users[room][request.sid]['cursor'] = data['cursor']
-        
-        emit('remote_cursor', {
-            'sid': request.sid,
-            'username': room_users[room][request.sid]['username'],
-            'cursor': data['cursor'],
-            'color': room_users[room][request.sid]['color']
-        }, room=room, include_self=False)
+    update_presence(data['room'], request.sid, cursor=data['cursor'], file=data.get('file'))
 
 @socketio.on('selection_change')
 def on_selection_change(data):
     """Text selection changed"""
-    room = data['room']
+    update_presence(data['room'], request.sid, selection=data['selection'], file=data.get('file'))
+
+@socketio.on('run_code')
+def on_run_code(data):
+    """Run code with its output streamed to the room"""
+    room = data.get('room')
+    job, error = submit_job(data.get('language', 'python'), data.get('code', ''), data.get('input', ''),
+                            room, data.get('file'), priority=parse_priority(data.get('priority')),
+                            stream=True, sid=request.sid)
+    if job is None:
+        emit('run_error', {'error': error})
+        return
     
-    emit('remote_selection', {
-        'sid': request.sid,
-        'selection': data['selection'],
-        'username': room_users.get(room, {}).get(request.sid, {}).get('username', 'Unknown')
-    }, room=room, include_self=False)
+    emit('run_started', dict(job_info(job),
+                             owner=request.sid,
+                             username=room_users.get(room, {}).get(request.sid, {}).get('username', 'Unknown')),
+         room=room or request.sid)
+
+@socketio.on('run_input')
+def on_run_input(data):
+    """Interactive stdin for a streamed run; eof closes it"""
+    job = execution_jobs.get(data.get('job_id'))
+    if job is None or not job['stream'] or job['sid'] != request.sid:
+        return
+    if job['status'] not in ('queued', 'running'):
+        return
+    if data.get('data'):
+        job['stdin'].put(str(data['data']))
+    if data.get('eof'):
+        job['stdin'].put(None)
+
+@socketio.on('ai_stream')
+def on_ai_stream(data):
+    """Stream an assistant answer back to the sender"""
+    stream_id = str(data.get('id') or uuid.uuid4())
+    error = ai_stream(
+        stream_id, request.sid,
+        provider=data.get('provider', 'gemini'),
+        model=data.get('model', 'gemini-pro'),
+        api_key=data.get('api_key'),
+        prompt=data.get('prompt'),
+        code_context=data.get('context'),
+        task_type=data.get('task', 'chat')
+    )
+    if error:
+        emit('ai_done', {'id': stream_id, 'cancelled': False, 'error': error})
+
+@socketio.on('ai_cancel')
+def on_ai_cancel(data):
+    """Stop streaming an assistant answer"""
+    cancel_ai_streams(request.sid, str(data.get('id')))
 
 @socketio.on('chat_message')
 def on_chat_message(data):
@@ -863,73 +5527,68 @@ def on_chat_message(data):
 def on_terminal_input(data):
     """Terminal command input"""
     room = data['room']
-    command = data['command']
+    command = data.get('command', '')
     
-    # Expanded safe commands list for better integration
-    safe_commands = [
-        'ls', 'dir', 'pwd', 'cd', 'echo', 'cat', 'grep', 'wc', 'head', 'tail', 
-        'mkdir', 'rm', 'touch', 'mv', 'cp', 
-        'python', 'python3', 'py', 'node', 'npm', 'npx',
-        'java', 'javac', 'gcc', 'g++', 'go', 'cargo', 'rustc', 'ruby', 'php', 
-        'git', 'pip', 'whoami', 'date'
-    ]
+    if pty is None:
+        emit('terminal_output', {
+            'output': run_terminal_command(room, command),
+            'command': command
+        }, room=room)
+        return
     
-    cmd_parts = command.strip().split()
-    is_safe = False
+    session = active_terminals.get(room)
     
-    if cmd_parts:
-        # Check if the command starts with one of the allowed programs (cross-platform friendly)
-        base_cmd = os.path.basename(cmd_parts[0])
-        # remove extension like .exe
-        base_cmd = os.path.splitext(base_cmd)[0]
-        
-        if base_cmd in safe_commands or cmd_parts[0] in safe_commands:
-            is_safe = True
-            
-    if is_safe:
-        try:
-            cwd = get_room_path(room)
-            result = subprocess.run(
-                command,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=10,
-                cwd=cwd
-            )
-            output = result.stdout + result.stderr
-        except Exception as e:
-            output = f"Error: {str(e)}"
-    else:
-        output = f"Command '{cmd_parts[0] if cmd_parts else ''}' not in allowed list."
+    # Ctrl+C / Ctrl+D go straight to whatever is running
+    control = {'c': '\x03', 'd': '\x04'}.get(data.get('control'))
+    if control:
+        if session is not None:
+            write_terminal(session, control)
+        return
     
-    emit('terminal_output', {
-        'output': output,
-        'command': command
-    }, room=room)
+    # At the shell prompt a line is a command; while a program runs it is that program's input
+    if (session is None or shell_in_foreground(session)) and command.strip() and not is_safe_terminal_command(command):
+        cmd_parts = command.strip().split()
+        emit('terminal_output', {'output': f"Command '{cmd_parts[0]}' not in allowed list.\n"})
+        return
+    
+    if session is None:
+        session, error = open_terminal(room)
+        if session is None:
+            emit('terminal_output', {'output': error + "\n"})
+            return
+    write_terminal(session, command + "\n")
 
 @socketio.on('disconnect')
 def on_disconnect():
     """User disconnected"""
-    for room, users in room_users.items():
-        if request.sid in users:
-            username = users[request.sid]['username']
-            del users[request.sid]
-            
-            emit('user_left', {
-                'username': username,
-                'users': [u['username'] for u in users.values()],
-                'sid': request.sid
-            }, room=room)
-            break
+    cancel_ai_streams(request.sid)
+    with membership_lock:
+        rooms = list(sid_rooms.get(request.sid, ()))
+    for room in rooms:
+        user = remove_room_user(room, request.sid)
+        if user is None:
+            continue
+        
+        emit('user_left', {
+            'username': user['username'],
+            'users': [u['username'] for u in state_backend.room_members(room).values()],
+            'sid': request.sid
+        }, room=room)
 
 # ============ Main ============
 
+atexit.register(flush_all_documents)
+atexit.register(shutdown_python_pool)
+atexit.register(close_all_terminals)
+
 if __name__ == '__main__':
     # Ensure directories exist
     ensure_dir(ROOMS_DIR)
     ensure_dir(SETTINGS_DIR)
     ensure_dir(SNIPPETS_DIR)
+    recovered = recover_journals()
+    if recovered:
+        print(f"Recovered unsaved edits to {recovered} file(s) from the edit journal")
     
     print("=" * 60)
     print("CodeSync Pro - Enhanced Collaborative Code Editor")
@@ -946,7 +5605,11 @@ if __name__ == '__main__':
     print("✓ Live cursors & selections")
     print("✓ Built-in chat")
     print("✓ Terminal support")
-    print("\nStarting server on http://localhost:5000")
+    
+    refill_python_pool()
+    
+    port = int(os.environ.get('PORT', 5000))
+    print(f"\nStarting server on http://localhost:{port} (worker {WORKER_ID}, state: {STATE_BACKEND})")
     print("=" * 60)
     
-    socketio.run(app, debug=True, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True)
\ No newline at end of file
+    socketio.run(app, debug=True, host='0.0.0.0', port=port, allow_unsafe_werkzeug=True)
\ No newline at end of file
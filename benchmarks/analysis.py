@@ -0,0 +1,98 @@
+"""Code analysis cost on large files: full, cached and incremental.
+
+Usage: python benchmarks/analysis.py [--lines 20000] [--edits 50]
+
+"full" analyzes a file never seen before, "cached" repeats an unchanged
+file, "edit" changes one line and re-analyzes by diffing against the cached
+version, and "edit+op" does the same but passes the op, as live edits can.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import ot  # noqa: E402
+
+SAMPLES = {
+    'python': (
+        'def handler_{n}(request, items):\n'
+        '    """Handle request {n}"""\n'
+        '    # TODO: validate\n'
+        '    if request and items or not request:\n'
+        '        return [i for i in items if i % {n} == 0]\n'
+        '    elif request:\n'
+        '        raise ValueError("bad if/else request")\n'
+        '    return None\n'
+        '\n'
+    ),
+    'javascript': (
+        'function handler{n}(req, items) {{\n'
+        '    /* filters the items\n'
+        '       for a request */\n'
+        '    if (req && items || !req) {{\n'
+        '        return items.filter(i => i % {n} === 0 ? true : false);\n'
+        '    }}\n'
+        '    const msg = `while ${{req}}`;\n'
+        '    return null;\n'
+        '}}\n'
+        '\n'
+    ),
+}
+
+
+def make_file(language, lines):
+    """Generated source of roughly the requested number of lines"""
+    template = SAMPLES[language]
+    per_block = template.count('\n')
+    return ''.join(template.format(n=n + 1) for n in range(lines // per_block))
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def bench(language, lines, edits):
+    content = make_file(language, lines)
+    key = ('bench', f"file.{language}")
+    app.analysis_cache.clear()
+    results = {'full': [timed(app.analyze_code, content, language, key)],
+               'cached': [timed(app.analyze_code, content, language, key) for _ in range(edits)],
+               'edit': [], 'edit+op': []}
+
+    rng = random.Random(0)
+    for i in range(edits * 2):
+        pos = rng.randrange(len(content))
+        pos = content.index('\n', pos) if '\n' in content[pos:] else pos
+        insert = '\n    x = 1 if y else 2'
+        op = []
+        ot.append_component(op, pos)
+        ot.append_component(op, insert)
+        content = content[:pos] + insert + content[pos:]
+        mode = 'edit+op' if i % 2 else 'edit'
+        results[mode].append(timed(app.analyze_code, content, language, key, op if i % 2 else None))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--edits', type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'language':<11} {'mode':<8} {'mean ms':>9} {'p50 ms':>9} {'max ms':>9}")
+    for language in SAMPLES:
+        for mode, samples in bench(language, args.lines, args.edits).items():
+            samples = sorted(samples)
+            print(f"{language:<11} {mode:<8} {statistics.mean(samples):>9.2f} "
+                  f"{samples[len(samples) // 2]:>9.2f} {samples[-1]:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
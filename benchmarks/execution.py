@@ -0,0 +1,272 @@
+"""Where code execution time goes, per language, program and mode.
+
+Usage: python benchmarks/execution.py [--runs 5] [--languages python,c] [--python-pool 0]
+                                      [--json report.json]
+
+Every runnable language in LANGUAGE_CONFIG whose toolchain is on PATH runs
+four programs (hello, cpu, stdout, stdin) through execute_code, both in a
+temporary directory and in a room directory. Setup (writing the source),
+compile, run and teardown are read from the execution phase metrics
+execute_code records. The first run is reported on its own because it
+misses the compile cache; later runs of the same source hit it. --json
+writes the report for comparing runs.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+ROOM = 'bench-execution'
+PHASES = {'write': 'setup', 'compile': 'compile', 'run': 'run', 'cleanup': 'teardown'}
+STDIN = ''.join(f"{i}\n" for i in range(10000))
+
+# The cpu program sums squares modulo a prime; bash and sql loop fewer times
+PROGRAMS = {
+    'python': {
+        'hello': 'print("Hello, World!")\n',
+        'cpu': 'total = 0\nfor i in range(1000000):\n    total = (total + i * i) % 1000003\nprint(total)\n',
+        'stdout': 'for i in range(10000):\n    print("line", i)\n',
+        'stdin': 'import sys\nprint(sum(int(line) for line in sys.stdin))\n',
+    },
+    'javascript': {
+        'hello': 'console.log("Hello, World!");\n',
+        'cpu': 'let t = 0;\nfor (let i = 0; i < 1000000; i++) t = (t + i * i) % 1000003;\nconsole.log(t);\n',
+        'stdout': 'for (let i = 0; i < 10000; i++) console.log("line " + i);\n',
+        'stdin': "const data = require('fs').readFileSync(0, 'utf8');\n"
+                 "console.log(data.split('\\n').filter(Boolean).reduce((a, l) => a + Number(l), 0));\n",
+    },
+    'typescript': {
+        'hello': 'console.log("Hello, World!");\n',
+        'cpu': 'let t: number = 0;\nfor (let i = 0; i < 1000000; i++) t = (t + i * i) % 1000003;\nconsole.log(t);\n',
+        'stdout': 'for (let i = 0; i < 10000; i++) console.log("line " + i);\n',
+        'stdin': "declare const require: any;\nconst data: string = require('fs').readFileSync(0, 'utf8');\n"
+                 "console.log(data.split('\\n').filter(Boolean).reduce((a, l) => a + Number(l), 0));\n",
+    },
+    'java': {
+        'hello': 'public class Main {\n    public static void main(String[] args) {\n'
+                 '        System.out.println("Hello, World!");\n    }\n}\n',
+        'cpu': 'public class Main {\n    public static void main(String[] args) {\n'
+               '        long t = 0;\n        for (long i = 0; i < 1000000; i++) t = (t + i * i) % 1000003;\n'
+               '        System.out.println(t);\n    }\n}\n',
+        'stdout': 'public class Main {\n    public static void main(String[] args) {\n'
+                  '        for (int i = 0; i < 10000; i++) System.out.println("line " + i);\n    }\n}\n',
+        'stdin': 'import java.io.*;\n\npublic class Main {\n'
+                 '    public static void main(String[] args) throws IOException {\n'
+                 '        BufferedReader in = new BufferedReader(new InputStreamReader(System.in));\n'
+                 '        long s = 0;\n        String line;\n'
+                 '        while ((line = in.readLine()) != null) if (!line.isEmpty()) s += Long.parseLong(line.trim());\n'
+                 '        System.out.println(s);\n    }\n}\n',
+    },
+    'c': {
+        'hello': '#include <stdio.h>\n\nint main(void) {\n    printf("Hello, World!\\n");\n    return 0;\n}\n',
+        'cpu': '#include <stdio.h>\n\nint main(void) {\n    long long t = 0;\n'
+               '    for (long long i = 0; i < 1000000; i++) t = (t + i * i) % 1000003;\n'
+               '    printf("%lld\\n", t);\n    return 0;\n}\n',
+        'stdout': '#include <stdio.h>\n\nint main(void) {\n'
+                  '    for (int i = 0; i < 10000; i++) printf("line %d\\n", i);\n    return 0;\n}\n',
+        'stdin': '#include <stdio.h>\n\nint main(void) {\n    long long s = 0, v;\n'
+                 '    while (scanf("%lld", &v) == 1) s += v;\n    printf("%lld\\n", s);\n    return 0;\n}\n',
+    },
+    'cpp': {
+        'hello': '#include <iostream>\n\nint main() {\n    std::cout << "Hello, World!" << std::endl;\n}\n',
+        'cpu': '#include <iostream>\n\nint main() {\n    long long t = 0;\n'
+               '    for (long long i = 0; i < 1000000; i++) t = (t + i * i) % 1000003;\n'
+               '    std::cout << t << std::endl;\n}\n',
+        'stdout': '#include <iostream>\n\nint main() {\n'
+                  '    for (int i = 0; i < 10000; i++) std::cout << "line " << i << "\\n";\n}\n',
+        'stdin': '#include <iostream>\n\nint main() {\n    long long s = 0, v;\n'
+                 '    while (std::cin >> v) s += v;\n    std::cout << s << std::endl;\n}\n',
+    },
+    'go': {
+        'hello': 'package main\n\nimport "fmt"\n\nfunc main() {\n\tfmt.Println("Hello, World!")\n}\n',
+        'cpu': 'package main\n\nimport "fmt"\n\nfunc main() {\n\tvar t int64\n'
+               '\tfor i := int64(0); i < 1000000; i++ {\n\t\tt = (t + i*i) % 1000003\n\t}\n\tfmt.Println(t)\n}\n',
+        'stdout': 'package main\n\nimport "fmt"\n\nfunc main() {\n'
+                  '\tfor i := 0; i < 10000; i++ {\n\t\tfmt.Println("line", i)\n\t}\n}\n',
+        'stdin': 'package main\n\nimport (\n\t"bufio"\n\t"fmt"\n\t"os"\n\t"strconv"\n)\n\nfunc main() {\n'
+                 '\tscanner := bufio.NewScanner(os.Stdin)\n\tvar s int64\n\tfor scanner.Scan() {\n'
+                 '\t\tv, _ := strconv.ParseInt(scanner.Text(), 10, 64)\n\t\ts += v\n\t}\n\tfmt.Println(s)\n}\n',
+    },
+    'rust': {
+        'hello': 'fn main() {\n    println!("Hello, World!");\n}\n',
+        'cpu': 'fn main() {\n    let mut t: u64 = 0;\n'
+               '    for i in 0..1000000u64 {\n        t = (t + i * i) % 1000003;\n    }\n    println!("{}", t);\n}\n',
+        'stdout': 'fn main() {\n    for i in 0..10000 {\n        println!("line {}", i);\n    }\n}\n',
+        'stdin': 'use std::io::Read;\n\nfn main() {\n    let mut input = String::new();\n'
+                 '    std::io::stdin().read_to_string(&mut input).unwrap();\n'
+                 '    let total: i64 = input.split_whitespace().map(|x| x.parse::<i64>().unwrap()).sum();\n'
+                 '    println!("{}", total);\n}\n',
+    },
+    'ruby': {
+        'hello': 'puts "Hello, World!"\n',
+        'cpu': 't = 0\n1000000.times { |i| t = (t + i * i) % 1000003 }\nputs t\n',
+        'stdout': '10000.times { |i| puts "line #{i}" }\n',
+        'stdin': 'puts STDIN.read.split.map(&:to_i).sum\n',
+    },
+    'php': {
+        'hello': '<?php\necho "Hello, World!\\n";\n',
+        'cpu': '<?php\n$t = 0;\nfor ($i = 0; $i < 1000000; $i++) {\n    $t = ($t + $i * $i) % 1000003;\n}\necho $t, "\\n";\n',
+        'stdout': '<?php\nfor ($i = 0; $i < 10000; $i++) {\n    echo "line $i\\n";\n}\n',
+        'stdin': '<?php\necho array_sum(array_map(\'intval\', file(\'php://stdin\'))), "\\n";\n',
+    },
+    'bash': {
+        'hello': 'echo "Hello, World!"\n',
+        'cpu': 't=0\nfor ((i = 0; i < 100000; i++)); do\n    t=$(( (t + i * i) % 1000003 ))\ndone\necho $t\n',
+        'stdout': 'for ((i = 0; i < 10000; i++)); do\n    echo "line $i"\ndone\n',
+        'stdin': 's=0\nwhile read -r v; do\n    s=$((s + v))\ndone\necho $s\n',
+    },
+    'sql': {
+        'hello': "SELECT 'Hello, World!';\n",
+        'cpu': 'WITH RECURSIVE n(i, t) AS (SELECT 0, 0 UNION ALL SELECT i + 1, (t + i * i) % 1000003 FROM n WHERE i < 100000)\n'
+               'SELECT t FROM n WHERE i = 100000;\n',
+        'stdout': "WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < 9999)\nSELECT 'line ' || i FROM n;\n",
+    },
+}
+
+
+def toolchain(language):
+    """Path of the compiler or interpreter a language needs, or None if it isn't installed"""
+    config = app.LANGUAGE_CONFIG[language]
+    command = config.get('compile') or config.get('command')
+    if not command:
+        return None
+    return shutil.which(command[0])
+
+
+def phase_totals(language):
+    """Seconds recorded so far for each execution phase of a language"""
+    with app.metrics_lock:
+        return {phase: counts[-1] for (name, (lang, phase)), counts in app.metric_histograms.items()
+                if name == 'codesync_execution_phase_seconds' and lang == language}
+
+
+def run_once(language, code, mode):
+    """One execute_code call; returns (phase seconds, result)"""
+    before = phase_totals(language)
+    started = time.perf_counter()
+    if mode == 'room':
+        filename = 'Main.java' if language == 'java' else 'prog' + app.LANGUAGE_CONFIG[language]['extension']
+        result = app.execute_code(language, code, STDIN, room_id=ROOM, filename=filename)
+    else:
+        result = app.execute_code(language, code, STDIN)
+    total = time.perf_counter() - started
+    after = phase_totals(language)
+    phases = {label: after.get(phase, 0) - before.get(phase, 0) for phase, label in PHASES.items()}
+    phases['total'] = total
+    return phases, result
+
+
+def bench(language, program, code, mode, runs, gap):
+    samples = []
+    error = None
+    for _ in range(runs):
+        phases, result = run_once(language, code, mode)
+        if result['error'] and error is None:
+            # First line of the message, past the [stderr]: marker
+            lines = [line for line in result['output'].splitlines() if line.strip() and not line.startswith('[')]
+            error = lines[0][:200] if lines else 'error'
+        samples.append(phases)
+        time.sleep(gap)
+    ms = lambda seconds: round(seconds * 1000, 2)  # noqa: E731
+    report = {
+        'language': language,
+        'program': program,
+        'mode': mode,
+        'runs': runs,
+        'ok': error is None,
+        'error': error,
+        'first_ms': {phase: ms(value) for phase, value in samples[0].items()},
+    }
+    if runs > 1:
+        report['repeat_p50_ms'] = {phase: ms(statistics.median(s[phase] for s in samples[1:])) for phase in samples[0]}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='runs per program and mode')
+    parser.add_argument('--languages', help='comma-separated subset of languages')
+    parser.add_argument('--programs', help='comma-separated subset of hello,cpu,stdout,stdin')
+    parser.add_argument('--modes', default='temp,room', help='temp, room or both')
+    parser.add_argument('--python-pool', type=int, default=0, help='warm Python interpreters to keep')
+    parser.add_argument('--gap', type=float, default=0.05, help='seconds between runs')
+    parser.add_argument('--json', help='write the report as JSON to this file ("-" for stdout)')
+    args = parser.parse_args()
+
+    # Rooms and the compile cache go in a scratch directory, so the first runs always compile
+    workdir = tempfile.mkdtemp(prefix='codesync_execution_')
+    os.chdir(workdir)
+    app.ensure_dir(app.get_room_path(ROOM))
+    app.PYTHON_POOL_SIZE = args.python_pool
+    app.refill_python_pool()
+
+    languages = args.languages.split(',') if args.languages else list(PROGRAMS)
+    programs = args.programs.split(',') if args.programs else ['hello', 'cpu', 'stdout', 'stdin']
+    toolchains = {language: toolchain(language) for language in languages if language in app.LANGUAGE_CONFIG}
+    skipped = sorted(set(languages) - {language for language, path in toolchains.items() if path})
+
+    quiet = args.json == '-'
+    if not quiet:
+        print(f"{'language':<11} {'program':<7} {'mode':<5} {'first ms':>9} "
+              + ' '.join(f"{label:>9}" for label in list(PHASES.values()) + ['total']) + '  (repeat p50 ms)')
+    results = []
+    try:
+        for language in languages:
+            if language in skipped:
+                continue
+            for program in programs:
+                code = PROGRAMS.get(language, {}).get(program)
+                if code is None:
+                    continue
+                for mode in args.modes.split(','):
+                    report = bench(language, program, code, mode, args.runs, args.gap)
+                    results.append(report)
+                    if not quiet:
+                        repeat = report.get('repeat_p50_ms', {})
+                        print(f"{language:<11} {program:<7} {mode:<5} {report['first_ms']['total']:>9.1f} "
+                              + ' '.join(f"{repeat.get(label, 0):>9.1f}" for label in list(PHASES.values()) + ['total'])
+                              + ('' if report['ok'] else f"  FAILED: {report['error']}"))
+    finally:
+        app.shutdown_python_pool()
+        os.chdir('/')
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if skipped and not quiet:
+        print(f"\nskipped (toolchain not on PATH): {', '.join(skipped)}")
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(__file__),
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    report = {
+        'benchmark': 'execution',
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'platform': platform.platform(),
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+        'toolchains': toolchains,
+        'skipped': skipped,
+        'results': results,
+    }
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+"""Socket.IO load test: many simulated collaborators across many rooms.
+
+Usage: python benchmarks/load.py [--clients 200] [--rooms 20] [--duration 20]
+                                 [--typing-rate 2] [--file-size 2000] [--json report.json]
+
+Starts the app in a temporary directory (or targets --url), connects the
+clients over websockets and has each of them join a room, then send
+code_change, cursor_move and chat_message at the given rates until they
+leave. Every message carries its send time, so each broadcast a client
+receives gives one end-to-end latency sample. The report has throughput,
+p50/p99 latency per broadcast, server CPU and RSS, and Socket.IO bytes
+in each direction. --json writes it as JSON ("-" for stdout) so runs can
+be compared.
+"""
+import argparse
+import heapq
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import requests
+import socketio
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = ("import app; app.socketio.run(app.app, host='127.0.0.1', port={port}, "
+          "allow_unsafe_werkzeug=True, log_output=False)")
+
+
+class CountingClient(socketio.Client):
+    """Client that tallies the Socket.IO packets it sends and receives (characters; payloads are ASCII)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def _send_packet(self, pkt):
+        encoded = pkt.encode()
+        for data in encoded if isinstance(encoded, list) else [encoded]:
+            self.bytes_sent += len(data)
+            self.eio.send(data)
+
+    def _handle_eio_message(self, data):
+        self.bytes_received += len(data)
+        super()._handle_eio_message(data)
+
+
+class Collaborator:
+    """One simulated user in a room"""
+
+    def __init__(self, index, room, stats):
+        self.index = index
+        self.room = room
+        self.stats = stats
+        self.client = CountingClient(reconnection=False)
+        self.sid = None
+        self.filler = None
+        self.leaving = False
+        self.client.on('update_code', self.on_update_code)
+        self.client.on('presence', self.on_presence)
+        self.client.on('chat_message', self.on_chat)
+        self.client.on('disconnect', self.on_disconnect)
+
+    def connect(self, url, file_size):
+        self.client.connect(url, transports=['websocket'], wait_timeout=10)
+        self.sid = self.client.get_sid()
+        self.filler = ''.join(random.choice('abcdefghij \n') for _ in range(max(file_size - 32, 0)))
+        self.client.emit('join', {'room': self.room, 'username': f"bench{self.index}"})
+
+    def send(self, event):
+        sent = time.perf_counter()
+        if event == 'code_change':
+            payload = {'room': self.room, 'file': 'bench.py', 'content': f"# sent={sent!r}\n{self.filler}"}
+        elif event == 'cursor_move':
+            payload = {'room': self.room, 'file': 'bench.py',
+                       'cursor': {'row': random.randrange(100), 'column': random.randrange(80), 'sent': sent}}
+        else:
+            payload = {'room': self.room, 'message': f"sent={sent!r}"}
+        self.client.emit(event, payload)
+        self.stats.sent(event)
+
+    def on_update_code(self, data):
+        first = data['content'].split('\n', 1)[0]
+        if first.startswith('# sent='):
+            self.stats.received('update_code', float(first[7:]))
+
+    def on_presence(self, data):
+        for user in data['users']:
+            cursor = user.get('cursor') or {}
+            if 'sent' in cursor:
+                self.stats.received('presence', cursor['sent'])
+
+    def on_disconnect(self, *args):
+        if not self.leaving:
+            self.stats.error('disconnected')
+
+    def on_chat(self, data):
+        if data['message'].startswith('sent='):
+            self.stats.received('chat_message', float(data['message'][5:]))
+
+
+class Stats:
+    """Counts and latency samples, recorded only while measuring"""
+
+    def __init__(self):
+        self.measuring = False
+        self.sent_counts = {}
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def sent(self, event):
+        if self.measuring:
+            with self.lock:
+                self.sent_counts[event] = self.sent_counts.get(event, 0) + 1
+
+    def received(self, event, sent):
+        if self.measuring:
+            latency = time.perf_counter() - sent
+            with self.lock:
+                self.latencies.setdefault(event, []).append(latency)
+
+    def error(self, kind):
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+def process_sample(pid):
+    """(cpu seconds, rss bytes, peak rss bytes) for a process, or None if it can't be read"""
+    if pid is None:
+        return None
+    if psutil is not None:
+        try:
+            proc = psutil.Process(pid)
+            cpu = proc.cpu_times()
+            memory = proc.memory_info()
+            return cpu.user + cpu.system, memory.rss, getattr(memory, 'peak_wset', None)
+        except psutil.Error:
+            return None
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    return ((int(fields[11]) + int(fields[12])) / ticks,
+            int(status['VmRSS'].split()[0]) * 1024,
+            int(status['VmHWM'].split()[0]) * 1024)
+
+
+def start_server(workdir):
+    """Start the app on a free port; returns (process, url)"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    proc = subprocess.Popen([sys.executable, '-c', SERVER.format(port=port)], cwd=workdir,
+                            env=dict(os.environ, PYTHONPATH=REPO), stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"server exited, see {log.name}")
+        try:
+            requests.get(url + '/api/languages', timeout=1)
+            return proc, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise SystemExit("server did not start within 30s")
+
+
+def drive(collaborators, rates, until):
+    """Send each client's events as Poisson processes until the deadline"""
+    now = time.perf_counter()
+    queue = [(now + random.expovariate(rate), i, event)
+             for i in range(len(collaborators)) for event, rate in rates.items() if rate > 0]
+    heapq.heapify(queue)
+    while queue:
+        due, i, event = heapq.heappop(queue)
+        if due >= until:
+            break
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            collaborators[i].send(event)
+        except socketio.exceptions.SocketIOError:
+            collaborators[i].stats.error('send_failed')
+            continue
+        heapq.heappush(queue, (due + random.expovariate(rates[event]), i, event))
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='codesync_load_')
+    proc = None
+    if args.url:
+        url, pid = args.url.rstrip('/'), args.pid
+    else:
+        proc, url = start_server(workdir)
+        pid = proc.pid
+
+    stats = Stats()
+    collaborators = [Collaborator(i, f"load-{i % args.rooms}", stats) for i in range(args.clients)]
+    rates = {'code_change': args.typing_rate, 'cursor_move': args.cursor_rate, 'chat_message': args.chat_rate}
+    peak_rss = [0]
+    sampling = threading.Event()
+
+    def sample_rss():
+        while not sampling.wait(0.5):
+            sample = process_sample(pid)
+            if sample:
+                peak_rss[0] = max(peak_rss[0], sample[1])
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+
+    try:
+        started = time.perf_counter()
+        for collaborator in collaborators:
+            try:
+                collaborator.connect(url, args.file_size)
+            except socketio.exceptions.ConnectionError:
+                stats.error('connect_failed')
+        connected = [c for c in collaborators if c.client.connected]
+        connect_seconds = time.perf_counter() - started
+
+        drive(connected, rates, time.perf_counter() + args.warmup)
+        bytes_before = sum(c.client.bytes_sent for c in connected), sum(c.client.bytes_received for c in connected)
+        server_before = process_sample(pid)
+        harness_before = os.times()
+        stats.measuring = True
+        measure_started = time.perf_counter()
+        drive(connected, rates, measure_started + args.duration)
+        time.sleep(0.5)  # let in-flight broadcasts land
+        stats.measuring = False
+        elapsed = time.perf_counter() - measure_started
+        server_after = process_sample(pid)
+        harness_after = os.times()
+        bytes_after = sum(c.client.bytes_sent for c in connected), sum(c.client.bytes_received for c in connected)
+
+        for collaborator in connected:
+            collaborator.client.emit('leave', {'room': collaborator.room})
+        # Each disconnect waits for the close handshake, so they run side by side
+        for collaborator in connected:
+            collaborator.leaving = True
+        closers = [threading.Thread(target=c.client.disconnect) for c in connected]
+        for closer in closers:
+            closer.start()
+        for closer in closers:
+            closer.join()
+    finally:
+        sampling.set()
+        if proc is not None:
+            proc.terminate()
+            proc.wait(10)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latency = {}
+    for event, samples in sorted(stats.latencies.items()):
+        samples.sort()
+        latency[event] = {
+            'count': len(samples),
+            'p50': percentile(samples, 0.5) * 1000,
+            'p99': percentile(samples, 0.99) * 1000,
+            'mean': sum(samples) / len(samples) * 1000,
+            'max': samples[-1] * 1000,
+        }
+    server = None
+    if server_before and server_after:
+        cpu = server_after[0] - server_before[0]
+        server = {
+            'cpu_seconds': cpu,
+            'cpu_percent': cpu / elapsed * 100,
+            'rss_mb': server_after[1] / 2 ** 20,
+            'peak_rss_mb': max(peak_rss[0], server_after[2] or 0) / 2 ** 20,
+        }
+    harness_cpu = (harness_after.user + harness_after.system - harness_before.user - harness_before.system)
+    sent, received = bytes_after[0] - bytes_before[0], bytes_after[1] - bytes_before[1]
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        'benchmark': 'socketio_load',
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+        'connected': len(connected),
+        'connect_seconds': connect_seconds,
+        'duration_seconds': elapsed,
+        'throughput': {
+            'sent_per_second': {event: count / elapsed for event, count in sorted(stats.sent_counts.items())},
+            'received_per_second': {event: value['count'] / elapsed for event, value in latency.items()},
+        },
+        'latency_ms': latency,
+        'server': server,
+        'harness_cpu_percent': harness_cpu / elapsed * 100,
+        'bytes': {
+            'sent': sent,
+            'received': received,
+            'sent_per_second': sent / elapsed,
+            'received_per_second': received / elapsed,
+        },
+        'errors': stats.errors,
+    }
+
+
+def print_report(report):
+    print(f"{report['connected']} clients connected in {report['connect_seconds']:.1f}s, "
+          f"measured for {report['duration_seconds']:.1f}s")
+    print(f"\n{'event':<14} {'sent/s':>9} {'recv/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    sent = report['throughput']['sent_per_second']
+    broadcasts = {'code_change': 'update_code', 'cursor_move': 'presence', 'chat_message': 'chat_message'}
+    for event, broadcast in broadcasts.items():
+        stats = report['latency_ms'].get(broadcast)
+        received = report['throughput']['received_per_second'].get(broadcast, 0)
+        if stats:
+            print(f"{event:<14} {sent.get(event, 0):>9.1f} {received:>9.1f} "
+                  f"{stats['p50']:>8.1f} {stats['p99']:>8.1f} {stats['max']:>8.1f}")
+        else:
+            print(f"{event:<14} {sent.get(event, 0):>9.1f} {received:>9.1f} {'-':>8} {'-':>8} {'-':>8}")
+    server = report['server']
+    if server:
+        print(f"\nserver: {server['cpu_percent']:.0f}% CPU, {server['rss_mb']:.0f} MB RSS "
+              f"(peak {server['peak_rss_mb']:.0f} MB)")
+    print(f"harness: {report['harness_cpu_percent']:.0f}% CPU")
+    print(f"wire: {report['bytes']['sent_per_second'] / 1024:.0f} KB/s sent, "
+          f"{report['bytes']['received_per_second'] / 1024:.0f} KB/s received")
+    if report['errors']:
+        print(f"errors: {report['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=20, help='seconds measured')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds of load before measuring')
+    parser.add_argument('--typing-rate', type=float, default=2, help='code_change per second per client')
+    parser.add_argument('--cursor-rate', type=float, default=5, help='cursor_move per second per client')
+    parser.add_argument('--chat-rate', type=float, default=0.1, help='chat_message per second per client')
+    parser.add_argument('--file-size', type=int, default=2000, help='bytes of content in each code_change')
+    parser.add_argument('--url', help='use a running server instead of starting one')
+    parser.add_argument('--pid', type=int, help='process id of the --url server, for CPU and RSS')
+    parser.add_argument('--json', help='write the report as JSON to this file ("-" for stdout)')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
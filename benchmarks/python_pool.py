@@ -0,0 +1,67 @@
+"""Cold vs warm-pool latency for Python code execution.
+
+Usage: python benchmarks/python_pool.py [--runs 30] [--pool 2] [--gap 0.2]
+
+Each run goes through execute_code exactly as /api/run does. The gap
+between runs gives the pool time to refill, as it would between real
+submissions.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+PROGRAMS = {
+    'hello': 'print("Hello, World!")\n',
+    'imports': 'import collections, itertools, math, re\nprint(math.sqrt(sum(range(1000))))\n',
+    'stdin': 'name = input()\nprint(f"Hello, {name}")\n',
+}
+
+
+def measure(code, runs, gap):
+    """Latencies in milliseconds for repeated runs of one program"""
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = app.execute_code('python', code, 'bench\n')
+        samples.append((time.perf_counter() - start) * 1000)
+        if result['error']:
+            raise SystemExit(f"run failed: {result['output']}")
+        time.sleep(gap)
+    return samples
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'mean': statistics.mean(samples),
+        'p50': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=30)
+    parser.add_argument('--pool', type=int, default=2)
+    parser.add_argument('--gap', type=float, default=0.2, help='seconds between runs')
+    args = parser.parse_args()
+
+    print(f"{'program':<10} {'mode':<5} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for name, code in PROGRAMS.items():
+        for mode, size in (('cold', 0), ('warm', args.pool)):
+            app.PYTHON_POOL_SIZE = size
+            app.refill_python_pool()
+            time.sleep(args.gap)
+            stats = summarize(measure(code, args.runs, args.gap))
+            print(f"{name:<10} {mode:<5} {stats['mean']:>8.1f} {stats['p50']:>8.1f} {stats['p95']:>8.1f}")
+        app.shutdown_python_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""Operational transformation for collaborative text editing.
+
+Edits travel as text operations: a list of components applied left to right
+over the document, where an int retains that many characters, a str inserts
+text and {'d': n} deletes n characters. Lengths are counted in UTF-16 code
+units so they line up with the offsets reported by the browser.
+"""
+import re
+
+_ASTRAL_RE = re.compile('[\U00010000-\U0010FFFF]')
+
+def utf16_len(text):
+    """Length of a string in UTF-16 code units"""
+    if text.isascii():
+        return len(text)
+    return len(text.encode('utf-16-le', 'surrogatepass')) // 2
+
+def split_utf16(text, units):
+    """Split a string after the given number of UTF-16 code units"""
+    if text.isascii() or not _ASTRAL_RE.search(text):
+        return text[:units], text[units:]
+    data = text.encode('utf-16-le', 'surrogatepass')
+    return (data[:units * 2].decode('utf-16-le', 'surrogatepass'),
+            data[units * 2:].decode('utf-16-le', 'surrogatepass'))
+
+def component_length(component):
+    """Number of document characters a component spans"""
+    if isinstance(component, int):
+        return component
+    if isinstance(component, str):
+        return utf16_len(component)
+    return component['d']
+
+def append_component(op, component):
+    """Append a component to an op, merging it with the previous one"""
+    if component in (0, '') or (isinstance(component, dict) and not component['d']):
+        return
+    if op:
+        last = op[-1]
+        if isinstance(component, int) and isinstance(last, int):
+            op[-1] = last + component
+            return
+        if isinstance(component, str) and isinstance(last, str):
+            op[-1] = last + component
+            return
+        if isinstance(component, dict) and isinstance(last, dict):
+            op[-1] = {'d': last['d'] + component['d']}
+            return
+    op.append(component)
+
+def trim_op(op):
+    """Drop the trailing retain, which is implicit"""
+    if op and isinstance(op[-1], int):
+        op.pop()
+    return op
+
+class _OpIterator:
+    """Walks an op component by component, splitting components on demand"""
+
+    def __init__(self, op):
+        self.op = op
+        self.index = 0
+        self.offset = 0
+        self.rest = ''
+
+    def peek(self):
+        return self.op[self.index] if self.index < len(self.op) else None
+
+    def take(self, units, indivisible=None):
+        """Take up to `units` of the current component (-1 takes all of it)"""
+        if self.index == len(self.op):
+            return None if units == -1 else units
+
+        component = self.op[self.index]
+        if isinstance(component, int):
+            remaining = component - self.offset
+            part = remaining if units == -1 or remaining <= units else units
+        elif isinstance(component, str):
+            rest = self.rest if self.offset else component
+            if units == -1 or indivisible == 'i' or utf16_len(rest) <= units:
+                self.index += 1
+                self.offset = 0
+                return rest
+            # Split inserts are kept as strings since a split can fall
+            # inside a surrogate pair
+            head, self.rest = split_utf16(rest, units)
+            self.offset += units
+            return head
+        else:
+            remaining = component['d'] - self.offset
+            if units == -1 or indivisible == 'd' or remaining <= units:
+                part = remaining
+            else:
+                part = units
+            part = {'d': part}
+
+        length = component_length(part)
+        if self.offset + length == component_length(component):
+            self.index += 1
+            self.offset = 0
+        else:
+            self.offset += length
+        return part
+
+def check_text_op(op):
+    """Validate the shape of an op received from a client"""
+    if not isinstance(op, list):
+        return False
+    for component in op:
+        if isinstance(component, bool):
+            return False
+        if isinstance(component, int):
+            if component <= 0:
+                return False
+        elif isinstance(component, str):
+            if not component:
+                return False
+        elif isinstance(component, dict):
+            if not isinstance(component.get('d'), int) or isinstance(component['d'], bool) or component['d'] <= 0:
+                return False
+        else:
+            return False
+    return True
+
+def apply_text_op(content, op):
+    """Apply an op to a string, raising ValueError if it does not fit"""
+    if content.isascii() or not _ASTRAL_RE.search(content):
+        parts = []
+        pos = 0
+        for component in op:
+            if isinstance(component, int):
+                if pos + component > len(content):
+                    raise ValueError("Operation retains past end of document")
+                parts.append(content[pos:pos + component])
+                pos += component
+            elif isinstance(component, str):
+                parts.append(component)
+            else:
+                if pos + component['d'] > len(content):
+                    raise ValueError("Operation deletes past end of document")
+                pos += component['d']
+        parts.append(content[pos:])
+        return ''.join(parts)
+
+    # Documents containing astral characters are patched as UTF-16
+    data = content.encode('utf-16-le', 'surrogatepass')
+    parts = []
+    pos = 0
+    for component in op:
+        if isinstance(component, int):
+            if pos + component * 2 > len(data):
+                raise ValueError("Operation retains past end of document")
+            parts.append(data[pos:pos + component * 2])
+            pos += component * 2
+        elif isinstance(component, str):
+            parts.append(component.encode('utf-16-le', 'surrogatepass'))
+        else:
+            if pos + component['d'] * 2 > len(data):
+                raise ValueError("Operation deletes past end of document")
+            pos += component['d'] * 2
+    parts.append(data[pos:])
+    return b''.join(parts).decode('utf-16-le', 'surrogatepass')
+
+def transform_text_op(op, other, side):
+    """Transform op so it applies after the concurrent op `other`.
+
+    `side` breaks ties between inserts at the same position: 'left' keeps
+    op's insert before other's, 'right' puts it after.
+    """
+    result = []
+    it = _OpIterator(op)
+
+    for component in other:
+        if isinstance(component, int):
+            length = component
+            while length > 0:
+                chunk = it.take(length, 'i')
+                append_component(result, chunk)
+                if not isinstance(chunk, str):
+                    length -= component_length(chunk)
+        elif isinstance(component, str):
+            if side == 'left' and isinstance(it.peek(), str):
+                append_component(result, it.take(-1))
+            append_component(result, utf16_len(component))
+        else:
+            length = component['d']
+            while length > 0:
+                chunk = it.take(length, 'i')
+                if isinstance(chunk, int):
+                    length -= chunk
+                elif isinstance(chunk, str):
+                    append_component(result, chunk)
+                else:
+                    length -= chunk['d']
+
+    while True:
+        chunk = it.take(-1)
+        if chunk is None:
+            break
+        append_component(result, chunk)
+
+    return trim_op(result)
+
+def compose_text_ops(op1, op2):
+    """Compose two consecutive ops into one"""
+    result = []
+    it = _OpIterator(op1)
+
+    for component in op2:
+        if isinstance(component, int):
+            length = component
+            while length > 0:
+                chunk = it.take(length, 'd')
+                append_component(result, chunk)
+                if not isinstance(chunk, dict):
+                    length -= component_length(chunk)
+        elif isinstance(component, str):
+            append_component(result, component)
+        else:
+            length = component['d']
+            while length > 0:
+                chunk = it.take(length, 'd')
+                if isinstance(chunk, int):
+                    append_component(result, {'d': chunk})
+                    length -= chunk
+                elif isinstance(chunk, str):
+                    length -= utf16_len(chunk)
+                else:
+                    append_component(result, chunk)
+
+    while True:
+        chunk = it.take(-1)
+        if chunk is None:
+            break
+        append_component(result, chunk)
+
+    return trim_op(result)
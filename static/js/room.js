@@ -14,10 +14,31 @@ let settings = {
 };
 let aiApiKey = localStorage.getItem('aiApiKey') || '';
 let isCodeChanging = false;
-let saveTimeout = null;
+let saveRequested = false;
+let openRequested = null;  // file to open once our edits to the current one are acknowledged
 let remoteCursors = {};
+let docRevision = 0;
+let docEpoch = null;
+let pendingOp = null;  // sent to the server, waiting for code_ack
+let bufferOp = null;   // local edits not yet sent
+let ackedRevision = null;  // revision our pendingOp landed at, once acked
+let remoteOps = {};        // revision -> remote op that arrived out of order
+let resyncTimer = null;
+let currentJobId = null;
+let fileIndexVersion = null; // X-Index-Version of the file list on screen
+let streamJobId = null;     // run whose output is streaming into the output panel
+let streamHasOutput = false;
+let runInteractive = false; // stdin stays open for typed input while our run is going
+let presenceRate = parseFloat(localStorage.getItem('presenceRate')) || 10;  // updates per second
+let presenceTimer = null;
 let aiProvider = localStorage.getItem('aiProvider') || 'gemini';
 let aiModel = localStorage.getItem('aiModel') || 'gemini-pro';
+let aiStreamId = null;      // assistant answer currently streaming in
+let aiStreamSpan = null;
+let aiStreamHasText = false;
+let fileDiagnostics = {};   // id -> lint diagnostic for the open file
+let largeFile = null;       // {loaded, total, version, loading} while a large file is shown read-only
+const LARGE_FILE_WINDOW = 2000;  // lines fetched per range read
 
 // ============ Initialization ============
 document.addEventListener('DOMContentLoaded', function () {
@@ -52,31 +73,65 @@ function initializeEditor() {
 
     editor.session.on('change', function (delta) {
         if (!isCodeChanging && currentFile) {
-            const content = editor.getValue();
-            socket.emit('code_change', {
-                room: ROOM_ID,
-                file: currentFile,
-                content: content,
-                auto_save: settings.auto_save
-            });
+            const op = deltaToOp(delta);
+            bufferOp = bufferOp ? otCompose(bufferOp, op) : op;
+            flushOps();
 
             updateFileStatus('Modified');
-
-            if (settings.auto_save) {
-                clearTimeout(saveTimeout);
-                saveTimeout = setTimeout(function () {
-                    saveCurrentFile();
-                }, 2000);
-            }
         }
     });
 
-    editor.selection.on('changeCursor', function () {
-        const cursor = editor.getCursorPosition();
-        socket.emit('cursor_move', {
-            room: ROOM_ID,
-            cursor: cursor
-        });
+    editor.selection.on('changeCursor', schedulePresence);
+    editor.selection.on('changeSelection', schedulePresence);
+
+    // Large files load the next window of lines as the end comes into view
+    editor.session.on('changeScrollTop', function () {
+        if (largeFile && editor.getLastVisibleRow() > editor.session.getLength() - 200) loadLargeFileLines();
+    });
+}
+
+// ============ Presence ============
+// Cursor and selection are sent at most presenceRate times per second; the
+// server batches everyone's latest state into one presence frame per tick.
+function schedulePresence() {
+    if (presenceTimer || !currentFile) return;
+    presenceTimer = setTimeout(sendPresence, 1000 / presenceRate);
+}
+
+function sendPresence() {
+    presenceTimer = null;
+    if (!currentFile) return;
+
+    socket.emit('cursor_move', {
+        room: ROOM_ID,
+        file: currentFile,
+        cursor: editor.getCursorPosition()
+    });
+
+    const range = editor.getSelectionRange();
+    socket.emit('selection_change', {
+        room: ROOM_ID,
+        file: currentFile,
+        selection: range.isEmpty() ? null : { start: range.start, end: range.end }
+    });
+}
+
+function renderRemoteCursors() {
+    const session = editor.session;
+    const Range = ace.require('ace/range').Range;
+
+    Object.values(remoteCursors).forEach(remote => {
+        (remote.markers || []).forEach(id => session.removeMarker(id));
+        remote.markers = [];
+        if (remote.file !== currentFile) return;
+
+        const c = remote.cursor;
+        remote.markers.push(session.addMarker(new Range(c.row, c.column, c.row, c.column + 1), 'remote-cursor', 'text', true));
+        if (remote.selection) {
+            const sel = remote.selection;
+            remote.markers.push(session.addMarker(
+                new Range(sel.start.row, sel.start.column, sel.end.row, sel.end.column), 'remote-selection', 'text', true));
+        }
     });
 }
 
@@ -89,7 +144,8 @@ function initializeSocket() {
         socket.emit('join', {
             room: ROOM_ID,
             username: username,
-            color: userColor
+            color: userColor,
+            presence_rate: presenceRate
         });
     });
 
@@ -108,28 +164,136 @@ function initializeSocket() {
         addChatMessage('System', data.username + ' left the room', 'system');
 
         if (remoteCursors[data.sid]) {
-            // Remove remote cursor marker if implemented
+            (remoteCursors[data.sid].markers || []).forEach(id => editor.session.removeMarker(id));
             delete remoteCursors[data.sid];
         }
     });
 
+    socket.on('presence', function (data) {
+        data.users.forEach(user => {
+            if (user.sid === socket.id) return;
+            remoteCursors[user.sid] = Object.assign(remoteCursors[user.sid] || {}, user);
+        });
+        renderRemoteCursors();
+    });
+
     socket.on('update_code', function (data) {
         if (data.file === currentFile) {
-            isCodeChanging = true;
-            const cursor = editor.getCursorPosition();
-            editor.setValue(data.content, -1);
-            editor.moveCursorToPosition(cursor);
-            isCodeChanging = false;
+            resetDocument(data.content, data.rev, data.epoch);
+            updateFileStatus('Synced');
+        }
+    });
+
+    socket.on('resync', function (data) {
+        if (data.file === currentFile) {
+            resetDocument(data.content, data.rev, data.epoch);
             updateFileStatus('Synced');
+            if (openRequested) openFile(openRequested);
         }
     });
 
+    // Acks and remote ops can arrive out of order when the room is served by
+    // several workers, so both are applied strictly in revision order
+    socket.on('code_ack', function (data) {
+        if (data.file !== currentFile || !pendingOp) return;
+        ackedRevision = data.rev;
+        drainRevisions();
+    });
+
+    socket.on('code_delta', function (data) {
+        if (data.file !== currentFile || data.rev <= docRevision) return;
+        remoteOps[data.rev] = data.op;
+        drainRevisions();
+    });
+
+    socket.on('file_saved', function (data) {
+        if (data.file !== currentFile || pendingOp || bufferOp) return;
+        updateFileStatus(data.success === false ? 'Error' : 'Saved');
+    });
+
+
     socket.on('chat_message', function (data) {
         addChatMessage(data.username, data.message, 'user');
     });
 
+    socket.on('job_complete', function (data) {
+        if (data.job_id === currentJobId) showJobResult(data);
+        else if (data.job_id === streamJobId) finishStream(data);
+    });
+
+    socket.on('settings_updated', function (data) {
+        settings = data.settings;
+        applySettings();
+    });
+
+    socket.on('run_started', function (data) {
+        const out = document.getElementById('output-text');
+        streamJobId = data.job_id;
+        if (data.owner === socket.id) {
+            currentJobId = data.job_id;
+            streamHasOutput = false;
+            setRunButton(true);
+            out.textContent = data.position ? 'Queued (' + data.position + ' ahead)...' : 'Running...';
+            if (runInteractive) {
+                document.getElementById('code-input').placeholder = 'Type input and press Enter (Ctrl+D to end input)...';
+            }
+            // The result is pushed as job_complete; poll too in case the socket drops
+            setTimeout(() => pollJob(data.job_id), 2000);
+        } else {
+            streamHasOutput = true;
+            out.textContent = data.username + ' is running ' + (data.filename || data.language) + '...\n';
+        }
+    });
+
+    socket.on('run_output', function (data) {
+        if (data.job_id !== streamJobId) return;
+        if (!streamHasOutput) {
+            document.getElementById('output-text').textContent = '';
+            streamHasOutput = true;
+        }
+        appendRunOutput(data.data, data.stream);
+    });
+
+    socket.on('files_changed', function (data) {
+        if (data.version !== fileIndexVersion) loadFiles();
+        if (data.removed.includes(currentFile)) closeCurrentFile();
+        else if (largeFile && data.changed.includes(currentFile)) openFile(currentFile);
+    });
+
+    socket.on('diagnostics', function (data) {
+        if (data.file !== currentFile) return;
+        data.removed.forEach(id => delete fileDiagnostics[id]);
+        data.added.forEach(d => fileDiagnostics[d.id] = d);
+        showDiagnostics();
+    });
+
+    socket.on('ai_chunk', function (data) {
+        if (data.id !== aiStreamId) return;
+        if (!aiStreamHasText) {
+            aiStreamSpan.textContent = '';
+            aiStreamHasText = true;
+        }
+        aiStreamSpan.textContent += data.text;
+        const container = document.getElementById('ai-messages');
+        container.scrollTop = container.scrollHeight;
+    });
+
+    socket.on('ai_done', function (data) {
+        if (data.id !== aiStreamId) return;
+        if (data.error) aiStreamSpan.textContent = aiStreamHasText ? aiStreamSpan.textContent + '\n' + data.error : data.error;
+        else if (data.cancelled) aiStreamSpan.textContent += ' [stopped]';
+        aiStreamId = null;
+        aiStreamSpan = null;
+        setAIButton(false);
+    });
+
+    socket.on('run_error', function (data) {
+        document.getElementById('output-text').textContent = data.error;
+    });
+
     socket.on('terminal_output', function (data) {
-        addTerminalOutput(data.command, data.output);
+        if (data.command !== undefined) addTerminalOutput(data.command, data.output);
+        else appendTerminalText(data.output);
     });
 
     socket.on('disconnect', function () {
@@ -139,6 +303,235 @@ function initializeSocket() {
     });
 }
 
+// ============ Operational Transform ============
+// Ops are lists of components: a number retains that many characters, a
+// string inserts text and {d: n} deletes n characters. Mirrors app.py.
+
+function otComponentLength(c) {
+    if (typeof c === 'number') return c;
+    if (typeof c === 'string') return c.length;
+    return c.d;
+}
+
+function otAppend(op, c) {
+    if (c === 0 || c === '' || (typeof c === 'object' && c.d === 0)) return;
+    const last = op[op.length - 1];
+    if (typeof c === 'number' && typeof last === 'number') op[op.length - 1] = last + c;
+    else if (typeof c === 'string' && typeof last === 'string') op[op.length - 1] = last + c;
+    else if (typeof c === 'object' && typeof last === 'object') op[op.length - 1] = { d: last.d + c.d };
+    else op.push(c);
+}
+
+function otTrim(op) {
+    if (op.length && typeof op[op.length - 1] === 'number') op.pop();
+    return op;
+}
+
+function otIterator(op) {
+    let index = 0;
+    let offset = 0;
+    return {
+        peek: () => op[index],
+        take: (n, indivisible) => {
+            if (index === op.length) return n === -1 ? null : n;
+            const c = op[index];
+            let part;
+            if (typeof c === 'number') {
+                part = (n === -1 || c - offset <= n) ? c - offset : n;
+            } else if (typeof c === 'string') {
+                part = (n === -1 || indivisible === 'i' || c.length - offset <= n)
+                    ? c.slice(offset) : c.slice(offset, offset + n);
+            } else {
+                part = { d: (n === -1 || indivisible === 'd' || c.d - offset <= n) ? c.d - offset : n };
+            }
+            offset += otComponentLength(part);
+            if (offset === otComponentLength(c)) {
+                index++;
+                offset = 0;
+            }
+            return part;
+        }
+    };
+}
+
+function otTransform(op, other, side) {
+    const result = [];
+    const it = otIterator(op);
+
+    for (const c of other) {
+        if (typeof c === 'number') {
+            let length = c;
+            while (length > 0) {
+                const chunk = it.take(length, 'i');
+                otAppend(result, chunk);
+                if (typeof chunk !== 'string') length -= otComponentLength(chunk);
+            }
+        } else if (typeof c === 'string') {
+            if (side === 'left' && typeof it.peek() === 'string') otAppend(result, it.take(-1));
+            otAppend(result, c.length);
+        } else {
+            let length = c.d;
+            while (length > 0) {
+                const chunk = it.take(length, 'i');
+                if (typeof chunk === 'number') length -= chunk;
+                else if (typeof chunk === 'string') otAppend(result, chunk);
+                else length -= chunk.d;
+            }
+        }
+    }
+
+    let chunk;
+    while ((chunk = it.take(-1)) !== null) otAppend(result, chunk);
+    return otTrim(result);
+}
+
+function otCompose(op1, op2) {
+    const result = [];
+    const it = otIterator(op1);
+
+    for (const c of op2) {
+        if (typeof c === 'number') {
+            let length = c;
+            while (length > 0) {
+                const chunk = it.take(length, 'd');
+                otAppend(result, chunk);
+                if (typeof chunk !== 'object') length -= otComponentLength(chunk);
+            }
+        } else if (typeof c === 'string') {
+            otAppend(result, c);
+        } else {
+            let length = c.d;
+            while (length > 0) {
+                const chunk = it.take(length, 'd');
+                if (typeof chunk === 'number') {
+                    otAppend(result, { d: chunk });
+                    length -= chunk;
+                } else if (typeof chunk === 'string') {
+                    length -= chunk.length;
+                } else {
+                    otAppend(result, chunk);
+                }
+            }
+        }
+    }
+
+    let chunk;
+    while ((chunk = it.take(-1)) !== null) otAppend(result, chunk);
+    return otTrim(result);
+}
+
+function deltaToOp(delta) {
+    const doc = editor.session.doc;
+    const text = delta.lines.join(doc.getNewLineCharacter());
+    const op = [];
+    otAppend(op, doc.positionToIndex(delta.start));
+    otAppend(op, delta.action === 'insert' ? text : { d: text.length });
+    return op;
+}
+
+function applyOpToEditor(op) {
+    const doc = editor.session.doc;
+    const Range = ace.require('ace/range').Range;
+    let index = 0;
+
+    isCodeChanging = true;
+    for (const c of op) {
+        if (typeof c === 'number') {
+            index += c;
+        } else if (typeof c === 'string') {
+            doc.insert(doc.indexToPosition(index), c);
+            index += c.length;
+        } else {
+            const start = doc.indexToPosition(index);
+            const end = doc.indexToPosition(index + c.d);
+            doc.remove(new Range(start.row, start.column, end.row, end.column));
+        }
+    }
+    isCodeChanging = false;
+}
+
+function applyRemoteOp(op) {
+    // Bring the remote op past our unacknowledged edits and vice versa
+    if (pendingOp) {
+        const transformed = otTransform(pendingOp, op, 'right');
+        op = otTransform(op, pendingOp, 'left');
+        pendingOp = transformed;
+    }
+    if (bufferOp) {
+        const transformed = otTransform(bufferOp, op, 'right');
+        op = otTransform(op, bufferOp, 'left');
+        bufferOp = transformed;
+    }
+    applyOpToEditor(op);
+}
+
+function drainRevisions() {
+    let progressed = false;
+    for (;;) {
+        const next = docRevision + 1;
+        if (ackedRevision === next) {
+            docRevision = next;
+            ackedRevision = null;
+            pendingOp = null;
+            flushOps();
+            if (saveRequested && !pendingOp) saveCurrentFile();
+        } else if (next in remoteOps) {
+            const op = remoteOps[next];
+            delete remoteOps[next];
+            docRevision = next;
+            applyRemoteOp(op);
+            updateFileStatus('Synced');
+        } else {
+            break;
+        }
+        progressed = true;
+    }
+
+    // A gap that does not fill in soon means we missed something
+    if (progressed || (ackedRevision === null && !Object.keys(remoteOps).length)) {
+        clearTimeout(resyncTimer);
+        resyncTimer = null;
+    }
+    if (!resyncTimer && (ackedRevision !== null || Object.keys(remoteOps).length)) {
+        resyncTimer = setTimeout(function () {
+            resyncTimer = null;
+            socket.emit('request_resync', { room: ROOM_ID, file: currentFile });
+        }, 3000);
+    }
+    if (openRequested && !pendingOp && !bufferOp) openFile(openRequested);
+}
+
+function flushOps() {
+    if (pendingOp || !bufferOp || !currentFile) return;
+    pendingOp = bufferOp;
+    bufferOp = null;
+    socket.emit('code_delta', {
+        room: ROOM_ID,
+        file: currentFile,
+        rev: docRevision,
+        epoch: docEpoch,
+        op: pendingOp,
+        auto_save: settings.auto_save
+    });
+}
+
+function resetDocument(content, revision, epoch) {
+    isCodeChanging = true;
+    const cursor = editor.getCursorPosition();
+    editor.setValue(content, -1);
+    editor.moveCursorToPosition(cursor);
+    isCodeChanging = false;
+
+    docRevision = revision || 0;
+    docEpoch = epoch || null;
+    pendingOp = null;
+    bufferOp = null;
+    ackedRevision = null;
+    remoteOps = {};
+    clearTimeout(resyncTimer);
+    resyncTimer = null;
+}
+
 // ============ Event Listeners ============
 function setupEventListeners() {
     document.getElementById('copy-room-id').addEventListener('click', function () {
@@ -159,6 +552,7 @@ function setupEventListeners() {
     document.getElementById('refresh-files-btn').addEventListener('click', loadFiles);
     document.getElementById('save-file-btn').addEventListener('click', saveCurrentFile);
     document.getElementById('run-code-btn').addEventListener('click', runCode);
+    document.getElementById('code-input').addEventListener('keydown', sendRunInput);
     document.getElementById('analyze-code-btn').addEventListener('click', analyzeCode);
 
     document.getElementById('ai-assist-btn').addEventListener('click', toggleAIPanel);
@@ -199,6 +593,13 @@ function setupEventListeners() {
     document.getElementById('terminal-input').addEventListener('keypress', function (e) {
         if (e.key === 'Enter') executeTerminalCommand();
     });
+    document.getElementById('terminal-input').addEventListener('keydown', function (e) {
+        // Ctrl+C / Ctrl+D go to the running program unless text is selected
+        if (!e.ctrlKey || (e.key !== 'c' && e.key !== 'd')) return;
+        if (this.selectionStart !== this.selectionEnd) return;
+        e.preventDefault();
+        socket.emit('terminal_input', { room: ROOM_ID, control: e.key });
+    });
     document.getElementById('terminal-send').addEventListener('click', executeTerminalCommand);
 
     document.getElementById('send-ai-btn').addEventListener('click', sendAIMessage);
@@ -322,9 +723,15 @@ function setupTabs(tabSelector, panelSelector, tabAttr, panelAttr) {
 
 // ============ File Management ============
 function loadFiles() {
-    fetch('/api/files/' + ROOM_ID)
-        .then(res => res.json())
-        .then(files => displayFiles(files))
+    // Conditional refresh: the server answers 304 if the listing hasn't changed
+    const query = fileIndexVersion ? '?version=' + encodeURIComponent(fileIndexVersion) : '';
+    fetch('/api/files/' + ROOM_ID + query)
+        .then(res => {
+            if (res.status === 304) return null;
+            fileIndexVersion = res.headers.get('X-Index-Version');
+            return res.json();
+        })
+        .then(files => { if (files) displayFiles(files); })
         .catch(err => console.error(err));
 }
 
@@ -366,38 +773,95 @@ function displayFiles(files) {
 }
 
 function openFile(filename) {
+    // Edits to the current file are sent and acknowledged before switching away
+    if (currentFile && (pendingOp || bufferOp)) {
+        openRequested = filename;
+        flushOps();
+        return;
+    }
+    openRequested = null;
+
     fetch('/api/files/' + ROOM_ID + '/' + filename)
         .then(res => res.json())
         .then(data => {
+            if (data.error) return loadFiles();  // deleted since the list was loaded
             currentFile = filename;
-            isCodeChanging = true;
-            editor.setValue(data.content, -1);
-            isCodeChanging = false;
+            setLargeFile(data.large ? { loaded: 0, total: null, version: data.version, loading: false } : null);
+            resetDocument(data.large ? '' : data.content, data.revision, data.epoch);
+            // Binary files have no live document to edit
+            if (data.binary) editor.setReadOnly(true);
 
             currentLanguage = detectLanguage(filename);
             setEditorMode(currentLanguage);
 
             document.getElementById('current-file').textContent = filename;
-            updateFileStatus('Loaded');
+            updateFileStatus(data.binary ? 'Read-only' : 'Loaded');
+            if (data.large) return loadLargeFileLines();
+            loadDiagnostics(filename);
         });
 }
 
-function saveCurrentFile() {
-    if (!currentFile) return;
-    const content = editor.getValue();
+// Large files are shown read-only and fetched a window of lines at a time
+function setLargeFile(state) {
+    largeFile = state;
+    editor.setReadOnly(!!state);
+}
 
-    fetch('/api/save_file', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ room_id: ROOM_ID, filename: currentFile, content: content })
-    })
+function loadLargeFileLines() {
+    const file = largeFile;
+    if (!file || file.loading || file.loaded === file.total) return;
+    file.loading = true;
+
+    fetch('/api/file_range/' + ROOM_ID + '/' + currentFile + '?line=' + file.loaded + '&count=' + LARGE_FILE_WINDOW)
         .then(res => res.json())
         .then(data => {
-            if (data.success) updateFileStatus('Saved');
-            else updateFileStatus('Error');
+            file.loading = false;
+            if (file !== largeFile) return;
+            if (data.version !== file.version) return openFile(currentFile);
+
+            isCodeChanging = true;
+            editor.session.insert({ row: editor.session.getLength(), column: 0 }, data.text);
+            isCodeChanging = false;
+            file.loaded = data.line + (data.truncated ? 1 : data.count);
+            file.total = data.total_lines;
+            updateFileStatus('Read-only: ' + file.loaded + ' of ' + file.total + ' lines');
         });
 }
 
+function loadDiagnostics(filename) {
+    fileDiagnostics = {};
+    showDiagnostics();
+    fetch('/api/diagnostics/' + ROOM_ID + '/' + filename)
+        .then(res => res.json())
+        .then(data => {
+            if (filename !== currentFile) return;
+            data.diagnostics.forEach(d => fileDiagnostics[d.id] = d);
+            showDiagnostics();
+        });
+}
+
+function showDiagnostics() {
+    editor.session.setAnnotations(Object.values(fileDiagnostics).map(d => ({
+        row: d.line - 1,
+        column: d.column ? d.column - 1 : 0,
+        text: '[' + d.source + '] ' + d.message,
+        type: d.severity
+    })));
+}
+
+function saveCurrentFile() {
+    if (!currentFile || largeFile) return;
+
+    // The server holds the document; wait until our edits have reached it
+    if (pendingOp || bufferOp) {
+        saveRequested = true;
+        flushOps();
+        return;
+    }
+    saveRequested = false;
+    socket.emit('save_file', { room: ROOM_ID, file: currentFile });
+}
+
 function createNewFile() {
     const filename = document.getElementById('new-file-name').value.trim();
     const language = document.getElementById('file-language').value;
@@ -439,37 +903,101 @@ function deleteFile(filename) {
 
 function closeCurrentFile() {
     currentFile = null;
-    editor.setValue('', -1);
+    openRequested = null;
+    setLargeFile(null);
+    resetDocument('', 0);
     document.getElementById('current-file').textContent = 'No file';
     document.getElementById('file-status').textContent = '';
 }
 
 // ============ Code Execution ============
 function runCode() {
+    if (currentJobId) return cancelRun();
     if (!currentFile) return alert('No file open');
 
     document.querySelector('[data-output-tab="output"]').click();
-    document.getElementById('output-text').textContent = 'Running...';
+    document.getElementById('output-text').textContent = 'Queued...';
 
+    // Input given up front is sent in one go; otherwise it can be typed while the program runs
     const input = document.getElementById('code-input').value;
+    runInteractive = !input;
+
+    socket.emit('run_code', {
+        room: ROOM_ID,
+        language: currentLanguage,
+        code: editor.getValue(),
+        input: input,
+        file: currentFile
+    });
+}
 
-    fetch('/api/run', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-            language: currentLanguage,
-            code: editor.getValue(),
-            input: input,
-            room_id: ROOM_ID,
-            filename: currentFile
-        })
-    })
+function sendRunInput(e) {
+    if (!currentJobId || !runInteractive) return;
+    const field = document.getElementById('code-input');
+    if (e.key === 'Enter') {
+        e.preventDefault();
+        socket.emit('run_input', { job_id: currentJobId, data: field.value + '\n' });
+        appendRunOutput(field.value + '\n', 'stdin');
+        field.value = '';
+    } else if (e.key === 'd' && e.ctrlKey) {
+        e.preventDefault();
+        socket.emit('run_input', { job_id: currentJobId, eof: true });
+    }
+}
+
+function appendRunOutput(text, stream) {
+    const out = document.getElementById('output-text');
+    if (stream === 'stdout') {
+        out.appendChild(document.createTextNode(text));
+    } else {
+        const span = document.createElement('span');
+        span.className = 'stream-' + stream;
+        span.textContent = text;
+        out.appendChild(span);
+    }
+    out.scrollTop = out.scrollHeight;
+}
+
+function finishStream(data) {
+    if (data.job_id !== streamJobId) return;
+    streamJobId = null;
+    if (!streamHasOutput) document.getElementById('output-text').textContent = '';
+    const result = data.result;
+    appendRunOutput(result.exit_code === undefined
+        ? result.output
+        : '\n[Process exited with code ' + result.exit_code + ']', 'status');
+}
+
+function pollJob(jobId) {
+    if (jobId !== currentJobId) return;
+    fetch('/api/jobs/' + jobId)
         .then(res => res.json())
         .then(data => {
-            document.getElementById('output-text').textContent = data.output;
+            if (data.result) showJobResult(data);
+            else if (data.status === 'running') document.getElementById('output-text').textContent = 'Running...';
+            if (!data.result && !data.error) setTimeout(() => pollJob(jobId), 2000);
         });
 }
 
+function showJobResult(data) {
+    if (data.job_id !== currentJobId) return;
+    currentJobId = null;
+    setRunButton(false);
+    document.getElementById('code-input').placeholder = 'Input for program...';
+    if (data.stream) finishStream(data);
+    else document.getElementById('output-text').textContent = data.result.output;
+}
+
+function cancelRun() {
+    fetch('/api/jobs/' + currentJobId + '/cancel', { method: 'POST' });
+}
+
+function setRunButton(running) {
+    document.getElementById('run-code-btn').innerHTML = running
+        ? '<i class="fas fa-stop"></i> Stop'
+        : '<i class="fas fa-play"></i> Run';
+}
+
 // ============ Chat & AI ============
 function sendChatMessage() {
     const input = document.getElementById('chat-input');
@@ -492,12 +1020,27 @@ function addChatMessage(username, message, type) {
 
 function executeTerminalCommand() {
     const input = document.getElementById('terminal-input');
-    const cmd = input.value.trim();
-    if (!cmd) return;
+    const cmd = input.value;
 
+    // Empty lines are sent too: a running program may be waiting for one
     socket.emit('terminal_input', { room: ROOM_ID, command: cmd });
     input.value = '';
-    // Optimistic UI could go here
+}
+
+function appendTerminalText(text) {
+    const container = document.getElementById('terminal-output');
+    let pre = container.lastElementChild;
+    if (!pre || !pre.classList.contains('terminal-stream')) {
+        pre = document.createElement('pre');
+        pre.className = 'terminal-stream';
+        container.appendChild(pre);
+    }
+    // The shell runs with TERM=dumb; drop any escape sequences and carriage returns that slip through
+    pre.appendChild(document.createTextNode(text
+        .replace(/\x1b\[[0-9;?]*[A-Za-z]/g, '')
+        .replace(/\x1b\][^\x07]*\x07/g, '')
+        .replace(/\r/g, '')));
+    container.scrollTop = container.scrollHeight;
 }
 
 function addTerminalOutput(command, output) {
@@ -514,6 +1057,10 @@ function loadAISettings() {
 }
 
 function sendAIMessage() {
+    if (aiStreamId) {
+        socket.emit('ai_cancel', { id: aiStreamId });
+        return;
+    }
     const input = document.getElementById('ai-input');
     const prompt = input.value.trim();
     if (!prompt) return;
@@ -525,24 +1072,23 @@ function sendAIMessage() {
 
     addAIMessage('You', prompt);
     input.value = '';
-    addAIMessage('AI', 'Thinking...');
 
-    fetch('/api/ai_chat', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-            prompt: prompt, context: context, api_key: aiApiKey,
-            provider: aiProvider, model: aiModel, task: document.getElementById('ai-task').value
-        })
-    })
-        .then(res => res.json())
-        .then(data => {
-            // remove 'Thinking...'
-            const msgs = document.getElementById('ai-messages');
-            if (msgs.lastChild && msgs.lastChild.textContent.includes('Thinking...')) msgs.removeChild(msgs.lastChild);
+    // The answer streams in as ai_chunk events; the button stops it meanwhile
+    aiStreamId = Date.now().toString(36) + Math.random().toString(36).slice(2);
+    aiStreamSpan = addAIMessage('AI', 'Thinking...');
+    aiStreamSpan.style.whiteSpace = 'pre-wrap';
+    aiStreamHasText = false;
+    setAIButton(true);
+    socket.emit('ai_stream', {
+        id: aiStreamId, prompt: prompt, context: context, api_key: aiApiKey,
+        provider: aiProvider, model: aiModel, task: document.getElementById('ai-task').value
+    });
+}
 
-            addAIMessage('AI', data.response);
-        });
+function setAIButton(streaming) {
+    const btn = document.getElementById('send-ai-btn');
+    btn.innerHTML = streaming ? '<i class="fas fa-stop"></i>' : '<i class="fas fa-paper-plane"></i>';
+    btn.title = streaming ? 'Stop' : 'Send';
 }
 
 function addAIMessage(sender, text) {
@@ -554,6 +1100,7 @@ function addAIMessage(sender, text) {
     div.innerHTML = `<strong>${sender}:</strong> <span>${text}</span>`;
     container.appendChild(div);
     container.scrollTop = container.scrollHeight;
+    return div.querySelector('span');
 }
 
 function analyzeCode() {
@@ -563,7 +1110,7 @@ function analyzeCode() {
     fetch('/api/analyze_code', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ code: editor.getValue(), language: currentLanguage })
+        body: JSON.stringify({ code: editor.getValue(), language: currentLanguage, room: ROOM_ID, file: currentFile })
     })
         .then(res => res.json())
         .then(data => {
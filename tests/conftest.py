@@ -0,0 +1,26 @@
+"""The app keeps rooms, settings and caches relative to the working directory,
+so the whole test session runs from a scratch directory."""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORKDIR = tempfile.mkdtemp(prefix='codesync_tests_')
+os.chdir(WORKDIR)
+atexit.register(shutil.rmtree, WORKDIR, True)
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def room():
+    """A fresh, empty room directory"""
+    room_id = 'test-' + uuid.uuid4().hex[:8]
+    app.ensure_dir(app.get_room_path(room_id))
+    return room_id
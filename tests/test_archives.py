@@ -0,0 +1,76 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+import app
+
+
+def zip_bytes(entries):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in entries.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def tar_bytes(entries, symlink=None):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for name, data in entries.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+        if symlink:
+            info = tarfile.TarInfo(symlink[0])
+            info.type = tarfile.SYMTYPE
+            info.linkname = symlink[1]
+            archive.addfile(info)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('name', ['../evil.py', '/etc/evil', 'a/../../evil', 'C:/evil', '..\\evil.py'])
+@pytest.mark.parametrize('pack', [zip_bytes, tar_bytes])
+def test_unsafe_paths_are_rejected(room, pack, name):
+    paths, error = app.import_archive(room, io.BytesIO(pack({'ok.py': b'x = 1\n', name: b'bad\n'})))
+    assert paths == [] and error.startswith("Unsafe path")
+    assert not os.path.exists(os.path.join(app.get_room_path(room), 'ok.py'))
+    assert not os.path.exists(os.path.join(app.ROOMS_DIR, 'evil.py'))
+
+
+def test_tar_links_are_skipped(room):
+    paths, error = app.import_archive(room, io.BytesIO(tar_bytes({'a.py': b'x = 1\n'}, symlink=('b.py', '/etc/passwd'))))
+    assert error is None and paths == ['a.py']
+    assert not os.path.lexists(os.path.join(app.get_room_path(room), 'b.py'))
+
+
+@pytest.mark.parametrize('export', [app.export_zip, app.export_tar])
+def test_export_round_trip(room, export):
+    app.save_file_content(room, 'main.py', 'print("é")\n')
+    app.save_file_content(room, 'src/util.py', 'def f():\n    pass\n')
+    with open(os.path.join(app.get_room_path(room), 'blob.bin'), 'wb') as f:
+        f.write(bytes(range(256)))
+    app.save_room_settings(room, {'theme': 'github'})
+    data = b''.join(export(room))
+
+    target = room + '-copy'
+    paths, error = app.import_archive(target, io.BytesIO(data))
+    assert error is None
+    assert set(paths) == {'main.py', 'src/util.py', 'blob.bin'}
+    assert app.read_file_from_disk(target, 'main.py') == 'print("é")\n'
+    with open(os.path.join(app.get_room_path(target), 'blob.bin'), 'rb') as f:
+        assert f.read() == bytes(range(256))
+    assert app.get_room_settings_version(target)[0]['theme'] == 'github'
+
+
+def test_quotas_and_bad_input(room, monkeypatch):
+    monkeypatch.setattr(app, 'IMPORT_MAX_FILES', 2)
+    paths, error = app.import_archive(room, io.BytesIO(zip_bytes({'a': b'1', 'b': b'2', 'c': b'3'})))
+    assert paths == [] and 'more than 2 files' in error
+
+    data = zip_bytes({'a.py': bytes(range(256)) * 40})
+    assert app.import_archive(room, io.BytesIO(data[:len(data) // 2]))[1] == "Truncated archive"
+    assert app.import_archive(room, io.BytesIO(b'not an archive at all'))[1].startswith("Invalid archive")
+    assert not os.listdir(app.get_room_path(room))
@@ -0,0 +1,34 @@
+import os
+
+import app
+
+
+def batch(room, operations):
+    response = app.app.test_client().post('/api/batch', json={'room_id': room, 'operations': operations})
+    return response.status_code, response.get_json()
+
+
+def test_null_content_creates_from_template(room):
+    status, body = batch(room, [
+        {'op': 'create', 'path': 'main.py', 'content': None},
+        {'op': 'create', 'path': 'script', 'content': None, 'language': 'bash'},
+    ])
+    assert status == 200 and body['success']
+    assert app.read_file_from_disk(room, 'main.py') == app.LANGUAGE_CONFIG['python']['template']
+    assert app.read_file_from_disk(room, 'script') == app.LANGUAGE_CONFIG['bash']['template']
+
+
+def test_null_content_is_rejected_for_save(room):
+    status, body = batch(room, [{'op': 'save', 'path': 'a.py', 'content': None}])
+    assert status == 400
+    assert body['results'][0]['error'] == "Content must be a string"
+
+
+def test_unsafe_path_blocks_whole_batch(room):
+    status, body = batch(room, [
+        {'op': 'create', 'path': 'ok.txt', 'content': 'x'},
+        {'op': 'create', 'path': '../escape.txt', 'content': 'x'},
+    ])
+    assert status == 400
+    assert [result['error'] for result in body['results']] == ["Not applied", "Unsafe path"]
+    assert not os.path.exists(os.path.join(app.get_room_path(room), 'ok.txt'))
@@ -0,0 +1,48 @@
+import shutil
+
+import pytest
+
+import app
+
+pytestmark = pytest.mark.skipif(shutil.which('gcc') is None, reason="gcc is not installed")
+
+PROGRAM = '#include <stdio.h>\n#include "greeting.h"\n\nint main(void) {\n    puts(GREETING);\n    return 0;\n}\n'
+
+
+def stats():
+    with app.compile_cache_lock:
+        return app.compile_cache_stats['hits'], app.compile_cache_stats['misses']
+
+
+def run(room):
+    result = app.execute_code('c', PROGRAM, room_id=room, filename='main.c')
+    assert not result['error'], result['output']
+    return result['output']
+
+
+def test_identical_room_run_hits_cache(room):
+    app.save_file_content(room, 'greeting.h', '#define GREETING "hello"\n')
+    hits, misses = stats()
+    assert run(room).strip() == 'hello'
+    assert stats() == (hits, misses + 1)
+
+    assert run(room).strip() == 'hello'
+    assert stats() == (hits + 1, misses + 1)
+
+
+def test_changed_header_misses_cache(room):
+    app.save_file_content(room, 'greeting.h', '#define GREETING "one"\n')
+    run(room)
+    hits, misses = stats()
+
+    app.save_file_content(room, 'greeting.h', '#define GREETING "two"\n')
+    assert run(room).strip() == 'two'
+    assert stats() == (hits, misses + 1)
+
+
+def test_temp_runs_share_entries():
+    code = '#include <stdio.h>\n\nint main(void) {\n    puts("temp");\n    return 0;\n}\n'
+    app.execute_code('c', code)
+    hits, misses = stats()
+    assert app.execute_code('c', code)['output'].strip() == 'temp'
+    assert stats() == (hits + 1, misses)
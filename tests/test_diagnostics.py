@@ -0,0 +1,39 @@
+import logging
+
+import app
+
+
+class BrokenLinter:
+    name = 'broken'
+
+    def lint(self, content, job):
+        raise RuntimeError("boom")
+
+
+def keys(room):
+    tables = (app.diagnostics_pending, app.diagnostics_generation, app.diagnostics_results)
+    return {key for table in tables for key in table if key[0] == room}
+
+
+def test_failing_linter_is_logged(room, monkeypatch, caplog):
+    app.save_file_content(room, 'a.py', 'x = 1\n')
+    monkeypatch.setitem(app.diagnostic_linters, 'python', [BrokenLinter()])
+    app.schedule_diagnostics(room, 'a.py')
+    with caplog.at_level(logging.WARNING, logger=app.app.logger.name):
+        app.run_diagnostics(room, 'a.py', None, app.diagnostics_generation[(room, 'a.py')])
+    assert "Linter broken failed on a.py: boom" in caplog.text
+
+
+def test_entries_follow_file_lifecycle(room):
+    for name in ('a.py', 'b.py', 'c.py'):
+        app.save_file_content(room, name, 'x = 1\n')
+        app.schedule_diagnostics(room, name)
+        app.publish_diagnostics(room, name, None, [])
+    assert keys(room) == {(room, 'a.py'), (room, 'b.py'), (room, 'c.py')}
+
+    assert app.delete_file(room, 'a.py')
+    assert app.rename_file(room, 'b.py', 'd.py')
+    assert keys(room) == {(room, 'c.py')}
+
+    app.forget_diagnostics(room)
+    assert keys(room) == set()
@@ -0,0 +1,42 @@
+import os
+
+import app
+
+
+def test_get_missing_file_creates_no_document(room):
+    http = app.app.test_client()
+    assert http.get(f'/api/files/{room}/nope.py').status_code == 404
+    assert (room, 'nope.py') not in app.documents
+    assert app.state_backend.document_state(room, 'nope.py') is None
+    assert not os.path.exists(os.path.join(app.get_room_path(room), 'nope.py'))
+
+
+def test_binary_file_is_read_only(room):
+    data = bytes(range(256))
+    path = os.path.join(app.get_room_path(room), 'blob.bin')
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    response = app.app.test_client().get(f'/api/files/{room}/blob.bin')
+    assert response.status_code == 200 and response.json['binary']
+    assert 'epoch' not in response.json
+
+    socket = app.socketio.test_client(app.app)
+    socket.emit('join', {'room': room, 'username': 'ann'})
+    socket.emit('code_change', {'room': room, 'file': 'blob.bin', 'content': 'overwritten'})
+    socket.emit('code_delta', {'room': room, 'file': 'blob.bin', 'rev': 0, 'op': ['x']})
+    socket.disconnect()
+
+    assert (room, 'blob.bin') not in app.documents
+    app.flush_all_documents()
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_get_open_file_returns_live_content(room):
+    socket = app.socketio.test_client(app.app)
+    socket.emit('join', {'room': room, 'username': 'ann'})
+    socket.emit('code_change', {'room': room, 'file': 'new.py', 'content': 'x = 1\n'})
+    response = app.app.test_client().get(f'/api/files/{room}/new.py')
+    assert response.status_code == 200 and response.json['content'] == 'x = 1\n'
+    socket.disconnect()
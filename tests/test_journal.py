@@ -0,0 +1,102 @@
+import os
+
+import app
+
+
+def records(room, filename):
+    return [record for seq in app._journal_seqs(room, '.log')
+            for record in app._read_segment(room, seq) if record['f'] == filename]
+
+
+def test_unchanged_save_is_not_journaled(room):
+    assert app.save_file_content(room, 'a.py', 'print(1)\n')
+    mtime = os.stat(os.path.join(app.get_room_path(room), 'a.py')).st_mtime_ns
+    assert app.save_file_content(room, 'a.py', 'print(1)\n')
+    assert [r['t'] for r in records(room, 'a.py')] == ['base']
+    assert os.stat(os.path.join(app.get_room_path(room), 'a.py')).st_mtime_ns == mtime
+
+    assert app.save_file_content(room, 'a.py', 'print(2)\n')
+    assert [r['t'] for r in records(room, 'a.py')] == ['base', 'base']
+
+
+def test_journal_locks_are_released(room):
+    app.journal_append(room, {'t': 'delete', 'f': 'gone.py'})
+    assert room not in app.journal_locks
+
+
+def test_recovers_unsaved_ops(room):
+    app.save_file_content(room, 'a.txt', 'hello\n')
+    with app.state_backend.room_lock(room):
+        doc = app.get_document(room, 'a.txt')
+    revision = doc['revision']
+    assert app.apply_document_op(room, 'a.txt', revision, [5, ', world'], auto_save=False)
+    assert app.apply_document_op(room, 'a.txt', revision + 1, [12, '!'], auto_save=False)
+
+    # A crash loses the live document (and the in-process state backend) before it is written back
+    app.documents.pop((room, 'a.txt'))
+    app.state_backend.drop_document(room, 'a.txt')
+    assert app.read_file_from_disk(room, 'a.txt') == 'hello\n'
+    assert app.journal_state(room)['a.txt']['saved'] is False
+
+    assert app.recover_journals() >= 1
+    assert app.read_file_from_disk(room, 'a.txt') == 'hello, world!\n'
+    assert app.journal_state(room)['a.txt']['saved'] is True
+
+
+def test_compaction_keeps_latest_state(room, monkeypatch):
+    monkeypatch.setattr(app, 'JOURNAL_SEGMENT_BYTES', 2000)
+    monkeypatch.setattr(app, 'JOURNAL_MAX_BYTES', 8000)
+    for i in range(200):
+        app.save_file_content(room, 'a.txt', f"version {i}\n" * 20)
+    app.save_file_content(room, 'b.txt', 'other\n')
+
+    assert app._journal_seqs(room, '.snap')
+    assert app._journal_seqs(room, '.log')[0] > 1
+    journal_bytes = sum(os.path.getsize(os.path.join(app.get_journal_path(room), name))
+                        for name in os.listdir(app.get_journal_path(room)) if name != '.lock')
+    assert journal_bytes <= 8000 + 2 * 2000 + 4000
+
+    state = app.journal_state(room)
+    assert state['a.txt']['content'] == "version 199\n" * 20
+    assert state['b.txt']['content'] == 'other\n'
+    history = app.journal_history(room, 'a.txt')
+    assert len(history) < 200
+    assert app.journal_content(room, 'a.txt', history[-1]['epoch'], history[-1]['last_rev']) == "version 199\n" * 20
+
+
+def test_appends_reuse_the_open_segment(room, monkeypatch):
+    app.journal_append(room, {'t': 'delete', 'f': 'a'})
+    scans = []
+    seqs = app._journal_seqs
+    monkeypatch.setattr(app, '_journal_seqs', lambda *args: scans.append(args) or seqs(*args))
+    for i in range(20):
+        app.journal_append(room, {'t': 'delete', 'f': f'f{i}'})
+    assert scans == []
+    assert len(records(room, 'f19')) == 1
+
+
+def test_append_follows_a_roll_by_another_worker(room, monkeypatch):
+    monkeypatch.setattr(app, 'JOURNAL_SEGMENT_BYTES', 200)
+    app.journal_append(room, {'t': 'delete', 'f': 'ours'})
+
+    # Another worker fills segment 1, rolls and starts writing segment 2
+    with open(app._journal_file(room, 1, '.log'), 'a') as f:
+        f.write('{"t":"delete","f":"theirs","ts":0}\n' * 6)
+    app._roll_journal(room, 1)
+    with open(app._journal_file(room, 2, '.log'), 'a') as f:
+        f.write('{"t":"delete","f":"theirs","ts":0}\n')
+
+    app.journal_append(room, {'t': 'delete', 'f': 'next'})
+    assert app._journal_seqs(room, '.log') == [1, 2]
+    assert [r['f'] for r in app._read_segment(room, 2)] == ['theirs', 'next']
+
+
+def test_open_journals_are_bounded(room, monkeypatch):
+    monkeypatch.setattr(app, 'JOURNAL_OPEN_ROOMS', 2)
+    rooms = [f'{room}-{i}' for i in range(4)]
+    for other in rooms:
+        app.journal_append(other, {'t': 'delete', 'f': 'a'})
+    assert [other for other in app.journal_writers if other in rooms] == rooms[2:]
+    for other in rooms:
+        app.forget_journal_writer(other)
+    assert not set(rooms) & set(app.journal_writers)
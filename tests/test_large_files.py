@@ -0,0 +1,42 @@
+import os
+
+import app
+
+LINES = ''.join(f"line {i} é\n" for i in range(5000))
+
+
+def write(room, name, content):
+    path = os.path.join(app.get_room_path(room), name)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    return path
+
+
+def test_read_and_edit_by_line(room):
+    path = write(room, 'big.txt', LINES)
+    window = app.read_file_range(room, 'big.txt', line=4000, count=2)
+    assert window['text'] == 'line 4000 é\nline 4001 é\n'
+    assert window['total_lines'] == 5000
+
+    info, error = app.edit_file_range(room, 'big.txt', 'replaced\n', line=4000, count=2, version=window['version'])
+    assert error is None
+    with open(path, encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    assert lines[3999:4002] == ['line 3999 é', 'replaced', 'line 4002 é']
+    assert app.read_file_range(room, 'big.txt', line=4001, count=1)['text'] == 'line 4002 é\n'
+
+    # The old version no longer matches
+    assert app.edit_file_range(room, 'big.txt', 'x', line=0, count=1, version=window['version'])[1] == app.RANGE_CONFLICT
+
+
+def test_document_open_on_another_worker_blocks_edit(room):
+    write(room, 'big.txt', LINES)
+    # Another worker has the file open: only the shared state knows
+    app.state_backend.create_document(room, 'big.txt', 'e1', LINES)
+    try:
+        response = app.app.test_client().post(f'/api/file_range/{room}/big.txt', json={'text': 'x', 'line': 0, 'count': 1})
+        assert response.status_code == 409
+        assert response.get_json()['error'] == app.RANGE_LIVE_DOCUMENT
+        assert app.read_file_range(room, 'big.txt', line=0, count=1)['text'] == 'line 0 é\n'
+    finally:
+        app.state_backend.drop_document(room, 'big.txt')
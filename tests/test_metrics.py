@@ -0,0 +1,12 @@
+import app
+
+
+def test_metrics_endpoint_reports_requests():
+    client = app.app.test_client()
+    assert client.get('/api/languages').status_code == 200
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    body = response.get_data(as_text=True)
+    assert 'codesync_http_request_seconds_count{endpoint="/api/languages",method="GET",status="200"}' in body
+    assert '# TYPE codesync_active_rooms gauge' in body
@@ -0,0 +1,102 @@
+import random
+
+import pytest
+
+import app
+import ot
+
+ALPHABET = 'abc xyz\né€😀'
+
+
+def random_text(rng):
+    return ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 4)))
+
+
+def random_op(rng, doc):
+    """A random op over doc that never splits a character"""
+    op = []
+    i = 0
+    while i < len(doc):
+        if rng.random() < 0.2:
+            ot.append_component(op, random_text(rng))
+        n = rng.randint(1, 3)
+        units = ot.utf16_len(doc[i:i + n])
+        ot.append_component(op, units if rng.random() < 0.6 else {'d': units})
+        i += n
+    if rng.random() < 0.3:
+        ot.append_component(op, random_text(rng))
+    return ot.trim_op(op)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_transform_converges(seed):
+    rng = random.Random(seed)
+    for _ in range(50):
+        doc = random_text(rng) * rng.randint(0, 5)
+        a = random_op(rng, doc)
+        b = random_op(rng, doc)
+        left = ot.apply_text_op(ot.apply_text_op(doc, a), ot.transform_text_op(b, a, 'right'))
+        right = ot.apply_text_op(ot.apply_text_op(doc, b), ot.transform_text_op(a, b, 'left'))
+        assert left == right, (doc, a, b)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_compose_matches_sequential_apply(seed):
+    rng = random.Random(seed)
+    for _ in range(50):
+        doc = random_text(rng) * rng.randint(0, 5)
+        a = random_op(rng, doc)
+        middle = ot.apply_text_op(doc, a)
+        b = random_op(rng, middle)
+        assert ot.apply_text_op(doc, ot.compose_text_ops(a, b)) == ot.apply_text_op(middle, b)
+
+
+def test_positions_count_utf16_units():
+    assert ot.apply_text_op('a😀b', [3, 'X']) == 'a😀Xb'
+    assert ot.apply_text_op('a😀b', [1, {'d': 2}]) == 'ab'
+    with pytest.raises(ValueError):
+        ot.apply_text_op('ab', [3, 'X'])
+
+
+def test_check_text_op_rejects_bad_components():
+    assert ot.check_text_op([1, 'a', {'d': 2}])
+    for op in ([0], [''], [{'d': 0}], [True], [1.5], 'abc', [{'x': 1}]):
+        assert not ot.check_text_op(op), op
+
+
+def test_size_cap_counts_utf8_bytes(room, monkeypatch):
+    app.save_file_content(room, 'a.txt', 'aaaa')
+    with app.state_backend.room_lock(room):
+        revision = app.get_document(room, 'a.txt')['revision']
+    monkeypatch.setattr(app, 'MAX_FILE_SIZE', 10)
+    # 8 characters, but 12 bytes once encoded
+    assert app.apply_document_op(room, 'a.txt', revision, ['éééé']) is None
+    assert app.apply_document_op(room, 'a.txt', revision, ['ab']) is not None
+
+
+def test_oversize_full_sync_is_dropped(room, monkeypatch):
+    socket = app.socketio.test_client(app.app)
+    socket.emit('join', {'room': room, 'username': 'ann'})
+    socket.emit('code_change', {'room': room, 'file': 'a.txt', 'content': 'small'})
+    monkeypatch.setattr(app, 'MAX_FILE_SIZE', 100)
+    socket.emit('code_change', {'room': room, 'file': 'a.txt', 'content': 'é' * 250})
+
+    with app.state_backend.room_lock(room):
+        doc = app.get_document(room, 'a.txt')
+        assert doc['content'] == 'small' and doc['revision'] == 1
+    assert app.flush_document(room, 'a.txt')
+    assert not app.documents[(room, 'a.txt')]['dirty']
+    socket.disconnect()
+
+
+@pytest.mark.parametrize('rev', ['1', -1, 1.5, None, True])
+def test_bad_delta_revision_resyncs(room, rev):
+    app.save_file_content(room, 'a.txt', 'abc')
+    socket = app.socketio.test_client(app.app)
+    socket.emit('join', {'room': room, 'username': 'ann'})
+    socket.get_received()
+    socket.emit('code_delta', {'room': room, 'file': 'a.txt', 'rev': rev, 'op': ['x']})
+
+    assert [message['name'] for message in socket.get_received()] == ['resync']
+    assert app.read_file_from_disk(room, 'a.txt') == 'abc'
+    socket.disconnect()
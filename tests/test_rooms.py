@@ -0,0 +1,95 @@
+import os
+import time
+import uuid
+
+import app
+
+
+def per_room_state():
+    """Every in-memory map that holds per-room state, as (name, room ids)"""
+    backend = app.state_backend
+    return {
+        'room_users': set(app.room_users),
+        'sid_rooms': set(app.sid_rooms),
+        'empty_rooms': set(app.empty_rooms),
+        'presence_dirty': set(app.presence_dirty),
+        'room_locks': set(app.room_locks),
+        'journal_locks': set(app.journal_locks),
+        'journal_writers': set(app.journal_writers),
+        'documents': {room for room, _ in app.documents},
+        'file_indexes': set(app.file_indexes),
+        'search_indexes': set(app.search_indexes),
+        'search_texts': {room for room, _ in app.search_texts},
+        'line_indexes': {room for room, _ in app.line_indexes},
+        'settings_cache': set(app.settings_cache),
+        'created_rooms': set(app.created_rooms),
+        'diagnostics_pending': {room for room, _ in app.diagnostics_pending},
+        'diagnostics_generation': {room for room, _ in app.diagnostics_generation},
+        'diagnostics_results': {room for room, _ in app.diagnostics_results},
+        'backend_members': set(backend.members),
+        'backend_presence': set(backend.presence),
+        'backend_documents': {room for room, _ in backend.documents},
+    }
+
+
+def use_room(http, room):
+    """Touch a room the way a short visit does: page, socket edits, listing, search, settings"""
+    assert http.get(f'/room/{room}').status_code == 200
+    socket = app.socketio.test_client(app.app)
+    socket.emit('join', {'room': room, 'username': 'ann'})
+    socket.emit('code_change', {'room': room, 'file': 'main.py', 'content': 'print("hi")\n'})
+    socket.emit('cursor_move', {'room': room, 'cursor': {'row': 1, 'column': 2}})
+    assert http.get(f'/api/files/{room}').status_code == 200
+    assert http.get(f'/api/settings/{room}').status_code == 200
+    app.search_text(room, 'print')
+    with open(os.path.join(app.get_room_path(room), 'data.txt'), 'w') as f:
+        f.write('row\n' * 100)
+    app.read_file_range(room, 'data.txt', line=10, count=5)
+    app.publish_diagnostics(room, 'main.py', None, [])
+    return socket
+
+
+def test_disconnect_leaves_every_joined_room():
+    first, second = 'multi-' + uuid.uuid4().hex[:6], 'multi-' + uuid.uuid4().hex[:6]
+    ann = app.socketio.test_client(app.app)
+    bob = app.socketio.test_client(app.app)
+    ann.emit('join', {'room': first, 'username': 'ann'})
+    ann.emit('join', {'room': second, 'username': 'ann'})
+    bob.emit('join', {'room': first, 'username': 'bob'})
+    bob.get_received()
+
+    ann.disconnect()
+    assert [message['name'] for message in bob.get_received()] == ['user_left']
+    assert list(app.room_users[first].values())[0]['username'] == 'bob'
+    assert second not in app.room_users
+    assert set(app.state_backend.room_members(first)) == set(app.room_users[first])
+    bob.disconnect()
+
+
+def test_abandoned_rooms_are_released(monkeypatch):
+    # Start the reaper at its real interval before the grace period is shortened
+    app.ensure_background_task('room_reaper', app.room_reaper)
+    http = app.app.test_client()
+    rooms = ['abandoned-' + uuid.uuid4().hex[:6] for _ in range(5)]
+    for room in rooms:
+        use_room(http, room).disconnect()
+
+    state = per_room_state()
+    assert all(set(rooms) & state[name] for name in ('documents', 'file_indexes', 'search_indexes',
+                                                     'line_indexes', 'settings_cache', 'created_rooms',
+                                                     'room_locks', 'diagnostics_results', 'empty_rooms'))
+
+    # A room stays while it is inside its grace period
+    assert app.reclaim_rooms(time.time()) == 0
+    assert set(rooms) <= set(app.empty_rooms)
+
+    monkeypatch.setattr(app, 'ROOM_IDLE_GRACE', 0)
+    time.sleep(0.01)
+    assert app.reclaim_rooms(time.time()) >= len(rooms)
+    assert {name: rooms for name, rooms in per_room_state().items() if rooms} == {}
+    assert app.tracked_room_count() == 0
+
+    # Unsaved edits reached the disk, and the rooms still work afterwards
+    assert app.read_file_from_disk(rooms[0], 'main.py') == 'print("hi")\n'
+    use_room(http, rooms[0]).disconnect()
+    assert app.search_text(rooms[0], 'hi')[1] == 1
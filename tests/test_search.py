@@ -0,0 +1,79 @@
+import re
+
+import pytest
+
+import app
+
+FILES = {
+    'a.txt': 'abbbc and the colour red\n',
+    'b.txt': 'abc, color, xyz\n',
+    'c.txt': 'foo.bar = 1\nAbC\n',
+    'd.txt': 'hhey qqqrst ababc\n',
+    'e.txt': 'nothing to see\n',
+    'f.py': 'def bumblebee():\n    return 1\n',
+    'g.txt': 'Abc def xyyz ABBBC\n',
+    'h.txt': 'zz ] zz\n',
+}
+
+PATTERNS = [
+    'ab+c', 'abb+c', 'b+c', 'ab+', 'a+bc', 'ab+?c', 'colou?r', 'colou*r', 'x+y+z', r'foo\.bar', 'a.b',
+    '(ab)+c', '[abc]+def', r'\x41bc', r'\x61bbbc', 'h{2}ey', 'q*rst', '(?x) a b c', r'\bbumble\w+',
+    r'(a)\1bc', 'def bumble', '^abbb', '[]x]', '[^]x]', '[]abc] zz', '[^]]zz', '(x[)]abc)?def', r'[\]]abc',
+]
+
+
+@pytest.fixture
+def files(room):
+    for path, content in FILES.items():
+        assert app.save_file_content(room, path, content)
+    return room
+
+
+@pytest.mark.parametrize('case_sensitive', [False, True])
+@pytest.mark.parametrize('query', PATTERNS)
+def test_regex_prefilter_matches_full_scan(files, query, case_sensitive):
+    flags = re.MULTILINE | (0 if case_sensitive else re.IGNORECASE)
+    expected = sorted(path for path, content in FILES.items() if re.search(query, content, flags))
+    page, total = app.search_text(files, query, regex=True, case_sensitive=case_sensitive, limit=100)
+    assert sorted(result['path'] for result in page) == expected
+    assert total == len(expected)
+
+
+def test_repeated_character_splits_literals():
+    assert app._regex_literals('ab+c') == []
+    assert app._regex_literals('abcd+efg') == ['abcd', 'defg']
+    assert app._regex_literals('colou?r') == ['colo']
+    assert app._regex_literals('[]abc]xyz') == ['xyz']
+    assert app._regex_literals('[^]abc]xyz') == ['xyz']
+
+
+def test_index_keeps_no_file_text(files):
+    app.search_text(files, 'abc')
+    index = app.get_search_index(files)
+    assert all('content' not in entry for entry in index['files'].values())
+
+
+def test_repeated_searches_do_not_reread_files(files, monkeypatch):
+    app.search_text(files, 'abc')
+    reads = []
+    read = app.read_file_from_disk
+    monkeypatch.setattr(app, 'read_file_from_disk', lambda *args: reads.append(args) or read(*args))
+    assert app.search_text(files, 'abc')[1] == 4
+    assert app.search_text(files, 'ab+c', regex=True)[1] == 5
+    assert reads == []
+
+
+def test_search_text_cache_is_bounded(files, monkeypatch):
+    monkeypatch.setattr(app, 'SEARCH_TEXT_CACHE_CHARS', 40)
+    app.forget_search_texts(files)
+    app.search_text(files, 'abc')
+    assert app.search_texts_size[0] <= 40
+    assert app.search_texts_size[0] == sum(len(text) for _, text in app.search_texts.values())
+    assert app.search_text(files, 'abc')[1] == 4
+
+
+def test_search_sees_saved_changes(files):
+    assert app.search_text(files, 'zebra')[1] == 0
+    app.save_file_content(files, 'e.txt', 'a zebra\n')
+    page, total = app.search_text(files, 'zebra')
+    assert total == 1 and page[0]['matches'] == [{'line': 1, 'text': 'a zebra'}]
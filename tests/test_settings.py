@@ -0,0 +1,22 @@
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('body', ['[]', '"x"', '3', 'null'])
+def test_non_object_settings_are_rejected(room, body):
+    response = app.app.test_client().post(f'/api/settings/{room}', data=body, content_type='application/json')
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+
+
+def test_saved_settings_bump_the_etag(room):
+    client = app.app.test_client()
+    etag = client.get(f'/api/settings/{room}').headers['ETag']
+    assert client.get(f'/api/settings/{room}', headers={'If-None-Match': etag}).status_code == 304
+
+    response = client.post(f'/api/settings/{room}', json={'theme': 'github', 'font_size': 16})
+    assert response.get_json()['success'] is True
+    response = client.get(f'/api/settings/{room}', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['theme'] == 'github'